@@ -1,18 +1,31 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from http.cookiejar import DefaultCookiePolicy
 import json
+import base64
 import time
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import re
+from urllib.parse import urlparse
 import csv
 from io import BytesIO
 import zipfile
-import pandas as pd
+import itertools
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.styles import ParagraphStyle
+from xml.sax.saxutils import escape as xml_escape
 from reportlab.lib.units import inch
 import openai
 from bs4 import BeautifulSoup
@@ -21,7 +34,14 @@ from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from threading import Thread
+from threading import Thread, Lock, Event, Condition, current_thread
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+import queue
+from functools import lru_cache
+import numpy as np
+import uuid
+import hashlib
+from collections import OrderedDict
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -35,11 +55,12 @@ if not openai.api_key:
     print("WARNING: OPENAI_API_KEY environment variable is not set")
 
 # Папка для сохранения файлов
-UPLOAD_FOLDER = 'parsed_files'
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'parsed_files')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+# Переопределяется в тестах и бенчмарке, чтобы не трогать рабочую базу
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = 'supersecretkey'
 db = SQLAlchemy(app)
@@ -57,6 +78,7 @@ class User(db.Model, UserMixin):
     ai_token = db.Column(db.String(256), nullable=True)
     ai_prompt = db.Column(db.Text, nullable=True)
     ai_reply_mode = db.Column(db.String(16), default='manual')  # manual, suggest, auto
+    ai_auto_enabled_at = db.Column(db.DateTime, nullable=True)  # UTC; автоответ только на отзывы новее
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -114,6 +136,916 @@ def profile():
         return jsonify({'success': True})
     return jsonify({'email': current_user.email, 'name': current_user.name, 'wb_token': current_user.wb_token, 'supplier_id': current_user.supplier_id})
 
+# ===== Хранилище снимков товаров продавцов =====
+class SellerProduct(db.Model):
+    """Последний известный снимок товара продавца (запись extract_product_info)"""
+    id = db.Column(db.Integer, primary_key=True)
+    seller_id = db.Column(db.String(32), nullable=False, index=True)
+    article = db.Column(db.String(32), nullable=False)
+    data = db.Column(db.Text, nullable=False)  # JSON записи extract_product_info
+    sale_price = db.Column(db.Float)
+    price = db.Column(db.Float)
+    stock = db.Column(db.Integer)
+    rating = db.Column(db.Float)
+    feedbacks = db.Column(db.Integer)
+    first_seen_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)  # когда запись последний раз менялась
+    snapshot_at = db.Column(db.DateTime, nullable=False, index=True)  # когда товар последний раз видели при обходе
+    __table_args__ = (db.UniqueConstraint('seller_id', 'article', name='uq_seller_product'),)
+
+class ProductChange(db.Model):
+    """Изменение отслеживаемого поля товара между снимками"""
+    id = db.Column(db.Integer, primary_key=True)
+    seller_id = db.Column(db.String(32), nullable=False)
+    article = db.Column(db.String(32), nullable=False)
+    field = db.Column(db.String(32), nullable=False)
+    old_value = db.Column(db.String(64))
+    new_value = db.Column(db.String(64))
+    snapshot_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('ix_product_change_seller_time', 'seller_id', 'snapshot_at'),)
+
+class SellerCrawl(db.Model):
+    """Обход каталога продавца (снимок)"""
+    id = db.Column(db.Integer, primary_key=True)
+    seller_id = db.Column(db.String(32), nullable=False, index=True)
+    status = db.Column(db.String(16), default='running')  # running, done, failed
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    products_count = db.Column(db.Integer, default=0)
+    new_count = db.Column(db.Integer, default=0)
+    changed_count = db.Column(db.Integer, default=0)
+    # Чекпоинт для продолжения прерванного обхода
+    last_page = db.Column(db.Integer, default=0)
+    stats = db.Column(db.Text)  # JSON словаря stats из iter_seller_pages
+    checkpoint_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'seller_id': self.seller_id,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'products_count': self.products_count,
+            'new_count': self.new_count,
+            'changed_count': self.changed_count,
+            'last_page': self.last_page,
+            'checkpoint_at': self.checkpoint_at.isoformat() if self.checkpoint_at else None
+        }
+
+class ProductStore:
+    """Снимки товаров продавцов в БД: повторный обход записывает только изменения"""
+    # Поля записи extract_product_info, изменения которых сохраняются в ProductChange
+    TRACKED_FIELDS = {
+        'Цена со скидкой': 'sale_price',
+        'Цена без скидки': 'price',
+        'Остаток': 'stock',
+        'Оценка': 'rating',
+        'Количество отзывов': 'feedbacks',
+    }
+
+    def start_crawl(self, seller_id):
+        crawl = SellerCrawl(seller_id=str(seller_id), status='running', started_at=datetime.now())
+        db.session.add(crawl)
+        db.session.commit()
+        return crawl
+
+    def finish_crawl(self, crawl, status='done'):
+        crawl.status = status
+        crawl.finished_at = datetime.now()
+        db.session.commit()
+
+    def save_page(self, crawl, records, last_page=None, stats=None):
+        """Сохраняет страницу записей: новые товары добавляются, у известных пишутся только изменения
+
+        В той же транзакции обновляется чекпоинт обхода: номер последней
+        сохраненной страницы и статистика парсера.
+        """
+        seller_id = crawl.seller_id
+        snapshot_at = crawl.started_at
+        articles = [str(r.get('Артикул')) for r in records if r.get('Артикул')]
+        existing = {
+            p.article: p for p in SellerProduct.query.filter(
+                SellerProduct.seller_id == seller_id,
+                SellerProduct.article.in_(articles)
+            )
+        }
+        new_count = changed_count = 0
+        for record in records:
+            article = str(record.get('Артикул') or '')
+            if not article:
+                continue
+            tracked = {column: record.get(field) for field, column in self.TRACKED_FIELDS.items()}
+            product = existing.get(article)
+            if product is None:
+                product = SellerProduct(seller_id=seller_id, article=article, first_seen_at=snapshot_at,
+                                        updated_at=snapshot_at, snapshot_at=snapshot_at,
+                                        data=json.dumps(record, ensure_ascii=False), **tracked)
+                db.session.add(product)
+                existing[article] = product
+                new_count += 1
+                continue
+            product.snapshot_at = snapshot_at
+            changed = False
+            for field, column in self.TRACKED_FIELDS.items():
+                old_value = getattr(product, column)
+                new_value = tracked[column]
+                if old_value != new_value:
+                    db.session.add(ProductChange(seller_id=seller_id, article=article, field=field,
+                                                 old_value=None if old_value is None else str(old_value),
+                                                 new_value=None if new_value is None else str(new_value),
+                                                 snapshot_at=snapshot_at))
+                    setattr(product, column, new_value)
+                    changed = True
+            data = json.dumps(record, ensure_ascii=False)
+            if changed or product.data != data:
+                product.data = data
+                product.updated_at = snapshot_at
+            if changed:
+                changed_count += 1
+        crawl.products_count = (crawl.products_count or 0) + len(records)
+        crawl.new_count = (crawl.new_count or 0) + new_count
+        crawl.changed_count = (crawl.changed_count or 0) + changed_count
+        if last_page is not None:
+            crawl.last_page = last_page
+            # Парсер (и буфер уточнения остатков) может уйти вперед чекпоинта:
+            # счетчики страниц и товаров берем по сохраненным страницам
+            stats = dict(stats or {}, products=crawl.products_count, pages_done=last_page)
+            crawl.stats = json.dumps(stats, ensure_ascii=False)
+            crawl.checkpoint_at = datetime.now()
+        db.session.commit()
+        return new_count, changed_count
+
+    def resumable_crawl(self, seller_id):
+        """Последний незавершенный обход продавца с чекпоинтом (если после него не было успешного)"""
+        crawl = (SellerCrawl.query
+                 .filter_by(seller_id=str(seller_id))
+                 .order_by(SellerCrawl.started_at.desc())
+                 .first())
+        if crawl and crawl.status != 'done' and crawl.last_page:
+            return crawl
+        return None
+
+    def last_crawl(self, seller_id, status='done'):
+        return (SellerCrawl.query
+                .filter_by(seller_id=str(seller_id), status=status)
+                .order_by(SellerCrawl.started_at.desc())
+                .first())
+
+    def iter_products(self, seller_id, seen_since=None, batch_size=1000):
+        """Записи товаров продавца из хранилища (по умолчанию — увиденные последним обходом)"""
+        if seen_since is None:
+            crawl = self.last_crawl(seller_id)
+            seen_since = crawl.started_at if crawl else None
+        query = SellerProduct.query.filter(SellerProduct.seller_id == str(seller_id))
+        if seen_since is not None:
+            query = query.filter(SellerProduct.snapshot_at >= seen_since)
+        last_id = 0
+        while True:
+            rows = (query.filter(SellerProduct.id > last_id)
+                    .order_by(SellerProduct.id)
+                    .with_entities(SellerProduct.id, SellerProduct.data)
+                    .limit(batch_size)
+                    .all())
+            if not rows:
+                break
+            for row_id, data in rows:
+                yield json.loads(data)
+            last_id = rows[-1][0]
+
+    def changes(self, seller_id, since=None, until=None, article=None, field=None, limit=1000):
+        query = ProductChange.query.filter(ProductChange.seller_id == str(seller_id))
+        if since:
+            query = query.filter(ProductChange.snapshot_at > since)
+        if until:
+            query = query.filter(ProductChange.snapshot_at <= until)
+        if article:
+            query = query.filter(ProductChange.article == str(article))
+        if field:
+            query = query.filter(ProductChange.field == field)
+        return [{
+            'article': c.article,
+            'field': c.field,
+            'old_value': c.old_value,
+            'new_value': c.new_value,
+            'snapshot_at': c.snapshot_at.isoformat()
+        } for c in query.order_by(ProductChange.snapshot_at.desc(), ProductChange.id).limit(limit)]
+
+product_store = ProductStore()
+
+# ===== Общий HTTP-клиент с пулами соединений =====
+HTTP_POOL_SIZE = int(os.getenv('WB_HTTP_POOL_SIZE', 10))
+HTTP_TIMEOUT = float(os.getenv('WB_HTTP_TIMEOUT', 15))
+HTTP_RETRIES = int(os.getenv('WB_HTTP_RETRIES', 2))
+HTTP_BACKOFF = float(os.getenv('WB_HTTP_BACKOFF', 0.5))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+
+# Группы хостов: у каждой свой пул соединений.
+# Размер пула группы можно переопределить через WB_HTTP_POOL_SIZE_<ГРУППА>, например WB_HTTP_POOL_SIZE_CATALOG=16
+HTTP_HOST_GROUPS = [
+    ('catalog', 'catalog.wb.ru'),
+    ('search', 'search.wb.ru'),
+    ('card', 'card.wb.ru'),
+    ('basket', '.wbbasket.ru'),
+    ('feedbacks', 'feedbacks-api.wildberries.ru'),
+    ('advert', 'advert-api.wb.ru'),
+    ('suppliers', 'suppliers.wildberries.ru'),
+]
+
+def _counting_pool_class(base):
+    """Пул urllib3, который сообщает, досталось ли запросу уже открытое соединение"""
+    class CountingPool(base):
+        def _get_conn(self, timeout=None):
+            conn = super()._get_conn(timeout)
+            http_client.record_connection(self.host, reused=getattr(conn, 'sock', None) is not None)
+            return conn
+    CountingPool.__name__ = f'Counting{base.__name__}'
+    return CountingPool
+
+CountingHTTPConnectionPool = _counting_pool_class(HTTPConnectionPool)
+CountingHTTPSConnectionPool = _counting_pool_class(HTTPSConnectionPool)
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+class HttpClient:
+    """Общий для процесса HTTP-клиент: keep-alive сессия и пул соединений на каждую группу хостов"""
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._sessions = {}
+        self._stats = {}
+        self._lock = Lock()
+
+    def group_for(self, host):
+        host = (host or '').lower()
+        for group, pattern in HTTP_HOST_GROUPS:
+            if host == pattern or (pattern.startswith('.') and host.endswith(pattern)):
+                return group
+        return 'default'
+
+    def pool_size_for(self, group):
+        return int(os.getenv(f'WB_HTTP_POOL_SIZE_{group.upper()}', self.pool_size))
+
+    def _group_stats(self, group):
+        if group not in self._stats:
+            self._stats[group] = {'requests': 0, 'errors': 0, 'pool_hits': 0, 'pool_misses': 0}
+        return self._stats[group]
+
+    def session(self, group):
+        with self._lock:
+            session = self._sessions.get(group)
+            if session is None:
+                session = requests.Session()
+                # Сессии общие для всех пользователей, поэтому cookie не сохраняем
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'HEAD']),
+                    raise_on_status=False,
+                    respect_retry_after_header=True
+                )
+                size = self.pool_size_for(group)
+                adapter = CountingHTTPAdapter(pool_connections=size, pool_maxsize=size, max_retries=retry)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[group] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        group = self.group_for(urlparse(url).hostname)
+        with self._lock:
+            self._group_stats(group)['requests'] += 1
+        try:
+            return self.session(group).request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._group_stats(group)['errors'] += 1
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def record_connection(self, host, reused):
+        group = self.group_for(host)
+        with self._lock:
+            self._group_stats(group)['pool_hits' if reused else 'pool_misses'] += 1
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for group, stats in self._stats.items():
+                checkouts = stats['pool_hits'] + stats['pool_misses']
+                result[group] = dict(stats, pool_size=self.pool_size_for(group),
+                                     hit_ratio=round(stats['pool_hits'] / checkouts, 3) if checkouts else None)
+            return result
+
+http_client = HttpClient()
+
+_openai_clients = {}
+_openai_clients_lock = Lock()
+
+def get_openai_client(api_key):
+    """Переиспользуемый клиент OpenAI (со своим пулом соединений) на каждый API-ключ"""
+    with _openai_clients_lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            client = openai.OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+            _openai_clients[api_key] = client
+        return client
+
+# ===== Ограничение частоты запросов к WB =====
+CATALOG_CONCURRENCY = int(os.getenv('WB_CATALOG_CONCURRENCY', 4))
+CATALOG_RPS = float(os.getenv('WB_CATALOG_RPS', 3))
+CATALOG_MAX_CONCURRENCY = 16
+CATALOG_MAX_RPS = 20
+# Общий лимит запросов к search.wb.ru для всех проверок позиций процесса
+SEARCH_RPS = float(os.getenv('WB_SEARCH_RPS', 4))
+# Верхняя граница, до которой лимитер разгоняется после серии успешных ответов
+SEARCH_MAX_RPS = float(os.getenv('WB_SEARCH_MAX_RPS', 10))
+POSITION_CONCURRENCY = int(os.getenv('POSITION_CONCURRENCY', 4))
+POSITION_MAX_KEYWORDS = int(os.getenv('POSITION_MAX_KEYWORDS', 200))
+POSITION_MAX_PRODUCTS = int(os.getenv('POSITION_MAX_PRODUCTS', 500))
+POSITION_MAX_PAGES = 50
+# Анализ ставок: пары (регион, страница) загружаются параллельно через search_limiter
+AD_RATES_CONCURRENCY = int(os.getenv('AD_RATES_CONCURRENCY', 8))
+AD_RATES_MAX_REGIONS = 20
+AD_RATES_MAX_PAGES = 10
+# Пачки card.wb.ru для уточнения остатков
+STOCKS_BATCH_SIZE = int(os.getenv('WB_STOCKS_BATCH_SIZE', 100))
+STOCKS_CONCURRENCY = int(os.getenv('WB_STOCKS_CONCURRENCY', 4))
+
+class AdaptiveRateLimiter:
+    """Token bucket, который замедляется на 429 и разгоняется после серии успешных ответов"""
+    def __init__(self, rate, burst=None, min_rate=0.2, max_rate=None,
+                 backoff_factor=0.5, increase_factor=1.2, increase_after=20):
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.rate)
+        self.max_rate = float(max_rate or rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.backoff_factor = backoff_factor
+        self.increase_factor = increase_factor
+        self.increase_after = increase_after
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Блокирует поток, пока не появится свободный токен"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        """После increase_after успешных ответов подряд увеличиваем темп"""
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * self.increase_factor)
+                self._successes = 0
+
+    def on_failure(self):
+        """Ошибка, не связанная с лимитами: только сбрасываем серию успехов"""
+        with self._lock:
+            self._successes = 0
+
+    def on_throttle(self, retry_after=None):
+        """WB ограничил частоту (429) или не ответил: снижаем темп и опустошаем ведро"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+            self._tokens = 0
+            self._successes = 0
+            pause = retry_after if retry_after else 1 / self.rate
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+search_limiter = AdaptiveRateLimiter(rate=SEARCH_RPS, max_rate=max(SEARCH_RPS, SEARCH_MAX_RPS))
+
+# ===== Кэш ответов WB =====
+SEARCH_CACHE_TTL = int(os.getenv('WB_SEARCH_CACHE_TTL', 300))
+SEARCH_CACHE_SIZE = int(os.getenv('WB_SEARCH_CACHE_SIZE', 2000))
+# Страница выдачи — до ~100 товаров, в JSON это порядка 100-300 КБ, а в памяти
+# Python объекты занимают в несколько раз больше. Поэтому кэш ограничен еще и
+# суммарным размером страниц в JSON (приблизительная оценка памяти)
+SEARCH_CACHE_MAX_MB = float(os.getenv('WB_SEARCH_CACHE_MAX_MB', 64))
+# Каталог для второго (дискового) уровня кэша; пусто — только память
+SEARCH_CACHE_DIR = os.getenv('WB_SEARCH_CACHE_DIR', '')
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей
+
+    Первый уровень — память (OrderedDict, вытеснение самых давно
+    использованных записей при превышении max_size или max_bytes — суммарного
+    размера значений в JSON, если он задан), второй —
+    необязательный каталог на диске с JSON-файлами, который переживает
+    перезапуск процесса и общий для нескольких воркеров. Значения должны
+    сериализоваться в JSON, если включен диск.
+
+    get_or_load объединяет одновременные промахи по одному ключу:
+    загрузчик выполняется один раз, остальные потоки ждут его результат.
+    """
+    MISSING = object()
+
+    def __init__(self, name, ttl, max_size, disk_dir=None, max_bytes=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_bytes = max_bytes or None
+        self.disk_dir = disk_dir or None
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._loading = {}
+        self._lock = Lock()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'coalesced': 0, 'misses': 0,
+                          'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(json.dumps(key, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, f'{self.name}-{digest}.json')
+
+    def _size_of(self, value):
+        """Приблизительный размер значения (длина JSON); 0, если max_bytes не задан"""
+        if not self.max_bytes:
+            return 0
+        try:
+            return len(json.dumps(value, ensure_ascii=False, default=str))
+        except (TypeError, ValueError):
+            return 0
+
+    def _drop(self, key):
+        """Удаление из памяти; вызывается под self._lock"""
+        self._bytes -= self._sizes.pop(key, 0)
+        return self._items.pop(key, None)
+
+    def _store(self, key, value, expires_at, size=0):
+        """Запись в память; вызывается под self._lock"""
+        self._drop(key)
+        self._items[key] = (expires_at, value)
+        self._sizes[key] = size
+        self._bytes += size
+        while len(self._items) > self.max_size or (
+                self.max_bytes and self._bytes > self.max_bytes and len(self._items) > 1):
+            self._drop(next(iter(self._items)))
+            self._counters['evictions'] += 1
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), encoding='utf-8') as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return self.MISSING, 0
+        if item.get('expires_at', 0) <= time.time():
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+            return self.MISSING, 0
+        return item.get('value'), item['expires_at']
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._items.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return item[1]
+                self._drop(key)
+                self._counters['expired'] += 1
+        if self.disk_dir:
+            value, expires_at = self._read_disk(key)
+            if value is not self.MISSING:
+                size = self._size_of(value)
+                with self._lock:
+                    self._store(key, value, expires_at, size)
+                    self._counters['disk_hits'] += 1
+                return value
+        with self._lock:
+            self._counters['misses'] += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        size = self._size_of(value)
+        with self._lock:
+            self._store(key, value, expires_at, size)
+            self._counters['stores'] += 1
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'expires_at': expires_at, 'value': value}, f, ensure_ascii=False, default=str)
+                os.replace(tmp_path, path)
+            except (OSError, TypeError, ValueError) as e:
+                print(f"⚠️  Кэш {self.name}: не удалось записать на диск: {e}")
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Значение из кэша или результат loader(), сохраненный в кэш
+
+        ttl может быть функцией от загруженного значения.
+        """
+        value = self.get(key, self.MISSING)
+        if value is not self.MISSING:
+            return value
+        with self._lock:
+            key_lock = self._loading.setdefault(key, Lock())
+        with key_lock:
+            # Пока ждали блокировку, значение мог загрузить другой поток
+            with self._lock:
+                item = self._items.get(key)
+                if item is not None and item[0] > time.time():
+                    self._counters['misses'] -= 1
+                    self._counters['coalesced'] += 1
+                    return item[1]
+            try:
+                value = loader()
+                self.set(key, value, ttl(value) if callable(ttl) else ttl)
+                return value
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._drop(key)
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._bytes = 0
+        if self.disk_dir:
+            for filename in os.listdir(self.disk_dir):
+                if filename.startswith(f'{self.name}-') and filename.endswith('.json'):
+                    try:
+                        os.remove(os.path.join(self.disk_dir, filename))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._items)
+            size_bytes = self._bytes
+        served = counters['hits'] + counters['disk_hits'] + counters['coalesced']
+        lookups = served + counters['misses']
+        counters.update({
+            'size': size,
+            'max_size': self.max_size,
+            'bytes': size_bytes if self.max_bytes else None,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'disk': bool(self.disk_dir),
+            'hit_ratio': round(served / lookups, 4) if lookups else None
+        })
+        return counters
+
+# Страницы выдачи search.wb.ru по ключу (запрос, регион, страница, сортировка)
+search_cache = TTLCache('search', SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE,
+                        os.path.join(SEARCH_CACHE_DIR, 'search') if SEARCH_CACHE_DIR else None,
+                        max_bytes=int(SEARCH_CACHE_MAX_MB * 1024 * 1024))
+
+CARD_CACHE_TTL = int(os.getenv('WB_CARD_CACHE_TTL', 600))  # Цены и остатки быстро устаревают
+DESCRIPTION_CACHE_TTL = int(os.getenv('WB_DESCRIPTION_CACHE_TTL', 7 * 24 * 3600))
+CARD_CACHE_SIZE = int(os.getenv('WB_CARD_CACHE_SIZE', 5000))
+CARD_CACHE_DIR = os.getenv('WB_CARD_CACHE_DIR', SEARCH_CACHE_DIR)
+
+class ProductCardCache:
+    """Кэш товаров по nm id с разным временем жизни полей
+
+    cards — карточка card.wb.ru целиком (цены, остатки, категория), живет
+    CARD_CACHE_TTL; descriptions — найденные описание и категория, живут
+    DESCRIPTION_CACHE_TTL (пустое описание — CARD_CACHE_TTL, чтобы позже
+    поискать снова). Оба уровня — TTLCache на max_size записей в памяти с
+    необязательным дисковым уровнем, который вмещает ассортимент целиком.
+    """
+    def __init__(self, card_ttl=CARD_CACHE_TTL, description_ttl=DESCRIPTION_CACHE_TTL,
+                 max_size=CARD_CACHE_SIZE, disk_dir=CARD_CACHE_DIR):
+        self.cards = TTLCache('card', card_ttl, max_size,
+                              os.path.join(disk_dir, 'cards') if disk_dir else None)
+        self.descriptions = TTLCache('description', description_ttl, max_size,
+                                     os.path.join(disk_dir, 'descriptions') if disk_dir else None)
+
+    def get_cards(self, nm_ids, loader):
+        """Карточки {nm_id: карточка}: из кэша, недостающие — одним вызовом loader(список nm_id)"""
+        cards = {}
+        missing = []
+        for nm_id in dict.fromkeys(str(nm_id) for nm_id in nm_ids if nm_id):
+            card = self.cards.get(nm_id)
+            if card is None:
+                missing.append(nm_id)
+            else:
+                cards[nm_id] = card
+        if missing:
+            for nm_id, card in loader(missing).items():
+                self.cards.set(str(nm_id), card)
+                cards[str(nm_id)] = card
+        return cards
+
+    def description(self, nm_id, loader):
+        """Описание товара {'description', 'category', 'source', ...}: из кэша или loader()"""
+        return self.descriptions.get_or_load(
+            str(nm_id), loader, ttl=lambda value: None if value.get('description') else self.cards.ttl)
+
+    def cached_description(self, nm_id):
+        """Найденное ранее описание или пустая строка (без запросов к WB)"""
+        value = self.descriptions.get(str(nm_id))
+        return value.get('description', '') if value else ''
+
+product_card_cache = ProductCardCache()
+
+# Конкуренты по категории (subjectName или поисковому запросу)
+COMPETITORS_TOP_N = int(os.getenv('COMPETITORS_TOP_N', 20))
+COMPETITORS_MAX_TOP_N = 100
+COMPETITORS_CACHE_TTL = int(os.getenv('COMPETITORS_CACHE_TTL', 3600))
+competitors_cache = TTLCache('competitors', COMPETITORS_CACHE_TTL, 500,
+                             os.path.join(SEARCH_CACHE_DIR, 'competitors') if SEARCH_CACHE_DIR else None)
+
+# ===== Ключевые слова (TF-IDF по категориям) =====
+RUSSIAN_STOP_WORDS = frozenset({
+    'и', 'в', 'во', 'не', 'что', 'с', 'со', 'как', 'а', 'то', 'все', 'она', 'так', 'его', 'но',
+    'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от',
+    'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже', 'ну', 'вдруг', 'ли', 'если',
+    'уже', 'или', 'ни', 'быть', 'был', 'него', 'до', 'вас', 'нибудь', 'опять', 'уж', 'вам', 'ведь',
+    'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо', 'ней',
+    'для', 'мы', 'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз', 'тоже',
+    'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого', 'какой',
+    'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой', 'тем', 'чтобы', 'нее', 'сейчас',
+    'были', 'куда', 'зачем', 'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой',
+    'хоть', 'после', 'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая',
+    'много', 'разве', 'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой', 'перед', 'иногда',
+    'лучше', 'чуть', 'том', 'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между'
+})
+# Окончания, которые отрезает нормализатор (сначала длинные)
+RUSSIAN_ENDINGS = tuple(sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией', 'ость', 'ости',
+    'ий', 'ый', 'ой', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ых', 'их', 'ую', 'юю', 'ов', 'ев',
+    'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ию', 'ей',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True))
+KEYWORD_MIN_STEM = 4
+KEYWORD_INDEX_DIR = os.getenv('KEYWORD_INDEX_DIR', '')  # Пусто — индексы только в памяти
+KEYWORD_MIN_DOCUMENTS = 5  # Меньше документов в индексе — IDF не используется
+KEYWORD_FORMS_LIMIT = 5  # Сколько словоформ хранить на термин
+
+@lru_cache(maxsize=100000)
+def normalize_russian_word(word):
+    """Грубая нормализация: нижний регистр, ё -> е и отсечение окончания
+
+    Не полноценный стеммер: отрезается одно самое длинное окончание, если
+    после этого остается не меньше KEYWORD_MIN_STEM букв («платья»,
+    «платье», «платьем» -> «плать»).
+    """
+    word = word.lower().replace('ё', 'е')
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= KEYWORD_MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+def keyword_terms(text):
+    """Термины текста: нормализованные слова и биграммы соседних значимых слов
+
+    Возвращает список пар (термин, словоформа). Стоп-слова, числа, слова
+    короче трех букв и знаки препинания разрывают биграммы.
+    """
+    terms = []
+    for segment in re.split(r'[.,!?;:()\[\]«»"\n]+', (text or '').lower()):
+        previous = None
+        for word in re.findall(r'\w+', segment):
+            if word in RUSSIAN_STOP_WORDS or len(word) <= 2 or word.isdigit():
+                previous = None
+                continue
+            stem = normalize_russian_word(word)
+            terms.append((stem, word))
+            if previous:
+                terms.append((f'{previous[0]} {stem}', f'{previous[1]} {word}'))
+            previous = (stem, word)
+    return terms
+
+def keyword_term(keyword):
+    """Нормализованный термин ключевого слова или словосочетания (как в keyword_terms)"""
+    stems = [normalize_russian_word(word) for word in re.findall(r'\w+', (keyword or '').lower())
+             if word not in RUSSIAN_STOP_WORDS and len(word) > 2 and not word.isdigit()]
+    return ' '.join(stems) or (keyword or '').lower().strip()
+
+class KeywordIndex:
+    """Частоты документов (DF) терминов по описаниям товаров одной категории
+
+    Индекс пополняется инкрементально: каждый товар (nm id) учитывается
+    один раз. rank() считает TF-IDF для пачки текстов векторно: вхождения
+    терминов хранятся как разреженные массивы numpy (документ, термин,
+    количество), поэтому память зависит от числа вхождений, а не от
+    произведения числа документов на размер словаря.
+    """
+    def __init__(self, category):
+        self.category = category
+        self.documents = 0
+        self.df = {}
+        self.forms = {}
+        self.seen = set()
+        self._lock = Lock()
+
+    def add_documents(self, documents):
+        """Добавляет тексты {nm_id: текст}; возвращает число новых документов"""
+        added = 0
+        with self._lock:
+            for doc_id, text in documents.items():
+                doc_id = str(doc_id)
+                if doc_id in self.seen or not text:
+                    continue
+                self.seen.add(doc_id)
+                self.documents += 1
+                added += 1
+                for term in {term for term, _ in keyword_terms(text)}:
+                    self.df[term] = self.df.get(term, 0) + 1
+                for term, form in keyword_terms(text):
+                    forms = self.forms.setdefault(term, {})
+                    if form in forms or len(forms) < KEYWORD_FORMS_LIMIT:
+                        forms[form] = forms.get(form, 0) + 1
+        return added
+
+    def surface(self, term, fallback=None):
+        """Самая частая словоформа термина"""
+        with self._lock:
+            forms = self.forms.get(term)
+            if not forms:
+                return fallback or term
+            return max(forms.items(), key=lambda item: item[1])[0]
+
+    def rank(self, texts, top_n=20):
+        """Ключевые слова каждого текста по TF-IDF: список списков {'keyword', 'term', 'score'}"""
+        vocabulary = {}
+        doc_index, term_index, fallback_forms = [], [], {}
+        lengths = np.zeros(len(texts), dtype=np.float64)
+        for i, text in enumerate(texts):
+            terms = keyword_terms(text)
+            lengths[i] = max(1, sum(1 for term, _ in terms if ' ' not in term))
+            for term, form in terms:
+                index = vocabulary.setdefault(term, len(vocabulary))
+                fallback_forms.setdefault(term, form)
+                doc_index.append(i)
+                term_index.append(index)
+        results = [[] for _ in texts]
+        if not vocabulary:
+            return results
+        terms_by_index = list(vocabulary)
+        # Повторы (документ, термин) схлопываем в количество вхождений
+        pairs = np.array(doc_index, dtype=np.int64) * len(vocabulary) + np.array(term_index, dtype=np.int64)
+        pairs, counts = np.unique(pairs, return_counts=True)
+        docs, term_ids = np.divmod(pairs, len(vocabulary))
+        with self._lock:
+            documents = self.documents
+            df = np.fromiter((self.df.get(term, 0) for term in terms_by_index), dtype=np.float64,
+                             count=len(terms_by_index))
+        if documents >= KEYWORD_MIN_DOCUMENTS:
+            idf = np.log((1 + documents) / (1 + df)) + 1
+        else:
+            idf = np.ones(len(terms_by_index))
+        # Биграммы весомее: они реже и точнее описывают товар
+        weights = np.fromiter((1.5 if ' ' in term else 1.0 for term in terms_by_index), dtype=np.float64,
+                              count=len(terms_by_index))
+        scores = counts / lengths[docs] * idf[term_ids] * weights[term_ids]
+        # Сортировка по документу, внутри — по убыванию веса
+        order = np.lexsort((-scores, docs))
+        docs, term_ids, scores = docs[order], term_ids[order], scores[order]
+        starts = np.searchsorted(docs, np.arange(len(texts)))
+        ends = np.searchsorted(docs, np.arange(len(texts)), side='right')
+        for i in range(len(texts)):
+            for j in range(starts[i], min(ends[i], starts[i] + top_n)):
+                term = terms_by_index[term_ids[j]]
+                results[i].append({
+                    'keyword': self.surface(term, fallback_forms[term]),
+                    'term': term,
+                    'score': round(float(scores[j]), 4)
+                })
+        return results
+
+    def top_terms(self, limit=50):
+        """Самые распространенные в категории термины"""
+        with self._lock:
+            top = sorted(self.df.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [{'keyword': self.surface(term), 'term': term, 'documents': count} for term, count in top]
+
+    def to_dict(self):
+        """Снимок индекса: копии словарей, которые можно сериализовать без блокировки"""
+        with self._lock:
+            return {'category': self.category, 'documents': self.documents, 'df': dict(self.df),
+                    'forms': {term: dict(forms) for term, forms in self.forms.items()},
+                    'seen': sorted(self.seen)}
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(data['category'])
+        index.documents = data.get('documents', 0)
+        index.df = data.get('df', {})
+        index.forms = data.get('forms', {})
+        index.seen = set(data.get('seen', []))
+        return index
+
+class KeywordIndexRegistry:
+    """Индексы ключевых слов по категориям с необязательным сохранением в JSON"""
+    def __init__(self, directory=KEYWORD_INDEX_DIR):
+        self.directory = directory or None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self._indexes = {}
+        self._lock = Lock()
+        # Снимок и запись файла под одной блокировкой: более старый снимок
+        # не может перезаписать более новый
+        self._save_lock = Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, category):
+        key = ' '.join(str(category or '').lower().split())
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = KeywordIndex(key)
+                if self.directory and os.path.exists(self._path(key)):
+                    try:
+                        with open(self._path(key), encoding='utf-8') as f:
+                            index = KeywordIndex.from_dict(json.load(f))
+                    except (OSError, ValueError) as e:
+                        print(f"⚠️  Не удалось загрузить индекс ключевых слов '{key}': {e}")
+                self._indexes[key] = index
+            return index
+
+    def add_documents(self, category, documents):
+        """Пополняет индекс категории и сохраняет его, если включен каталог"""
+        index = self.get(category)
+        added = index.add_documents(documents)
+        if added and self.directory:
+            path = self._path(index.category)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with self._save_lock:
+                try:
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(index.to_dict(), f, ensure_ascii=False)
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print(f"⚠️  Не удалось сохранить индекс ключевых слов '{index.category}': {e}")
+        return index
+
+    def stats(self):
+        with self._lock:
+            return {key: index.documents for key, index in self._indexes.items()}
+
+keyword_indexes = KeywordIndexRegistry()
+
+def percentile(values, pct):
+    """Перцентиль с линейной интерполяцией; None для пустого списка"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = (len(values) - 1) * pct / 100
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return round(values[lower] + (values[upper] - values[lower]) * (index - lower), 2)
+
 class WildberriesParser:
     def __init__(self):
         self.headers = {
@@ -130,6 +1062,10 @@ class WildberriesParser:
         # https://www.wildberries.ru/seller/12345
         # https://www.wildberries.ru/brands/12345
         # https://www.wildberries.ru/brands/brand-name/all
+        # или просто 12345
+        
+        if re.fullmatch(r'\d+', str(seller_url).strip()):
+            return str(seller_url).strip()
         
         # Пробуем найти числовой ID
         match = re.search(r'/seller/(\d+)', seller_url)
@@ -150,16 +1086,12 @@ class WildberriesParser:
     
     def get_brand_id(self, brand_name):
         """Получение ID бренда по имени"""
-        search_url = f"https://search.wb.ru/exactmatch/ru/common/v4/search?query={brand_name}"
-        
         try:
-            response = requests.get(search_url, headers=self.headers)
-            response.raise_for_status()
-            data = response.json()
+            products = self.fetch_search_page(brand_name)
             
-            if data.get('data') and data['data'].get('products') and len(data['data']['products']) > 0:
+            if products:
                 # Берем supplierId первого товара
-                supplier_id = data['data']['products'][0].get('supplierId')
+                supplier_id = products[0].get('supplierId')
                 if supplier_id:
                     return str(supplier_id)
         except Exception as e:
@@ -167,11 +1099,41 @@ class WildberriesParser:
         
         raise ValueError(f"Не удалось найти бренд: {brand_name}")
     
-    def parse_seller_products(self, seller_url):
-        """Парсинг всех товаров продавца"""
+    def parse_seller_products(self, seller_url, progress_callback=None, concurrency=None, rps=None):
+        """Парсинг всех товаров продавца в список (см. iter_seller_pages)"""
+        return list(self.iter_seller_products(seller_url, progress_callback, concurrency, rps))
+    
+    def iter_seller_products(self, seller_url, progress_callback=None, concurrency=None, rps=None):
+        """Генератор записей extract_product_info по всем товарам продавца"""
+        for page_products in self.iter_seller_pages(seller_url, progress_callback, concurrency, rps):
+            yield from page_products
+    
+    def iter_seller_pages(self, seller_url, progress_callback=None, concurrency=None, rps=None,
+                          start_page=1, stats=None):
+        """Парсинг товаров продавца постранично
+
+        Генератор отдает список записей extract_product_info для каждой
+        страницы каталога, поэтому в памяти одновременно находится только
+        несколько страниц, а не весь каталог.
+
+        Страницы каталога загружаются параллельно (не более concurrency
+        запросов одновременно), частоту запросов регулирует AdaptiveRateLimiter
+        с целевым значением rps запросов в секунду.
+
+        progress_callback(dict) вызывается после каждой страницы и получает
+        текущий прогресс: страницы, товары, ошибки.
+
+        Для продолжения прерванного обхода передаются start_page и сохраненный
+        словарь stats. После окончания генератора stats['completed'] = True,
+        если достигнут конец каталога, и False, если обход остановлен ошибками.
+        """
+        concurrency = max(1, min(int(concurrency or CATALOG_CONCURRENCY), CATALOG_MAX_CONCURRENCY))
+        rps = max(0.1, min(float(rps or CATALOG_RPS), CATALOG_MAX_RPS))
+        
         print(f"\n{'='*50}")
         print(f"НАЧАЛО ПАРСИНГА ПРОДАВЦА")
         print(f"URL: {seller_url}")
+        print(f"Параллельность: {concurrency}, лимит: {rps} запр/сек")
         print(f"{'='*50}\n")
         
         try:
@@ -182,127 +1144,123 @@ class WildberriesParser:
             print(error_msg)
             raise ValueError(error_msg)
             
-        products = []
-        page = 1
-        total_requests = 0
-        consecutive_errors = 0
-        max_consecutive_errors = 3
-        
-        # Статистика для отладки
-        stats = {
-            'total_pages': 0,
-            'total_requests': 0,
-            'errors': [],
-            'empty_pages': 0,
-            'timeout_errors': 0,
-            'rate_limit_errors': 0
-        }
+        start_page = max(1, int(start_page or 1))
+        limiter = AdaptiveRateLimiter(rate=rps)
         
-        while True:
+        # Статистика для отладки (при продолжении обхода — восстановленная из чекпоинта)
+        if stats is None:
+            stats = {}
+        for key, default in (('total_pages', 0), ('pages_done', 0), ('total_requests', 0), ('errors', []),
+                             ('empty_pages', 0), ('timeout_errors', 0), ('rate_limit_errors', 0), ('products', 0)):
+            stats.setdefault(key, default)
+        stats['completed'] = False
+        products_count = stats['products']
+        if start_page > 1:
+            print(f"↻ Продолжаем обход со страницы {start_page}, уже собрано товаров: {products_count}")
+        
+        def report_progress(message=''):
+            if not progress_callback:
+                return
             try:
-                # Формируем URL
-                api_url = f"https://catalog.wb.ru/sellers/catalog?appType=1&curr=rub&dest=-1257786&page={page}&sort=popular&supplier={seller_id}"
+                progress_callback({
+                    'seller_id': seller_id,
+                    'pages_done': stats['pages_done'],
+                    'products': products_count,
+                    'requests': stats['total_requests'],
+                    'errors': len(stats['errors']) + stats['timeout_errors'],
+                    'rate_limit_errors': stats['rate_limit_errors'],
+                    'rate': round(limiter.rate, 2),
+                    'message': message
+                })
+            except Exception as e:
+                print(f"⚠️  Ошибка при обновлении прогресса: {e}")
+        
+        report_progress('Старт парсинга')
+        
+        def account(result):
+            stats['total_requests'] += result['requests']
+            stats['rate_limit_errors'] += result['rate_limit_errors']
+            stats['timeout_errors'] += result['timeout_errors']
+        
+        def find_last_page():
+            """Номер уже загруженной короткой (последней) страницы или None"""
+            last = None
+            for number, future in futures.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    done = future.result()
+                    if not done['error'] and len(done['products'] or []) < 100 and (last is None or number < last):
+                        last = number
+            return last
+        
+        def drop_pages_after(last):
+            """Отменяет страницы за концом каталога; уже выполненные запросы учитываются в stats"""
+            for number in [number for number in futures if number > last]:
+                future = futures.pop(number)
+                if future.cancel():
+                    continue
+                try:
+                    account(future.result())
+                except Exception:
+                    pass
+        
+        # Скользящее окно: держим в работе до concurrency страниц,
+        # а обрабатываем результаты строго по порядку номеров страниц.
+        # Как только известна короткая страница, за ее номер не заходим.
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='catalog')
+        futures = {}
+        stop = Event()
+        last_page = None
+        next_page = start_page
+        page = start_page
+        try:
+            while True:
+                found = find_last_page()
+                if found is not None and (last_page is None or found < last_page):
+                    last_page = found
+                    drop_pages_after(last_page)
+                while len(futures) < concurrency and (last_page is None or next_page <= last_page):
+                    futures[next_page] = executor.submit(self.fetch_catalog_page, seller_id, next_page, limiter,
+                                                         cancelled=stop)
+                    next_page += 1
                 
                 print(f"\n--- Страница {page} ---")
-                print(f"Текущее количество товаров: {len(products)}")
-                
-                # Большая пауза каждые 1000 товаров
-                if len(products) > 0 and len(products) % 1000 == 0:
-                    pause_time = 15  # Увеличиваем паузу до 15 секунд
-                    print(f"⏸️  БОЛЬШАЯ ПАУЗА {pause_time} сек после {len(products)} товаров...")
-                    time.sleep(pause_time)
-                
-                # Средняя пауза каждые 20 страниц
-                if page > 1 and page % 20 == 0:
-                    pause_time = 8  # Увеличиваем паузу до 8 секунд
-                    print(f"⏸️  Пауза {pause_time} сек после {page} страниц...")
-                    time.sleep(pause_time)
-                
-                # Делаем запрос с увеличенным таймаутом
-                print(f"→ Отправка запроса...")
-                start_time = time.time()
-                
-                response = requests.get(
-                    api_url, 
-                    headers=self.headers, 
-                    timeout=30  # Увеличенный таймаут
-                )
-                
-                request_time = time.time() - start_time
-                print(f"← Ответ получен за {request_time:.2f} сек, статус: {response.status_code}")
-                
-                total_requests += 1
-                stats['total_requests'] = total_requests
-                
-                # Проверка статуса
-                if response.status_code == 429:
-                    stats['rate_limit_errors'] += 1
-                    wait_time = 60
-                    print(f"⚠️  Ошибка 429: Слишком много запросов. Ожидание {wait_time} сек...")
-                    time.sleep(wait_time)
-                    continue
-                    
-                elif response.status_code != 200:
-                    error_msg = f"HTTP {response.status_code}: {response.text[:200]}"
-                    print(f"✗ Ошибка ответа: {error_msg}")
-                    stats['errors'].append({'page': page, 'error': error_msg})
-                    consecutive_errors += 1
-                    
-                    if consecutive_errors >= max_consecutive_errors:
-                        print(f"✗ Слишком много ошибок подряд ({consecutive_errors}). Остановка.")
-                        break
-                    
-                    time.sleep(5)
-                    continue
+                print(f"Текущее количество товаров: {products_count}")
                 
-                # Парсинг JSON
                 try:
-                    data = response.json()
-                except json.JSONDecodeError as e:
-                    error_msg = f"JSON decode error: {e}"
-                    print(f"✗ Ошибка парсинга JSON: {error_msg}")
-                    print(f"   Ответ сервера: {response.text[:500]}...")
-                    stats['errors'].append({'page': page, 'error': error_msg})
-                    consecutive_errors += 1
-                    
-                    if consecutive_errors >= max_consecutive_errors:
-                        break
-                    continue
-                
-                # Проверка структуры данных
-                if not isinstance(data, dict):
-                    print(f"✗ Неверный формат данных: {type(data)}")
+                    result = futures.pop(page).result()
+                except KeyboardInterrupt:
+                    print(f"\n⚠️  Прерывание пользователем")
                     break
-                
-                if 'data' not in data:
-                    print(f"✗ Отсутствует поле 'data' в ответе")
-                    print(f"   Структура: {list(data.keys()) if isinstance(data, dict) else 'не словарь'}")
+                except Exception as e:
+                    error_msg = f"{type(e).__name__}: {str(e)}"
+                    print(f"✗ НЕОЖИДАННАЯ ОШИБКА на странице {page}: {error_msg}")
+                    import traceback
+                    traceback.print_exc()
+                    stats['errors'].append({'page': page, 'error': error_msg})
                     break
                 
-                if not isinstance(data.get('data'), dict):
-                    print(f"✗ Поле 'data' не является словарем: {type(data.get('data'))}")
-                    break
+                account(result)
                 
-                if 'products' not in data['data']:
-                    print(f"✗ Отсутствует поле 'products' в data")
-                    stats['empty_pages'] += 1
+                if result['error']:
+                    # Страница не загрузилась после всех попыток
+                    print(f"✗ Страница {page} не загружена: {result['error']}. Остановка.")
+                    stats['errors'].append({'page': page, 'error': result['error']})
+                    report_progress(f'Ошибка на странице {page}')
                     break
                 
-                products_on_page = data['data']['products']
-                
-                if not isinstance(products_on_page, list):
-                    print(f"✗ products не является списком: {type(products_on_page)}")
-                    break
+                products_on_page = result['products']
                 
                 if not products_on_page:
                     print(f"✓ Страница {page} пустая - достигнут конец каталога")
                     stats['empty_pages'] += 1
+                    stats['completed'] = True
                     break
                 
                 print(f"✓ Найдено товаров на странице: {len(products_on_page)}")
-                consecutive_errors = 0  # Сброс счетчика ошибок
+                stats['pages_done'] += 1
                 
                 # Обработка товаров
+                page_products = []
                 page_errors = 0
                 for i, product in enumerate(products_on_page):
                     try:
@@ -311,15 +1269,13 @@ class WildberriesParser:
                             continue
                             
                         product_info = self.extract_product_info(product)
-                        products.append(product_info)
-                        
-                        # Микропауза каждые 100 товаров
-                        if len(products) % 100 == 0:
-                            time.sleep(0.5)  # Увеличиваем микропаузу до 0.5 секунд
+                        page_products.append(product_info)
+                        products_count += 1
+                        stats['products'] = products_count
                         
                         # Прогресс каждые 500 товаров
-                        if len(products) % 500 == 0:
-                            print(f"   ✓ Обработано товаров: {len(products)}")
+                        if products_count % 500 == 0:
+                            print(f"   ✓ Обработано товаров: {products_count}")
                             
                     except Exception as e:
                         page_errors += 1
@@ -329,74 +1285,42 @@ class WildberriesParser:
                 if page_errors > 0:
                     print(f"   ⚠️  Ошибок на странице: {page_errors}")
                 
+                yield page_products
+                
                 # Проверка на последнюю страницу
                 if len(products_on_page) < 100:
                     print(f"✓ Последняя страница (товаров < 100)")
+                    stats['completed'] = True
                     break
                 
                 # Ограничение для безопасности
-                if len(products) >= 100000:  # Увеличиваем лимит до 100,000
+                if products_count >= 100000:  # Увеличиваем лимит до 100,000
                     print(f"✓ Достигнут лимит в 100,000 товаров")
+                    stats['completed'] = True
                     break
                 
                 # Следующая страница
                 page += 1
                 stats['total_pages'] = page
-                
-                # Базовая пауза между страницами
-                time.sleep(3)  # Увеличиваем базовую паузу до 3 секунд
-                
-            except requests.exceptions.Timeout:
-                stats['timeout_errors'] += 1
-                consecutive_errors += 1
-                print(f"⚠️  Таймаут на странице {page}. Попытка {consecutive_errors}/{max_consecutive_errors}")
-                
-                if consecutive_errors >= max_consecutive_errors:
-                    print(f"✗ Слишком много таймаутов. Остановка.")
-                    break
-                    
-                time.sleep(10)  # Увеличиваем паузу при таймауте до 10 секунд
-                continue
-                
-            except requests.exceptions.ConnectionError as e:
-                error_msg = f"Connection error: {str(e)}"
-                print(f"⚠️  Ошибка соединения: {error_msg}")
-                stats['errors'].append({'page': page, 'error': error_msg})
-                consecutive_errors += 1
-                
-                if consecutive_errors >= max_consecutive_errors:
-                    break
-                    
-                time.sleep(15)  # Увеличиваем паузу при ошибке соединения до 15 секунд
-                continue
-                
-            except KeyboardInterrupt:
-                print(f"\n⚠️  Прерывание пользователем")
-                break
-                
-            except Exception as e:
-                error_msg = f"{type(e).__name__}: {str(e)}"
-                print(f"✗ НЕОЖИДАННАЯ ОШИБКА на странице {page}: {error_msg}")
-                import traceback
-                traceback.print_exc()
-                stats['errors'].append({'page': page, 'error': error_msg})
-                consecutive_errors += 1
-                
-                if consecutive_errors >= max_consecutive_errors:
-                    break
-                    
-                time.sleep(10)  # Увеличиваем паузу при неожиданной ошибке до 10 секунд
+                report_progress(f"Обработано страниц: {stats['pages_done']}")
+        finally:
+            # Страницы за концом каталога больше не нужны: ожидающие отменяем,
+            # а запросы, которые уже ушли, дожидаемся и учитываем в статистике
+            stop.set()
+            drop_pages_after(page)
+            executor.shutdown(wait=False, cancel_futures=True)
         
         # Итоговая статистика
         print(f"\n{'='*50}")
         print(f"ИТОГИ ПАРСИНГА:")
-        print(f"  • Всего товаров: {len(products)}")
-        print(f"  • Обработано страниц: {stats['total_pages']}")
+        print(f"  • Всего товаров: {products_count}")
+        print(f"  • Обработано страниц: {stats['pages_done']}")
         print(f"  • Всего запросов: {stats['total_requests']}")
         print(f"  • Ошибок таймаута: {stats['timeout_errors']}")
         print(f"  • Ошибок rate limit: {stats['rate_limit_errors']}")
         print(f"  • Пустых страниц: {stats['empty_pages']}")
         print(f"  • Всего ошибок: {len(stats['errors'])}")
+        print(f"  • Итоговый темп: {limiter.rate:.2f} запр/сек")
         
         if stats['errors']:
             print(f"\nПоследние ошибки:")
@@ -405,33 +1329,250 @@ class WildberriesParser:
         
         print(f"{'='*50}\n")
         
-        return products
+        report_progress('Парсинг завершен')
     
-    def get_product_stocks(self, product_id):
-        """Получение точных остатков товара через отдельный API"""
-        try:
-            # API для получения остатков
-            stocks_url = f"https://card.wb.ru/cards/detail?appType=1&curr=rub&dest=-1257786&nm={product_id}"
+    def fetch_catalog_page(self, seller_id, page, limiter, max_attempts=3, max_rate_limit_retries=10, cancelled=None):
+        """Загрузка одной страницы каталога продавца с повторами и учетом лимитера
+
+        cancelled — Event: если он установлен, пока страница ждет лимитер,
+        запрос не отправляется (обход уже закончился).
+        """
+        api_url = f"https://catalog.wb.ru/sellers/catalog?appType=1&curr=rub&dest=-1257786&page={page}&sort=popular&supplier={seller_id}"
+        result = {
+            'page': page,
+            'products': None,
+            'error': None,
+            'requests': 0,
+            'rate_limit_errors': 0,
+            'timeout_errors': 0
+        }
+        failures = 0
+        while failures < max_attempts:
+            limiter.acquire()
+            if cancelled is not None and cancelled.is_set():
+                result['error'] = 'Cancelled'
+                return result
+            result['requests'] += 1
+            start_time = time.time()
+            try:
+                response = http_client.get(api_url, headers=self.headers, timeout=30)
+            except requests.exceptions.Timeout:
+                result['timeout_errors'] += 1
+                result['error'] = 'Timeout'
+                failures += 1
+                print(f"⚠️  Таймаут на странице {page}. Попытка {failures}/{max_attempts}")
+                limiter.on_throttle()
+                continue
+            except requests.exceptions.ConnectionError as e:
+                result['error'] = f"Connection error: {str(e)}"
+                failures += 1
+                print(f"⚠️  Ошибка соединения на странице {page}: {e}")
+                limiter.on_throttle()
+                continue
             
-            response = requests.get(stocks_url, headers=self.headers)
-            response.raise_for_status()
-            data = response.json()
+            request_time = time.time() - start_time
+            print(f"← Страница {page}: ответ за {request_time:.2f} сек, статус: {response.status_code}")
             
-            total_stock = 0
-            if data.get('data') and data['data'].get('products'):
-                product = data['data']['products'][0]
-                if 'sizes' in product:
-                    for size in product['sizes']:
-                        if 'stocks' in size:
-                            for stock in size['stocks']:
-                                qty = stock.get('qty', 0)
-                                if qty and qty > 0:
-                                    total_stock += qty
+            if response.status_code == 429:
+                result['rate_limit_errors'] += 1
+                retry_after = response.headers.get('Retry-After')
+                limiter.on_throttle(retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+                print(f"⚠️  Ошибка 429 на странице {page}: снижаем темп до {limiter.rate:.2f} запр/сек")
+                if result['rate_limit_errors'] >= max_rate_limit_retries:
+                    result['error'] = f'HTTP 429 после {max_rate_limit_retries} попыток'
+                    return result
+                continue
+            
+            if response.status_code != 200:
+                result['error'] = f"HTTP {response.status_code}: {response.text[:200]}"
+                failures += 1
+                print(f"✗ Ошибка ответа на странице {page}: {result['error']}")
+                limiter.on_failure()
+                continue
+            
+            try:
+                data = response.json()
+            except ValueError as e:
+                result['error'] = f"JSON decode error: {e}"
+                failures += 1
+                print(f"✗ Ошибка парсинга JSON на странице {page}: {e}")
+                print(f"   Ответ сервера: {response.text[:500]}...")
+                limiter.on_failure()
+                continue
+            
+            limiter.on_success()
+            result['error'] = None
             
-            return total_stock
-        except:
+            # Проверка структуры данных: при неожиданном формате считаем страницу пустой
+            if not isinstance(data, dict):
+                print(f"✗ Неверный формат данных: {type(data)}")
+                result['products'] = []
+            elif not isinstance(data.get('data'), dict):
+                print(f"✗ Отсутствует или неверное поле 'data' в ответе")
+                print(f"   Структура: {list(data.keys())}")
+                result['products'] = []
+            elif not isinstance(data['data'].get('products'), list):
+                print(f"✗ Отсутствует список 'products' в data")
+                result['products'] = []
+            else:
+                result['products'] = data['data']['products']
+            return result
+        
+        return result
+    
+    def get_product_stocks(self, product_id):
+        """Получение точных остатков товара через отдельный API"""
+        try:
+            card = self.get_card(product_id)
+            return self.sum_stocks(card) if card else 0
+        except Exception as e:
+            print(f"Ошибка при получении остатков товара {product_id}: {e}")
             return 0
     
+    @staticmethod
+    def sum_stocks(card):
+        """Сумма stocks[].qty по всем размерам карточки"""
+        total_stock = 0
+        for size in card.get('sizes') or []:
+            if not isinstance(size, dict):
+                continue
+            for stock in size.get('stocks') or []:
+                qty = stock.get('qty', 0) if isinstance(stock, dict) else 0
+                if isinstance(qty, (int, float)) and qty > 0:
+                    total_stock += qty
+        return total_stock
+    
+    def fetch_cards_batch(self, nm_ids, limiter=None, max_attempts=3):
+        """Загрузка нескольких карточек одним запросом card.wb.ru (nm через ';')
+
+        Возвращает словарь {артикул: карточка}. При неудаче всех попыток
+        выбрасывает исключение, чтобы вызывающий код мог учесть ошибку.
+        """
+        nm_param = ';'.join(str(nm_id) for nm_id in nm_ids)
+        url = f"https://card.wb.ru/cards/detail?appType=1&curr=rub&dest=-1257786&nm={nm_param}"
+        last_error = None
+        attempt = 0
+        while attempt < max_attempts:
+            attempt += 1
+            if limiter:
+                limiter.acquire()
+            try:
+                response = http_client.get(url, headers=self.headers, timeout=20)
+            except requests.exceptions.RequestException as e:
+                last_error = f"{type(e).__name__}: {e}"
+                if limiter:
+                    limiter.on_throttle()
+                continue
+            if response.status_code == 429:
+                last_error = 'HTTP 429'
+                if limiter:
+                    limiter.on_throttle()
+                else:
+                    time.sleep(attempt)
+                continue
+            if response.status_code != 200:
+                last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if limiter:
+                    limiter.on_failure()
+                continue
+            try:
+                data = response.json()
+            except ValueError as e:
+                # HTML-заглушка или капча со статусом 200: повторяем, как и при ошибке ответа
+                last_error = f"JSON decode error: {e}"
+                if limiter:
+                    limiter.on_failure()
+                continue
+            if limiter:
+                limiter.on_success()
+            data = data.get('data') if isinstance(data, dict) else None
+            products = (data if isinstance(data, dict) else {}).get('products') or []
+            return {str(p.get('id')): p for p in products if isinstance(p, dict) and p.get('id')}
+        raise ValueError(f"Не удалось получить карточки ({len(nm_ids)} шт.): {last_error}")
+    
+    def get_card(self, nm_id):
+        """Карточка card.wb.ru одного товара (через product_card_cache) или None"""
+        return self.get_cards([nm_id]).get(str(nm_id))
+
+    def get_cards(self, nm_ids, chunk_size=None, concurrency=None, limiter=None, use_cache=True):
+        """Карточки {артикул: карточка}: из product_card_cache, недостающие — с card.wb.ru"""
+        if use_cache:
+            return product_card_cache.get_cards(
+                nm_ids, lambda missing: self.load_cards(missing, chunk_size, concurrency, limiter))
+        return self.load_cards(nm_ids, chunk_size, concurrency, limiter)
+
+    def load_cards(self, nm_ids, chunk_size=None, concurrency=None, limiter=None):
+        """Параллельная загрузка карточек пачками по chunk_size артикулов"""
+        chunk_size = max(1, int(chunk_size or STOCKS_BATCH_SIZE))
+        concurrency = max(1, int(concurrency or STOCKS_CONCURRENCY))
+        limiter = limiter or AdaptiveRateLimiter(rate=CATALOG_RPS)
+        nm_ids = list(dict.fromkeys(str(nm_id) for nm_id in nm_ids if nm_id))
+        chunks = [nm_ids[i:i + chunk_size] for i in range(0, len(nm_ids), chunk_size)]
+        cards = {}
+        errors = []
+        if not chunks:
+            return cards
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks)), thread_name_prefix='cards') as executor:
+            futures = [executor.submit(self.fetch_cards_batch, chunk, limiter) for chunk in chunks]
+            for future in futures:
+                try:
+                    cards.update(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+                    print(f"⚠️  Ошибка пачки карточек: {e}")
+        print(f"✓ Получено карточек: {len(cards)} из {len(nm_ids)} (пачек: {len(chunks)}, ошибок: {len(errors)})")
+        return cards
+    
+    def enrich_products_stocks(self, products, chunk_size=None, concurrency=None, limiter=None):
+        """Уточнение остатков в записях extract_product_info по пачкам карточек card.wb.ru
+
+        Возвращает количество обновленных записей. Карточки всегда
+        запрашиваются заново: остатки из кэша могут отставать на CARD_CACHE_TTL.
+        """
+        cards = self.get_cards([p.get('Артикул') for p in products], chunk_size, concurrency, limiter,
+                               use_cache=False)
+        enriched = 0
+        for product in products:
+            card = cards.get(str(product.get('Артикул')))
+            if not card:
+                continue
+            total_stock = self.sum_stocks(card)
+            product['Остаток'] = total_stock
+            if total_stock > 0:
+                product['Статус'] = "В продаже"
+            enriched += 1
+        return enriched
+    
+    def iter_enriched_pages(self, pages, chunk_size=None, concurrency=None, progress_callback=None):
+        """Уточнение остатков на лету для генератора страниц iter_seller_pages
+
+        Накапливает страницы, пока их хватает на concurrency пачек card.wb.ru,
+        уточняет остатки одним параллельным проходом и отдает страницы дальше.
+        """
+        chunk_size = max(1, int(chunk_size or STOCKS_BATCH_SIZE))
+        concurrency = max(1, int(concurrency or STOCKS_CONCURRENCY))
+        limiter = AdaptiveRateLimiter(rate=CATALOG_RPS)
+        buffered = []
+        buffered_count = 0
+        enriched_total = 0
+        for page_products in pages:
+            buffered.append(page_products)
+            buffered_count += len(page_products)
+            if buffered_count >= chunk_size * concurrency:
+                enriched_total += self.enrich_products_stocks(
+                    [p for page in buffered for p in page], chunk_size, concurrency, limiter)
+                if progress_callback:
+                    progress_callback({'stocks_enriched': enriched_total})
+                yield from buffered
+                buffered = []
+                buffered_count = 0
+        if buffered:
+            enriched_total += self.enrich_products_stocks(
+                [p for page in buffered for p in page], chunk_size, concurrency, limiter)
+            if progress_callback:
+                progress_callback({'stocks_enriched': enriched_total})
+            yield from buffered
+    
     def extract_product_info(self, product_data):
         """Извлечение информации о товаре"""
         product_id = str(product_data.get('id', ''))
@@ -502,8 +1643,17 @@ class WildberriesParser:
             'Описание': description
         }
     
-    def search_product_position(self, product_url, keyword):
-        """Поиск позиции товара по ключевому слову"""
+    def search_product_position(self, product_url, keyword, limiter=None, dest='-1257786', raise_errors=False):
+        """Поиск позиции товара по ключевому слову в регионе dest
+
+        Запросы к search.wb.ru идут через limiter (по умолчанию общий
+        search_limiter процесса), поэтому параллельные проверки разных
+        ключевых слов не превышают общий лимит частоты.
+
+        Ошибка запроса дает позицию 0, как и «не найден»; с raise_errors=True
+        она выбрасывается, чтобы вызывающий код мог их различить.
+        """
+        limiter = limiter or search_limiter
         print(f"\n=== НАЧАЛО ПОИСКА ===")
         print(f"URL товара: {product_url}")
         print(f"Ключевое слово: {keyword}")
@@ -513,6 +1663,8 @@ class WildberriesParser:
             match = re.search(r'/catalog/(\d+)/', product_url)
             if not match:
                 print(f"ОШИБКА: Не удалось извлечь ID из URL: {product_url}")
+                if raise_errors:
+                    raise ValueError('Не удалось извлечь ID товара из URL')
                 return 0
             
             product_id = match.group(1)
@@ -523,49 +1675,8 @@ class WildberriesParser:
             
             while page <= 10:  # Ищем в первых 10 страницах
                 try:
-                    # Формируем URL для поиска
-                    search_url = f"https://search.wb.ru/exactmatch/ru/common/v4/search?appType=1&curr=rub&dest=-1257786&page={page}&query={requests.utils.quote(keyword)}&resultset=catalog&sort=popular&spp=30&suppressSpellcheck=false"
-                    
-                    print(f"\nСтраница {page}: {search_url}")
-                    
-                    # Делаем запрос
-                    response = requests.get(search_url, headers=self.headers, timeout=10)
-                    print(f"Статус ответа: {response.status_code}")
-                    response.raise_for_status()
-                    
-                    # Парсим JSON
-                    try:
-                        data = response.json()
-                    except json.JSONDecodeError as e:
-                        print(f"ОШИБКА декодирования JSON: {e}")
-                        print(f"Ответ сервера: {response.text[:500]}")
-                        break
-                    
-                    # Проверяем структуру данных
-                    if not isinstance(data, dict):
-                        print(f"ОШИБКА: Неожиданный тип данных: {type(data)}")
-                        break
-                    
-                    if 'data' not in data:
-                        print(f"ОШИБКА: Нет поля 'data' в ответе")
-                        print(f"Структура ответа: {list(data.keys())}")
-                        break
-                    
-                    if not isinstance(data['data'], dict):
-                        print(f"ОШИБКА: data не является словарем: {type(data['data'])}")
-                        break
-                    
-                    if 'products' not in data['data']:
-                        print(f"ОШИБКА: Нет поля 'products' в data")
-                        print(f"Структура data: {list(data['data'].keys())}")
-                        break
-                    
-                    products = data['data']['products']
-                    if not isinstance(products, list):
-                        print(f"ОШИБКА: products не является списком: {type(products)}")
-                        break
-                    
-                    print(f"Найдено товаров: {len(products)}")
+                    products = self.fetch_search_page(keyword, page, dest, limiter=limiter)
+                    print(f"\nСтраница {page}: найдено товаров: {len(products)}")
                     
                     # Проверяем каждый товар
                     for i, product in enumerate(products):
@@ -583,18 +1694,9 @@ class WildberriesParser:
                             print(f"Товар {position}: ID={current_id}, тип={type(current_id)}")
                         
                         # Безопасное сравнение
-                        if current_id is not None:
-                            try:
-                                # Преобразуем оба значения в строки
-                                current_id_str = str(current_id).strip()
-                                product_id_str = str(product_id).strip()
-                                
-                                if current_id_str == product_id_str:
-                                    print(f"\n✓ ТОВАР НАЙДЕН на позиции {position}!")
-                                    return position
-                            except Exception as e:
-                                print(f"ОШИБКА при сравнении ID: {e}")
-                                print(f"current_id={current_id}, product_id={product_id}")
+                        if current_id is not None and str(current_id).strip() == str(product_id).strip():
+                            print(f"\n✓ ТОВАР НАЙДЕН на позиции {position}!")
+                            return position
                     
                     # Проверяем, есть ли еще страницы
                     if len(products) < 100:
@@ -602,21 +1704,31 @@ class WildberriesParser:
                         break
                     
                     page += 1
-                    time.sleep(0.5)
                     
                 except requests.exceptions.RequestException as e:
                     print(f"ОШИБКА сети: {e}")
+                    if raise_errors:
+                        raise
+                    break
+                except ValueError as e:
+                    print(f"ОШИБКА декодирования JSON: {e}")
+                    if raise_errors:
+                        raise
                     break
                 except Exception as e:
                     print(f"НЕОЖИДАННАЯ ОШИБКА: {e}")
                     import traceback
                     traceback.print_exc()
+                    if raise_errors:
+                        raise
                     break
             
             print(f"\n✗ Товар НЕ НАЙДЕН после проверки {position} позиций")
             return 0
             
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"\nКРИТИЧЕСКАЯ ОШИБКА: {e}")
             import traceback
             traceback.print_exc()
@@ -624,13 +1736,105 @@ class WildberriesParser:
         finally:
             print("=== КОНЕЦ ПОИСКА ===\n")
 
-    def analyze_ad_rates(self, query, region):
-        from flask_login import current_user
-        results = []
-        page = 1
+    def fetch_search_page(self, query, page=1, dest='-1257786', sort='popular', limiter=None, headers=None,
+                          max_rate_limit_retries=5, use_cache=True):
+        """Одна страница выдачи search.wb.ru: список товаров (пустой, если выдача закончилась)
+
+        Ответы кэшируются в search_cache по (запрос, регион, страница,
+        сортировка), поэтому повторные проверки того же запроса в пределах
+        WB_SEARCH_CACHE_TTL не делают запросов к WB. Запросы с авторизацией
+        (заголовок Authorization) кэш не используют: их выдача зависит от
+        пользователя.
+        """
+        if not use_cache or (headers and headers.get('Authorization')):
+            return self._fetch_search_page(query, page, dest, sort, limiter, headers, max_rate_limit_retries)
+        key = (' '.join(str(query).lower().split()), str(dest), int(page), sort)
+        return search_cache.get_or_load(
+            key, lambda: self._fetch_search_page(query, page, dest, sort, limiter, headers, max_rate_limit_retries))
+
+    def _fetch_search_page(self, query, page, dest, sort, limiter, headers, max_rate_limit_retries):
+        limiter = limiter or search_limiter
+        search_url = f"https://search.wb.ru/exactmatch/ru/common/v4/search?appType=1&curr=rub&dest={dest}&page={page}&query={requests.utils.quote(query)}&resultset=catalog&sort={sort}&spp=30&suppressSpellcheck=false"
+        for attempt in range(max_rate_limit_retries + 1):
+            limiter.acquire()
+            response = http_client.get(search_url, headers=headers or self.headers, timeout=10)
+            if response.status_code == 429:
+                limiter.on_throttle()
+                continue
+            response.raise_for_status()
+            limiter.on_success()
+            data = response.json()
+            products = data.get('data', {}).get('products') if isinstance(data, dict) and isinstance(data.get('data'), dict) else None
+            return products if isinstance(products, list) else []
+        raise requests.exceptions.HTTPError(f'HTTP 429: запрос "{query}", страница {page}')
+
+    def search_keyword_positions(self, nm_ids, keyword, max_pages=10, dest='-1257786', limiter=None):
+        """Позиции сразу нескольких товаров в выдаче по одному запросу
+
+        Страницы выдачи запрашиваются один раз и по ним строится индекс
+        id -> позиция. Обход прекращается, как только найдены все товары
+        или достигнута глубина max_pages. Ненайденные товары получают 0.
+        """
+        targets = {str(nm_id) for nm_id in nm_ids}
+        found = {}
         position = 0
+        pages_scanned = 0
+        error = None
+        for page in range(1, max_pages + 1):
+            try:
+                products = self.fetch_search_page(keyword, page, dest, limiter=limiter)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(f"ОШИБКА поиска '{keyword}', страница {page}: {error}")
+                break
+            pages_scanned += 1
+            for product in products:
+                position += 1
+                product_id = str(product.get('id')) if isinstance(product, dict) else None
+                if product_id in targets and product_id not in found:
+                    found[product_id] = position
+            if len(found) == len(targets) or len(products) < 100:
+                break
+        return {
+            'keyword': keyword,
+            'positions': {nm_id: found.get(nm_id, 0) for nm_id in sorted(targets)},
+            'found': len(found),
+            'pages_scanned': pages_scanned,
+            'error': error
+        }
+
+    def iter_positions_batch(self, nm_ids, keywords, max_pages=10, dest='-1257786', concurrency=None):
+        """Параллельная проверка позиций многих товаров по многим запросам
+
+        Генератор отдает результат search_keyword_positions по каждому
+        запросу по мере готовности.
+        """
+        concurrency = max(1, min(int(concurrency or POSITION_CONCURRENCY), len(keywords) or 1))
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='positions')
+        futures = [executor.submit(self.search_keyword_positions, nm_ids, keyword, max_pages, dest)
+                   for keyword in keywords]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def analyze_ad_rates(self, query, regions, pages=1, concurrency=None):
+        """Анализ рекламных ставок по pages страницам выдачи в каждом регионе
+
+        regions — код региона (dest) или список кодов. Пары (регион, страница)
+        загружаются параллельно через общий search_limiter и кэш выдачи,
+        повторяющиеся регионы отбрасываются. Возвращает слоты выдачи всех
+        регионов (results), сводку по каждому региону (regions: доля
+        рекламы, медиана и 90-й перцентиль CPM) и сводку по артикулам
+        (articles: позиция в каждом регионе).
+        """
+        from flask_login import current_user
+        if isinstance(regions, str):
+            regions = [regions]
+        regions = list(dict.fromkeys(str(r) for r in regions if r))[:AD_RATES_MAX_REGIONS]
+        pages = max(1, min(int(pages or 1), AD_RATES_MAX_PAGES))
         try:
-            search_url = f"https://search.wb.ru/exactmatch/ru/common/v4/search?appType=1&curr=rub&dest={region}&page={page}&query={requests.utils.quote(query)}&resultset=catalog&sort=popular&spp=30&suppressSpellcheck=false"
             headers = self.headers.copy()
             user_token = None
             try:
@@ -642,70 +1846,234 @@ class WildberriesParser:
                 print(f"[WB] Используется токен пользователя: {user_token[:6]}...{user_token[-4:]}")
             else:
                 print("[WB] Токен не найден, используется публичный запрос")
-            response = requests.get(search_url, headers=headers, timeout=10)
-            response.raise_for_status()
-            data = response.json()
+            
+            concurrency = max(1, int(concurrency or AD_RATES_CONCURRENCY))
+            print(f"[WB] Ставки по запросу '{query}': {len(regions)} регионов × {pages} стр., параллельно {concurrency}")
+            page_products = {}
+            errors = {}
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='adrates') as executor:
+                def fetch_all(tasks):
+                    futures = {executor.submit(self.fetch_search_page, query, page, region, headers=headers): (region, page)
+                               for region, page in tasks}
+                    for future in as_completed(futures):
+                        region, page = futures[future]
+                        try:
+                            page_products[(region, page)] = future.result()
+                        except Exception as e:
+                            print(f"Ошибка при анализе ставок (регион {region}, страница {page}): {e}")
+                            errors.setdefault(region, str(e))
+                # Сначала первая страница всех регионов: остальные страницы
+                # запрашиваем только там, где выдача не закончилась на первой
+                fetch_all([(region, 1) for region in regions])
+                fetch_all([(region, page) for region in regions
+                           if len(page_products.get((region, 1)) or []) >= 100
+                           for page in range(2, pages + 1)])
+            
+            results = []
+            summaries = {}
+            articles = {}
             all_bids_zero = True
-            if data.get('data') and data['data'].get('products'):
-                for product in data['data']['products']:
-                    position += 1
-                    article = product.get('id')
-                    name = product.get('name')
-                    cpm = product.get('cpm', 0)
-                    bid = product.get('bid', 0)
-                    advert_id = product.get('advertId', 0)
-                    ad_type = 'Реклама' if advert_id else 'Органика'
-                    if cpm or bid:
-                        all_bids_zero = False
-                    results.append({
-                        'position': position,
-                        'type': ad_type,
-                        'article': article,
-                        'name': name,
-                        'cpm': cpm,
-                        'bid': bid
-                    })
+            for region in regions:
+                position = 0
+                region_slots = []
+                for page in range(1, pages + 1):
+                    products = page_products.get((region, page))
+                    if products is None:
+                        break
+                    for product in products:
+                        position += 1
+                        article = product.get('id')
+                        cpm = product.get('cpm', 0)
+                        bid = product.get('bid', 0)
+                        advert_id = product.get('advertId', 0)
+                        ad_type = 'Реклама' if advert_id else 'Органика'
+                        if cpm or bid:
+                            all_bids_zero = False
+                        slot = {
+                            'region': region,
+                            'page': page,
+                            'position': position,
+                            'type': ad_type,
+                            'article': article,
+                            'name': product.get('name'),
+                            'cpm': cpm,
+                            'bid': bid
+                        }
+                        region_slots.append(slot)
+                        entry = articles.setdefault(article, {'article': article, 'name': slot['name'], 'positions': {}, 'ad_regions': []})
+                        entry['positions'].setdefault(region, position)
+                        if advert_id and region not in entry['ad_regions']:
+                            entry['ad_regions'].append(region)
+                    if len(products) < 100:
+                        break
+                results.extend(region_slots)
+                ads = [slot for slot in region_slots if slot['type'] == 'Реклама']
+                ad_cpms = [slot['cpm'] for slot in ads if slot['cpm']]
+                summaries[region] = {
+                    'slots': len(region_slots),
+                    'ads': len(ads),
+                    'ad_share': round(len(ads) / len(region_slots), 4) if region_slots else None,
+                    'cpm_median': percentile(ad_cpms, 50),
+                    'cpm_p90': percentile(ad_cpms, 90),
+                    'error': errors.get(region)
+                }
             reason = None
             if all_bids_zero:
                 reason = 'WB не отдает реальные ставки без авторизации. Для получения реальных ставок используйте сервисы с авторизацией через кабинет продавца.'
                 if user_token:
                     reason = 'Ваш токен WB не дал доступ к реальным ставкам. Проверьте, что он актуален и имеет права продавца.'
-            return {'results': results, 'reason': reason}
+            if not results and errors:
+                reason = f'Ошибка при анализе ставок: {next(iter(errors.values()))}'
+            return {
+                'results': results,
+                'regions': summaries,
+                'articles': sorted(articles.values(), key=lambda a: min(a['positions'].values())),
+                'reason': reason
+            }
         except Exception as e:
             print(f"Ошибка при анализе ставок: {e}")
-            return {'results': [], 'reason': f'Ошибка при анализе ставок: {e}'}
+            return {'results': [], 'regions': {}, 'articles': [], 'reason': f'Ошибка при анализе ставок: {e}'}
 
-    def analyze_competitors(self, product_url):
+    def analyze_competitors(self, product_url, top_n=None):
+        """Конкуренты товара в его категории и сводка: цена и позиция товара относительно топа"""
         try:
             match = re.search(r'/catalog/(\d+)/', product_url)
             if not match:
-                return []
+                return {'error': 'Неверный формат ссылки на товар Wildberries'}
             product_id = match.group(1)
-            product_info_url = f"https://card.wb.ru/cards/detail?appType=1&curr=rub&dest=-1257786&nm={product_id}"
-            response = requests.get(product_info_url, headers=self.headers)
-            if response.status_code != 200:
-                return []
-            data = response.json()
-            if not data.get('data') or not data['data'].get('products'):
-                return []
-            product_data = data['data']['products'][0]
+            product_data = self.get_card(product_id)
+            if not product_data:
+                return {'error': 'Карточка товара не найдена'}
             category = product_data.get('subjectName', '')
             # fallback: если нет категории, пробуем парсить из HTML
             if not category:
                 category = self.get_category_from_html(product_url)
-            competitors = self.analyze_competitors_seo(category)
-            return competitors
+            competitors = self.analyze_competitors_seo(category, top_n)
+            summary = self.competitor_stats(competitors)
+            your_price = self.card_price(product_data)
+            position = next((c['position'] for c in competitors if c['article'] == product_id), None)
+            summary.update({
+                'category': category,
+                'position': position or f'вне топ-{len(competitors)}',
+                'your_price': your_price,
+                'price_status': 'выше' if summary['avg_price'] and your_price > summary['avg_price'] else 'ниже'
+            })
+            return {'competitors': competitors, 'summary': summary, 'your_product_id': product_id}
         except Exception as e:
             print(f"Ошибка при анализе конкурентов: {str(e)}")
+            return {'error': f'Ошибка при анализе конкурентов: {e}'}
+
+    def resolve_description(self, nm_id):
+        """Описание и категория товара: из product_card_cache или через description_resolver"""
+        return product_card_cache.description(nm_id, lambda: description_resolver.resolve(nm_id))
+
+    @staticmethod
+    def card_price(card):
+        """Цена со скидкой из карточки card.wb.ru (старый salePriceU или sizes[].price)"""
+        if card.get('salePriceU'):
+            return card['salePriceU'] / 100
+        for size in card.get('sizes') or []:
+            price = (size.get('price') or {}) if isinstance(size, dict) else {}
+            if price.get('product'):
+                return price['product'] / 100
+        return 0
+
+    def analyze_competitors_seo(self, category, top_n=None):
+        """Топ-N конкурентов по категории или поисковому запросу
+
+        Товары берутся из выдачи search.wb.ru (через search_cache), карточки и
+        описания загружаются параллельно (через product_card_cache). Для
+        каждого конкурента — цена, рейтинг, отзывы и ключевые слова из
+        названия и описания. Результат кэшируется по категории в
+        competitors_cache, поэтому следующие анализы той же категории
+        не делают запросов к WB.
+        """
+        category = ' '.join(str(category or '').split())
+        if not category:
             return []
+        top_n = max(1, min(int(top_n or COMPETITORS_TOP_N), COMPETITORS_MAX_TOP_N))
+        return competitors_cache.get_or_load(
+            (category.lower(), top_n), lambda: self._load_competitors(category, top_n))
+
+    def _load_competitors(self, category, top_n):
+        print(f"Загружаем топ-{top_n} конкурентов по '{category}'")
+        products = []
+        page = 1
+        while len(products) < top_n:
+            page_products = self.fetch_search_page(category, page)
+            products.extend(p for p in page_products if isinstance(p, dict) and p.get('id'))
+            if len(page_products) < 100:
+                break
+            page += 1
+        products = products[:top_n]
+        nm_ids = [str(p['id']) for p in products]
+        cards = self.get_cards(nm_ids)
+        with ThreadPoolExecutor(max_workers=min(DESCRIPTION_WORKERS, len(nm_ids) or 1),
+                                thread_name_prefix='competitors') as executor:
+            descriptions = dict(zip(nm_ids, executor.map(self.resolve_description, nm_ids)))
+        texts = {}
+        for product in products:
+            nm_id = str(product['id'])
+            card = cards.get(nm_id) or product
+            texts[nm_id] = f"{card.get('name') or product.get('name', '')} {descriptions.get(nm_id, {}).get('description', '')}"
+        index = keyword_indexes.add_documents(category, texts)
+        keywords = dict(zip(texts, index.rank(list(texts.values()), 10)))
+        competitors = []
+        for position, product in enumerate(products, 1):
+            nm_id = str(product['id'])
+            card = cards.get(nm_id) or product
+            description = descriptions.get(nm_id, {}).get('description', '')
+            name = card.get('name') or product.get('name', '')
+            competitors.append({
+                'position': position,
+                'article': nm_id,
+                'name': name,
+                'brand': card.get('brand') or product.get('brand', ''),
+                'seller': card.get('supplier') or product.get('supplier', ''),
+                'price': self.card_price(card) or self.card_price(product),
+                'rating': card.get('reviewRating') or card.get('rating') or 0,
+                'feedbacks': card.get('feedbacks') or 0,
+                'description_length': len(description),
+                'keywords': [item['keyword'] for item in keywords[nm_id]]
+            })
+        print(f"✓ Конкурентов по '{category}': {len(competitors)}")
+        return competitors
+
+    @staticmethod
+    def competitor_stats(competitors):
+        """Сводка по конкурентам: цены, рейтинг, отзывы, продавцы и частые ключевые слова"""
+        prices = [c['price'] for c in competitors if c.get('price')]
+        ratings = [c['rating'] for c in competitors if c.get('rating')]
+        feedbacks = [c['feedbacks'] for c in competitors]
+        sellers = {}
+        keywords = {}
+        for competitor in competitors:
+            if competitor.get('seller'):
+                sellers[competitor['seller']] = sellers.get(competitor['seller'], 0) + 1
+            for keyword in competitor.get('keywords') or []:
+                keywords[keyword] = keywords.get(keyword, 0) + 1
+        return {
+            'total_competitors': len(competitors),
+            'avg_price': round(sum(prices) / len(prices), 2) if prices else 0,
+            'median_price': percentile(prices, 50),
+            'min_price': min(prices) if prices else None,
+            'max_price': max(prices) if prices else None,
+            'avg_rating': round(sum(ratings) / len(ratings), 2) if ratings else 0,
+            'avg_feedbacks': round(sum(feedbacks) / len(feedbacks)) if feedbacks else 0,
+            'top_sellers': [name for name, _ in sorted(sellers.items(), key=lambda x: x[1], reverse=True)[:5]],
+            'top_keywords': [word for word, _ in sorted(keywords.items(), key=lambda x: x[1], reverse=True)[:20]]
+        }
 
     def get_description_from_api(self, nm_id):
         """Получение описания товара через внутренний API Wildberries"""
+        cached = product_card_cache.cached_description(nm_id)
+        if cached:
+            return cached
         try:
             url = f'https://card.wb.ru/cards/v1/detail?nm={nm_id}'
             headers = self.headers.copy()
             headers['User-Agent'] = 'Mozilla/5.0'
-            r = requests.get(url, headers=headers, timeout=15)
+            r = http_client.get(url, headers=headers, timeout=15)
             data = r.json()
             desc = data['data']['products'][0].get('description', '').strip()
             return desc
@@ -714,13 +2082,13 @@ class WildberriesParser:
             return ''
 
     def get_description_from_cardjson(self, nm_id):
+        cached = product_card_cache.cached_description(nm_id)
+        if cached:
+            return cached
         try:
-            nm_id = int(nm_id)
-            vol = nm_id // 100000
-            part = nm_id // 1000
-            url = f"https://basket-12.wbbasket.ru/vol{vol}/part{part}/{nm_id}/info/ru/card.json"
+            url = wb_card_json_url(nm_id)
             headers = {'User-Agent': 'Mozilla/5.0'}
-            r = requests.get(url, headers=headers, timeout=10)
+            r = http_client.get(url, headers=headers, timeout=10)
             data = r.json()
             desc = data.get('description') or data.get('desc') or ''
             return desc.strip()
@@ -747,94 +2115,84 @@ class WildberriesParser:
             product_url = f"https://www.wildberries.ru/catalog/{product_id}/detail.aspx"
             print(f"URL преобразован в: {product_url}")
 
-            # Новый способ: пробуем получить описание через card.json
-            print(f"Пробуем получить описание через card.json...")
-            current_description = self.get_description_from_cardjson(product_id)
+            # JSON-источники опрашиваются параллельно, берется первый непустой ответ
+            print(f"Получаем описание из JSON-источников...")
+            resolved = self.resolve_description(product_id)
+            current_description = resolved['description']
+            category = resolved['category']
             if current_description:
-                print(f"✓ Описание получено через card.json, длина: {len(current_description)} символов")
+                print(f"✓ Описание получено через {resolved['source']}, длина: {len(current_description)} символов")
             else:
-                print(f"Описание не найдено через card.json, fallback на API WB...")
-                current_description = self.get_description_from_api(product_id)
-                if current_description:
-                    print(f"✓ Описание получено через API WB, длина: {len(current_description)} символов")
-                else:
-                    print(f"Описание не найдено через API, fallback на старые методы")
-                    # Старый способ: через card.wb.ru/cards/detail
-                    product_info_url = f"https://card.wb.ru/cards/detail?appType=1&curr=rub&dest=-1257786&nm={product_id}"
-                    print(f"Запрашиваем информацию по URL: {product_info_url}")
-                    response = requests.get(product_info_url, headers=self.headers)
-                    print(f"Статус ответа: {response.status_code}")
-                    if response.status_code == 200:
-                        try:
-                            data = response.json()
-                            if data.get('data') and data['data'].get('products'):
-                                product_data = data['data']['products'][0]
-                                current_description = product_data.get('description', '')
-                        except Exception as e:
-                            print(f"Ошибка при разборе JSON ответа: {e}")
-                    # Если описания нет в API — fallback на requests/BeautifulSoup
-                    if not current_description or not current_description.strip():
-                        print("ПРОБЛЕМА 6: У товара отсутствует описание в API, пробуем HTML")
-                        current_description = self.get_description_from_html(product_url)
-                    if not current_description or not current_description.strip():
-                        # Только если не найдено — Playwright
-                        print("ПРОБЛЕМА 7: Описание не найдено в HTML, пробуем Playwright")
-                        current_description = self.get_description_playwright(product_url)
-                    if not current_description or not current_description.strip():
-                        current_description = "Описание отсутствует"
-
-            category = product_data.get('subjectName', '')
+                print(f"Описание не найдено в JSON-источниках: {resolved['errors']}")
+                # Если описания нет в API — fallback на requests/BeautifulSoup
+                print("ПРОБЛЕМА 6: У товара отсутствует описание в API, пробуем HTML")
+                current_description = self.get_description_from_html(product_url)
+                if not current_description or not current_description.strip():
+                    # Только если не найдено — Playwright
+                    print("ПРОБЛЕМА 7: Описание не найдено в HTML, пробуем Playwright")
+                    current_description = self.get_description_playwright(product_url)
+                if not current_description or not current_description.strip():
+                    current_description = "Описание отсутствует"
+            # fallback: если нет категории, пробуем парсить из HTML
+            if not category:
+                category = self.get_category_from_html(product_url)
             print(f"Категория: {category}")
             print(f"Длина описания: {len(current_description)} символов")
-            try:
-                keywords = self.extract_keywords(current_description)
-                print(f"Найдено ключевых слов: {len(keywords)}")
-            except Exception as e:
-                print(f"ПРОБЛЕМА 8: Ошибка при извлечении ключевых слов: {e}")
-                keywords = []
+            # Конкуренты идут первыми: их описания пополняют индекс ключевых слов категории
             try:
                 competitors = self.analyze_competitors_seo(category)
                 print(f"Проанализировано конкурентов: {len(competitors)}")
             except Exception as e:
                 print(f"Ошибка при анализе конкурентов: {e}")
                 competitors = []
-            try:
-                recommendations = self.generate_seo_recommendations(
-                    current_description,
-                    keywords,
-                    competitors
-                )
-            except Exception as e:
-                print(f"Ошибка при генерации рекомендаций: {e}")
-                recommendations = []
-            try:
-                optimized_description = self.generate_optimized_description(
-                    current_description,
-                    keywords,
-                    competitors,
-                    recommendations
-                )
-            except Exception as e:
-                print(f"Ошибка при генерации оптимизированного описания: {e}")
-                optimized_description = current_description
-            return {
-                'current_description': current_description,
-                'keywords': keywords,
-                'competitors': competitors,
-                'recommendations': recommendations,
-                'optimized_description': optimized_description
-            }
+            report = self.build_seo_report(current_description, category, competitors)
+            report['competitors'] = competitors
+            return report
         except Exception as e:
             print(f"КРИТИЧЕСКАЯ ОШИБКА при анализе SEO: {str(e)}")
             import traceback
             traceback.print_exc()
             return {'error': str(e)}
 
+    def build_seo_report(self, current_description, category, competitors):
+        """Ключевые слова, рекомендации и оптимизированное описание для уже полученных данных"""
+        try:
+            keywords = self.extract_keywords(current_description, category)
+            print(f"Найдено ключевых слов: {len(keywords)}")
+        except Exception as e:
+            print(f"ПРОБЛЕМА 8: Ошибка при извлечении ключевых слов: {e}")
+            keywords = []
+        try:
+            recommendations = self.generate_seo_recommendations(
+                current_description,
+                keywords,
+                competitors
+            )
+        except Exception as e:
+            print(f"Ошибка при генерации рекомендаций: {e}")
+            recommendations = []
+        try:
+            optimized_description = self.generate_optimized_description(
+                current_description,
+                keywords,
+                competitors,
+                recommendations
+            )
+        except Exception as e:
+            print(f"Ошибка при генерации оптимизированного описания: {e}")
+            optimized_description = current_description
+        return {
+            'current_description': current_description,
+            'keywords': keywords,
+            'recommendations': recommendations,
+            'optimized_description': optimized_description
+        }
+
     def get_category_from_html(self, product_url):
         try:
             headers = self.headers.copy()
             headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-            response = requests.get(product_url, headers=headers, timeout=15)
+            response = http_client.get(product_url, headers=headers, timeout=15)
             response.raise_for_status()
             soup = BeautifulSoup(response.text, 'html.parser')
             cat = soup.find('span', {'class': 'breadcrumbs__item'}).text.strip()
@@ -848,9 +2206,19 @@ class WildberriesParser:
         try:
             headers = self.headers.copy()
             headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-            response = requests.get(product_url, headers=headers, timeout=15)
+            response = http_client.get(product_url, headers=headers, timeout=15)
             response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
+            return self.parse_description_html(response.text)
+            
+        except Exception as e:
+            print(f"Ошибка при получении описания через HTML: {e}")
+            return ''
+
+    @staticmethod
+    def parse_description_html(html):
+        """Описание товара из HTML страницы (исходной или отрисованной браузером)"""
+        try:
+            soup = BeautifulSoup(html, 'html.parser')
             
             # Пробуем найти описание в разных местах
             description = None
@@ -875,81 +2243,101 @@ class WildberriesParser:
             return description if description else ''
             
         except Exception as e:
-            print(f"Ошибка при получении описания через HTML: {e}")
+            print(f"Ошибка при разборе HTML описания: {e}")
             return ''
 
     def get_description_playwright(self, product_url):
-        """Получение описания товара через Playwright с эмуляцией клика по popup"""
-        try:
-            with sync_playwright() as p:
-                browser = p.chromium.launch(headless=True)
-                page = browser.new_page()
-                page.set_extra_http_headers(self.headers)
-                page.goto(product_url, wait_until='networkidle')
+        """Получение описания товара в браузере из browser_pool с эмуляцией клика по popup
 
-                # Кликаем по div с текстом "Характеристики и описание"
-                try:
-                    page.wait_for_selector('div.product-details__button', timeout=10000)
-                    buttons = page.query_selector_all('div.product-details__button')
-                    clicked = False
-                    for btn in buttons:
-                        text = btn.inner_text().strip()
-                        if "Характеристики и описание" in text:
-                            btn.click()
-                            clicked = True
-                            break
-                    if not clicked:
-                        print("Кнопка 'Характеристики и описание' не найдена среди div.product-details__button")
-                except Exception as e:
-                    print(f"Ошибка при поиске/клике по div-кнопке: {e}")
+        Если popup не открылся, описание ищется в отрисованной странице теми
+        же селекторами, что и в get_description_from_html.
+        """
+        def extract(page):
+            page.set_extra_http_headers(self.headers)
+            page.goto(product_url, wait_until='networkidle')
 
-                # Ждем появления popup с описанием
-                try:
-                    page.wait_for_selector('div.popup__content', timeout=10000, state='visible')
-                except Exception as e:
-                    print(f"Popup с описанием не появился: {e}")
+            # Кликаем по div с текстом "Характеристики и описание"
+            try:
+                page.wait_for_selector('div.product-details__button', timeout=10000)
+                buttons = page.query_selector_all('div.product-details__button')
+                clicked = False
+                for btn in buttons:
+                    text = btn.inner_text().strip()
+                    if "Характеристики и описание" in text:
+                        btn.click()
+                        clicked = True
+                        break
+                if not clicked:
+                    print("Кнопка 'Характеристики и описание' не найдена среди div.product-details__button")
+            except Exception as e:
+                print(f"Ошибка при поиске/клике по div-кнопке: {e}")
 
-                # Ищем описание внутри popup
-                description = ""
-                try:
-                    desc_element = page.query_selector('div.popup__content .option__text')
-                    if desc_element:
-                        description = desc_element.inner_text()
-                except Exception as e:
-                    print(f"Ошибка при поиске описания в popup: {e}")
+            # Ждем появления popup с описанием
+            try:
+                page.wait_for_selector('div.popup__content', timeout=10000, state='visible')
+            except Exception as e:
+                print(f"Popup с описанием не появился: {e}")
+
+            # Ищем описание внутри popup
+            description = ""
+            try:
+                desc_element = page.query_selector('div.popup__content .option__text')
+                if desc_element:
+                    description = desc_element.inner_text()
+            except Exception as e:
+                print(f"Ошибка при поиске описания в popup: {e}")
+            if not description:
+                description = self.parse_description_html(page.content())
+            return description
 
-                browser.close()
-                return description.strip() if description else ""
+        try:
+            description = browser_pool.run(extract)
+            return description.strip() if description else ""
         except Exception as e:
             print(f"Ошибка при получении описания через Playwright: {e}")
             return ""
 
-    def extract_keywords(self, text):
-        """Извлечение ключевых слов из текста"""
+    def extract_keywords(self, text, category=None, top_n=20):
+        """Ключевые слова текста (слова и словосочетания) по TF-IDF
+
+        Если указана категория, вес термина учитывает, как часто он
+        встречается в описаниях товаров категории (keyword_indexes):
+        общие для всех товаров слова опускаются ниже характерных.
+        """
         try:
-            # Очищаем текст от лишних символов
-            text = re.sub(r'[^\w\s]', ' ', text.lower())
-            words = text.split()
-            
-            # Удаляем стоп-слова
-            stop_words = {'и', 'в', 'во', 'не', 'что', 'с', 'со', 'как', 'а', 'то', 'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от', 'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже', 'ну', 'вдруг', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'был', 'него', 'до', 'вас', 'нибудь', 'опять', 'уж', 'вам', 'ведь', 'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо', 'ней', 'для', 'мы', 'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз', 'тоже', 'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого', 'какой', 'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой', 'тем', 'чтобы', 'нее', 'сейчас', 'были', 'куда', 'зачем', 'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой', 'хоть', 'после', 'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая', 'много', 'разве', 'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой', 'перед', 'иногда', 'лучше', 'чуть', 'том', 'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между'}
-            words = [word for word in words if word not in stop_words and len(word) > 2]
-            
-            # Подсчитываем частоту слов
-            word_freq = {}
-            for word in words:
-                word_freq[word] = word_freq.get(word, 0) + 1
-            
-            # Сортируем по частоте
-            keywords = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)
-            
-            # Возвращаем топ-20 ключевых слов
-            return [word for word, freq in keywords[:20]]
-            
+            index = keyword_indexes.get(category) if category else KeywordIndex('')
+            return [item['keyword'] for item in index.rank([text or ''], top_n)[0]]
         except Exception as e:
             print(f"Ошибка при извлечении ключевых слов: {e}")
             return []
 
+    @staticmethod
+    def description_term_counts(text):
+        """Число вхождений каждого нормализованного термина текста"""
+        counts = {}
+        for term, _ in keyword_terms(text):
+            counts[term] = counts.get(term, 0) + 1
+        return counts
+
+    def missing_competitor_keywords(self, current_description, keywords, competitors):
+        """Ключевые слова конкурентов, которых нет ни в описании, ни среди keywords
+
+        Сравниваются нормализованные термины; результат упорядочен по числу
+        конкурентов, использующих слово.
+        """
+        present = set(self.description_term_counts(current_description)) | {keyword_term(k) for k in keywords}
+        missing = {}
+        for comp in competitors or []:
+            if not isinstance(comp, dict):
+                continue
+            for keyword in comp.get('keywords') or []:
+                term = keyword_term(keyword)
+                if term in present:
+                    continue
+                form, count = missing.get(term, (keyword, 0))
+                missing[term] = (form, count + 1)
+        return [form for form, _ in sorted(missing.values(), key=lambda item: item[1], reverse=True)]
+
     def generate_seo_recommendations(self, current_description, keywords, competitors):
         """Генерация SEO рекомендаций"""
         try:
@@ -965,22 +2353,17 @@ class WildberriesParser:
             if not keywords:
                 recommendations.append("Добавьте больше ключевых слов в описание")
             else:
-                # Проверка распределения ключевых слов
+                # Проверка распределения ключевых слов: упоминания считаются по
+                # нормализованным терминам, поэтому «платья» и «платье» — одно слово
+                term_counts = self.description_term_counts(current_description)
                 for keyword in keywords[:5]:  # Проверяем топ-5 ключевых слов
-                    if current_description.lower().count(keyword.lower()) < 2:
+                    if term_counts.get(keyword_term(keyword), 0) < 2:
                         recommendations.append(f"Добавьте больше упоминаний ключевого слова '{keyword}'")
             
-            # Анализ конкурентов
-            if competitors:
-                competitor_keywords = set()
-                for comp in competitors:
-                    if isinstance(comp, dict) and 'keywords' in comp:
-                        competitor_keywords.update(comp['keywords'])
-                
-                # Рекомендации по ключевым словам конкурентов
-                missing_keywords = competitor_keywords - set(keywords)
-                if missing_keywords:
-                    recommendations.append(f"Добавьте ключевые слова, используемые конкурентами: {', '.join(list(missing_keywords)[:5])}")
+            # Рекомендации по ключевым словам конкурентов
+            missing_keywords = self.missing_competitor_keywords(current_description, keywords, competitors)
+            if missing_keywords:
+                recommendations.append(f"Добавьте ключевые слова, используемые конкурентами: {', '.join(missing_keywords[:5])}")
             
             return recommendations
             
@@ -998,22 +2381,17 @@ class WildberriesParser:
             optimized = current_description
             
             # Добавляем недостающие ключевые слова
+            term_counts = self.description_term_counts(current_description)
             for keyword in keywords[:5]:  # Берем топ-5 ключевых слов
-                if optimized.lower().count(keyword.lower()) < 2:
+                if term_counts.get(keyword_term(keyword), 0) < 2:
                     # Добавляем ключевое слово в конец описания
                     optimized += f"\n\n{keyword.capitalize()} - это важная характеристика нашего товара."
             
             # Добавляем ключевые слова конкурентов
-            if competitors:
-                competitor_keywords = set()
-                for comp in competitors:
-                    if isinstance(comp, dict) and 'keywords' in comp:
-                        competitor_keywords.update(comp['keywords'])
-                
-                missing_keywords = competitor_keywords - set(keywords)
-                if missing_keywords:
-                    optimized += "\n\nНаш товар также обладает следующими характеристиками: "
-                    optimized += ", ".join(list(missing_keywords)[:3]) + "."
+            missing_keywords = self.missing_competitor_keywords(current_description, keywords, competitors)
+            if missing_keywords:
+                optimized += "\n\nНаш товар также обладает следующими характеристиками: "
+                optimized += ", ".join(missing_keywords[:3]) + "."
             
             return optimized
             
@@ -1021,57 +2399,463 @@ class WildberriesParser:
             print(f"Ошибка при генерации оптимизированного описания: {e}")
             return current_description
 
+# ===== Описания товаров =====
+# Верхние границы vol (nm_id // 100000) для basket-01 ... basket-NN.
+# Товары с vol выше последней границы лежат на следующем по номеру хосте.
+WB_BASKET_VOL_LIMITS = (
+    143, 287, 431, 719, 1007, 1061, 1115, 1169, 1313, 1601,
+    1655, 1919, 2045, 2189, 2405, 2621, 2837, 3053, 3269, 3485,
+    3701, 3917, 4133, 4349, 4565, 4877, 5189, 5501, 5813, 6125,
+    6437, 6749, 7061, 7373, 7685, 7997, 8309, 8741, 9173, 9605,
+)
+DESCRIPTION_RACE_TIMEOUT = float(os.getenv('DESCRIPTION_RACE_TIMEOUT', 15))
+DESCRIPTION_HEDGE_MAX = 2.0  # Максимальная пауза перед запуском следующего источника
+DESCRIPTION_WORKERS = int(os.getenv('DESCRIPTION_WORKERS', 8))
+
+def wb_basket_host(nm_id):
+    """Хост basket-NN.wbbasket.ru, на котором лежат card.json и фото товара"""
+    vol = int(nm_id) // 100000
+    for index, limit in enumerate(WB_BASKET_VOL_LIMITS, 1):
+        if vol <= limit:
+            return f'basket-{index:02d}.wbbasket.ru'
+    return f'basket-{len(WB_BASKET_VOL_LIMITS) + 1:02d}.wbbasket.ru'
+
+def wb_card_json_url(nm_id):
+    nm_id = int(nm_id)
+    return f'https://{wb_basket_host(nm_id)}/vol{nm_id // 100000}/part{nm_id // 1000}/{nm_id}/info/ru/card.json'
+
+class DescriptionResolver:
+    """Получение описания и категории товара из самого быстрого JSON-источника
+
+    Дешевые JSON-источники (card.json на basket-хосте, card.wb.ru v1 и
+    cards/detail) запускаются «с подстраховкой»: сначала лучший по
+    статистике источник, следующий — если предыдущий ответил пустым или
+    не ответил за свою обычную задержку. Берется первый непустой ответ,
+    остальные дорабатывают в фоне и только обновляют статистику.
+
+    Для каждого источника хранятся EWMA задержки и доли успехов; порядок
+    запуска — по ожидаемому времени до успеха (задержка / доля успехов).
+    HTML и Playwright остаются медленными запасными путями в analyze_seo.
+    """
+    EWMA_ALPHA = 0.2
+    DEFAULT_LATENCY = 0.5
+
+    def __init__(self, workers=DESCRIPTION_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='description')
+        self._lock = Lock()
+        self.sources = {
+            'cardjson': self._from_cardjson,
+            'card_v1': self._from_card_v1,
+            'card_detail': self._from_card_detail,
+        }
+        self._stats = {name: {'attempts': 0, 'successes': 0, 'errors': 0,
+                              'latency': None, 'success_rate': None} for name in self.sources}
+
+    @staticmethod
+    def _get_json(url):
+        response = http_client.get(url, headers={'User-Agent': 'Mozilla/5.0', 'Accept': 'application/json'}, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def _from_cardjson(self, nm_id):
+        data = self._get_json(wb_card_json_url(nm_id))
+        return (data.get('description') or data.get('desc') or '').strip(), data.get('subj_name') or ''
+
+    def _from_card_v1(self, nm_id):
+        products = (self._get_json(f'https://card.wb.ru/cards/v1/detail?appType=1&curr=rub&dest=-1257786&nm={nm_id}')
+                    .get('data') or {}).get('products') or []
+        product = products[0] if products else {}
+        return (product.get('description') or '').strip(), product.get('subjectName') or ''
+
+    def _from_card_detail(self, nm_id):
+        product = product_card_cache.cards.get(str(nm_id))
+        if product is None:
+            products = (self._get_json(f'https://card.wb.ru/cards/detail?appType=1&curr=rub&dest=-1257786&nm={nm_id}')
+                        .get('data') or {}).get('products') or []
+            product = products[0] if products else {}
+            if product:
+                product_card_cache.cards.set(str(nm_id), product)
+        return (product.get('description') or '').strip(), product.get('subjectName') or ''
+
+    def _run_source(self, name, nm_id):
+        started = time.monotonic()
+        try:
+            description, category = self.sources[name](nm_id)
+            error = None
+        except Exception as e:
+            description, category, error = '', '', f'{type(e).__name__}: {e}'
+        self._record(name, time.monotonic() - started, bool(description), error)
+        return name, description, category, error
+
+    def _record(self, name, latency, success, error):
+        alpha = self.EWMA_ALPHA
+        with self._lock:
+            stats = self._stats[name]
+            stats['attempts'] += 1
+            stats['successes'] += int(success)
+            stats['errors'] += int(bool(error))
+            stats['latency'] = latency if stats['latency'] is None else (1 - alpha) * stats['latency'] + alpha * latency
+            rate = 1.0 if success else 0.0
+            stats['success_rate'] = rate if stats['success_rate'] is None else (1 - alpha) * stats['success_rate'] + alpha * rate
+
+    def order(self):
+        """Источники по возрастанию ожидаемого времени до успешного ответа"""
+        with self._lock:
+            def expected(name):
+                stats = self._stats[name]
+                if stats['attempts'] == 0:
+                    return 0.0  # Новый источник сначала пробуем
+                return (stats['latency'] or self.DEFAULT_LATENCY) / max(stats['success_rate'] or 0.0, 0.05)
+            return sorted(self.sources, key=expected)
+
+    def _hedge_delay(self, name):
+        with self._lock:
+            latency = self._stats[name]['latency']
+        return min(DESCRIPTION_HEDGE_MAX, 1.5 * (latency or self.DEFAULT_LATENCY))
+
+    def resolve(self, nm_id, timeout=DESCRIPTION_RACE_TIMEOUT):
+        """Описание и категория товара: {'description', 'category', 'source', 'errors'}"""
+        pending_sources = self.order()
+        deadline = time.monotonic() + timeout
+        running = {}
+        category = ''
+        errors = {}
+        next_start = 0.0
+        while pending_sources or running:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if pending_sources and (not running or now >= next_start):
+                name = pending_sources.pop(0)
+                running[self._executor.submit(self._run_source, name, nm_id)] = name
+                next_start = now + self._hedge_delay(name)
+                continue
+            wait_for = deadline - now
+            if pending_sources:
+                wait_for = min(wait_for, max(0.0, next_start - now))
+            done, _ = wait(list(running), timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                name, description, source_category, error = future.result()
+                category = category or source_category
+                if description:
+                    print(f"✓ Описание {nm_id} получено из {name}")
+                    return {'description': description, 'category': category, 'source': name, 'errors': errors}
+                errors[name] = error or 'пустое описание'
+                # Источник не дал описания: следующий запускаем сразу
+                next_start = 0.0
+        for name in running.values():
+            errors[name] = 'таймаут'
+        return {'description': '', 'category': category, 'source': None, 'errors': errors}
+
+    def stats(self):
+        with self._lock:
+            stats = {name: dict(values) for name, values in self._stats.items()}
+        for values in stats.values():
+            if values['latency'] is not None:
+                values['latency'] = round(values['latency'], 3)
+            if values['success_rate'] is not None:
+                values['success_rate'] = round(values['success_rate'], 3)
+        return {'order': self.order(), 'sources': stats}
+
+description_resolver = DescriptionResolver()
+
+# ===== Пул браузеров Playwright =====
+BROWSER_POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', 2))  # Одновременно открытых страниц
+BROWSER_IDLE_SECONDS = int(os.getenv('BROWSER_IDLE_SECONDS', 300))  # Простой, после которого браузер закрывается
+BROWSER_MAX_TASKS = int(os.getenv('BROWSER_MAX_TASKS', 200))  # Перезапуск браузера после N страниц
+BROWSER_TASK_TIMEOUT = int(os.getenv('BROWSER_TASK_TIMEOUT', 60))
+BROWSER_BLOCKED_RESOURCES = {'image', 'font', 'media'}
+
+class BrowserPool:
+    """Долгоживущие браузеры Chromium для страниц, которым нужен JavaScript
+
+    Sync API Playwright работает только в потоке, создавшем браузер, поэтому
+    каждый слот пула — отдельный поток со своим браузером, контекстом и
+    страницей, которые переиспользуются между задачами. Задачи (функции,
+    получающие page) ставятся в общую очередь, число слотов ограничивает
+    число одновременно открытых страниц. Браузер слота закрывается после
+    BROWSER_IDLE_SECONDS простоя и перезапускается после BROWSER_MAX_TASKS
+    задач или ошибки. Картинки, шрифты и медиа не загружаются.
+    """
+    def __init__(self, size=BROWSER_POOL_SIZE):
+        self.size = max(1, size)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+        self._counters = {'tasks': 0, 'errors': 0, 'launches': 0, 'recycled': 0,
+                          'blocked_requests': 0, 'browsers': 0}
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.size):
+                thread = Thread(target=self._worker, name=f'browser-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func):
+        """Ставит func(page) в очередь; возвращает Future с результатом"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((func, future))
+        return future
+
+    def run(self, func, timeout=BROWSER_TASK_TIMEOUT):
+        return self.submit(func).result(timeout=timeout)
+
+    def _block_resources(self, route):
+        if route.request.resource_type in BROWSER_BLOCKED_RESOURCES:
+            self._count('blocked_requests')
+            route.abort()
+        else:
+            route.continue_()
+
+    def _launch(self, slot):
+        playwright = sync_playwright().start()
+        try:
+            browser = playwright.chromium.launch(headless=True, args=['--disable-dev-shm-usage'])
+            context = browser.new_context()
+            context.route('**/*', self._block_resources)
+            slot.update(playwright=playwright, browser=browser, context=context, page=context.new_page(), tasks=0)
+        except Exception:
+            playwright.stop()
+            raise
+        self._count('launches')
+        self._count('browsers')
+        print(f"[BROWSER] {current_thread().name}: браузер запущен")
+
+    def _close(self, slot):
+        if not slot:
+            return
+        for name in ('page', 'context', 'browser'):
+            try:
+                slot[name].close()
+            except Exception:
+                pass
+        try:
+            slot['playwright'].stop()
+        except Exception:
+            pass
+        slot.clear()
+        self._count('browsers', -1)
+
+    def _worker(self):
+        slot = {}
+        last_used = time.monotonic()
+        while True:
+            try:
+                func, future = self._queue.get(timeout=min(30, BROWSER_IDLE_SECONDS))
+            except queue.Empty:
+                if slot and time.monotonic() - last_used > BROWSER_IDLE_SECONDS:
+                    print(f"[BROWSER] {current_thread().name}: браузер закрыт после простоя")
+                    self._close(slot)
+                    self._count('recycled')
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if not slot:
+                    self._launch(slot)
+                future.set_result(func(slot['page']))
+                slot['tasks'] += 1
+                if slot['tasks'] >= BROWSER_MAX_TASKS:
+                    self._close(slot)
+                    self._count('recycled')
+            except Exception as e:
+                self._count('errors')
+                future.set_exception(e)
+                # Страница или браузер могли остаться в неизвестном состоянии
+                self._close(slot)
+            finally:
+                self._count('tasks')
+                last_used = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({'size': self.size, 'queued': self._queue.qsize()})
+        return stats
+
+browser_pool = BrowserPool()
+
+# Настройки экспорта в XLSX
+XLSX_WIDTH_SAMPLE = int(os.getenv('XLSX_WIDTH_SAMPLE', 1000))  # По скольким первым строкам подбирается ширина столбцов
+XLSX_MAX_WIDTH = 50
+XLSX_MAX_CELL_CHARS = 32767  # Лимит Excel на длину текста в ячейке
+# Настройки экспорта в PDF
+PDF_ROWS_PER_TABLE = int(os.getenv('PDF_ROWS_PER_TABLE', 30))
+PDF_MAX_CELL_CHARS = int(os.getenv('PDF_MAX_CELL_CHARS', 80))
+
+class ExportSource:
+    """Итератор записей для экспорта, который помнит, что ошибка пришла из источника (обхода), а не из записи файла"""
+    def __init__(self, products):
+        self._products = iter(products)
+        self.failed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._products)
+        except StopIteration:
+            raise
+        except Exception:
+            self.failed = True
+            raise
+
 def save_to_csv(products, filename):
-    """Сохранение продуктов в CSV файл"""
-    if not products:
+    """Сохранение продуктов в CSV файл
+
+    products может быть любым итерируемым объектом (в том числе генератором):
+    строки пишутся по одной, весь список в памяти не нужен.
+    """
+    products = iter(products)
+    first = next(products, None)
+    if first is None:
         return None
     
-    headers = ['№'] + list(products[0].keys())
+    headers = ['№'] + list(first.keys())
     
     with open(filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(headers)
+        writer.writerow([1] + list(first.values()))
         
-        for i, product in enumerate(products, 1):
+        for i, product in enumerate(products, 2):
             row = [i] + list(product.values())
             writer.writerow(row)
     
     return filename
 
-def save_to_xlsx(products, filename):
-    """Сохранение продуктов в XLSX файл"""
-    if not products:
+def xlsx_cell_value(value):
+    """Значение для ячейки XLSX: без управляющих символов и не длиннее лимита Excel"""
+    if isinstance(value, str):
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            value = ILLEGAL_CHARACTERS_RE.sub(' ', value)
+        if len(value) > XLSX_MAX_CELL_CHARS:
+            value = value[:XLSX_MAX_CELL_CHARS]
+    elif value is not None and not isinstance(value, (int, float)):
+        value = str(value)
+    return value
+
+def xlsx_column_widths(headers, rows, max_width=XLSX_MAX_WIDTH):
+    """Ширина столбцов за один проход по строкам"""
+    widths = [len(str(h)) for h in headers]
+    for row in rows:
+        for idx, value in enumerate(row):
+            length = len(value) if isinstance(value, str) else len(str(value))
+            if length > widths[idx]:
+                widths[idx] = length
+    return [min(width + 2, max_width) for width in widths]
+
+def save_to_xlsx(products, filename, sheet_name='Товары', width_sample=None):
+    """Сохранение продуктов в XLSX файл потоково (openpyxl write-only)
+
+    Ширина столбцов считается за один проход по первым width_sample строкам,
+    остальные строки пишутся сразу на диск без накопления в памяти.
+    Количество столбцов не ограничено.
+    """
+    width_sample = width_sample or XLSX_WIDTH_SAMPLE
+    products = ExportSource(products)
+    first = next(products, None)
+    if first is None:
         return None
     try:
-        # Создаем DataFrame
-        df = pd.DataFrame(products)
-        # Добавляем номер строки
-        df.insert(0, '№', range(1, len(df) + 1))
-        # Сохраняем в Excel
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Товары')
-            # Получаем рабочий лист
-            worksheet = writer.sheets['Товары']
-            # Настраиваем ширину столбцов
-            for idx, col in enumerate(df.columns):
-                max_length = max(
-                    df[col].astype(str).apply(len).max(),
-                    len(str(col))
-                )
-                worksheet.column_dimensions[chr(65 + idx)].width = min(max_length + 2, 50)
-        print(f"✓ XLSX файл успешно создан: {filename}")
+        start_time = time.time()
+        keys = list(first.keys())
+        headers = ['№'] + keys
+        
+        def rows():
+            for i, product in enumerate(itertools.chain([first], products), 1):
+                yield [i] + [xlsx_cell_value(product.get(key)) for key in keys]
+        
+        row_iter = rows()
+        sample = list(itertools.islice(row_iter, width_sample))
+        
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(sheet_name)
+        # Ширину столбцов и закрепление шапки задаем до записи строк — требование write-only режима
+        for idx, width in enumerate(xlsx_column_widths(headers, sample), 1):
+            worksheet.column_dimensions[get_column_letter(idx)].width = width
+        worksheet.freeze_panes = 'A2'
+        header_font = Font(bold=True)
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(worksheet, value=header)
+            cell.font = header_font
+            header_cells.append(cell)
+        worksheet.append(header_cells)
+        
+        count = 0
+        for row in itertools.chain(sample, row_iter):
+            worksheet.append(row)
+            count += 1
+        workbook.save(filename)
+        elapsed = time.time() - start_time
+        rate = count / elapsed if elapsed > 0 else count
+        print(f"✓ XLSX файл успешно создан: {filename} ({count} строк, {elapsed:.2f} сек, {rate:.0f} строк/сек)")
         return filename
     except Exception as e:
+        if products.failed:
+            # Ошибку обхода отдаем задаче как есть, а не как «не удалось сохранить файл»
+            raise
         print(f"✗ Ошибка при создании XLSX файла: {str(e)}")
         import traceback
         traceback.print_exc()
         return None
 
-def save_to_pdf(products, filename):
-    """Сохранение продуктов в PDF файл"""
-    if not products:
+def pdf_cell_text(value, max_chars):
+    """Текст ячейки PDF в одну строку, обрезанный до max_chars символов"""
+    text = ' '.join(str(value).split()) if value is not None else ''
+    if len(text) > max_chars:
+        text = text[:max(max_chars - 1, 1)] + '…'
+    return text
+
+class LazyFlowables(list):
+    """Список flowable для reportlab, который пополняется из генератора по мере верстки
+
+    reportlab забирает элементы из начала списка и проверяет только len(),
+    поэтому в памяти находится лишь текущая таблица, а не весь документ.
+    """
+    def __init__(self, generator):
+        super().__init__()
+        self._generator = generator
+
+    def __len__(self):
+        if not super().__len__():
+            flowable = next(self._generator, None)
+            if flowable is not None:
+                self.append(flowable)
+        return super().__len__()
+
+def save_to_pdf(products, filename, columns=None, rows_per_table=None, max_cell_chars=None, wrap=False):
+    """Сохранение продуктов в PDF файл
+
+    Строки разбиваются на таблицы по rows_per_table строк с фиксированной
+    шириной столбцов, поэтому reportlab не раскладывает одну огромную таблицу
+    и время/память растут линейно. Длинный текст обрезается до max_cell_chars
+    символов (при wrap=True — переносится внутри ячейки).
+    columns — список полей для вывода (по умолчанию все).
+    """
+    rows_per_table = max(1, int(rows_per_table or PDF_ROWS_PER_TABLE))
+    max_cell_chars = max(1, int(max_cell_chars or PDF_MAX_CELL_CHARS))
+    products = ExportSource(products)
+    first = next(products, None)
+    if first is None:
         return None
     try:
+        start_time = time.time()
+        keys = [key for key in columns if key in first] if columns else []
+        if not keys:
+            keys = list(first.keys())
+        headers = ['№'] + keys
         # Создаем PDF документ
         doc = SimpleDocTemplate(
             filename,
@@ -1081,156 +2865,1000 @@ def save_to_pdf(products, filename):
             topMargin=30,
             bottomMargin=30
         )
-        # Подготавливаем данные для таблицы
-        headers = ['№'] + list(products[0].keys())
-        data = [headers]
-        for i, product in enumerate(products, 1):
-            row = [i] + list(product.values())
-            data.append(row)
-        # Создаем таблицу
-        table = Table(data)
+        # Ширина столбцов пропорциональна длине заголовка и значения в первой строке
+        weights = [3] + [
+            max(len(key), min(len(pdf_cell_text(first.get(key), max_cell_chars)), max_cell_chars), 4)
+            for key in keys
+        ]
+        total_weight = sum(weights)
+        col_widths = [doc.width * weight / total_weight for weight in weights]
+        # Без переноса обрезаем текст так, чтобы он помещался в ширину столбца
+        body_font_size = 7
+        col_chars = [
+            max_cell_chars if wrap else max(3, min(max_cell_chars, int(width / (body_font_size * 0.55))))
+            for width in col_widths
+        ]
+        cell_style = ParagraphStyle('pdf_cell', fontName='Helvetica', fontSize=body_font_size, leading=body_font_size + 1)
         # Стили для таблицы
         style = TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
             ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
             ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('FONTSIZE', (0, 0), (-1, 0), 8),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
             ('BACKGROUND', (0, 1), (-1, -1), colors.white),
             ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
             ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('FONTSIZE', (0, 1), (-1, -1), body_font_size),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
             ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
         ])
-        table.setStyle(style)
-        # Добавляем таблицу в документ
-        elements = []
-        elements.append(table)
+        header_row = [pdf_cell_text(header, chars) for header, chars in zip(headers, col_chars)]
+        
+        def make_row(i, product):
+            values = [i] + [product.get(key) for key in keys]
+            row = [pdf_cell_text(value, chars) for value, chars in zip(values, col_chars)]
+            if wrap:
+                row = [Paragraph(xml_escape(text), cell_style) if len(text) > 20 else text for text in row]
+            return row
+        
+        def make_table(rows):
+            table = Table([header_row] + rows, colWidths=col_widths, repeatRows=1)
+            table.setStyle(style)
+            return table
+        
+        counters = {'rows': 0, 'tables': 0}
+        
+        def tables():
+            # Таблицы по rows_per_table строк создаются по мере верстки
+            chunk = []
+            for i, product in enumerate(itertools.chain([first], products), 1):
+                chunk.append(make_row(i, product))
+                counters['rows'] += 1
+                if len(chunk) >= rows_per_table:
+                    counters['tables'] += 1
+                    yield make_table(chunk)
+                    chunk = []
+            if chunk:
+                counters['tables'] += 1
+                yield make_table(chunk)
+        
         # Строим PDF
-        doc.build(elements)
-        print(f"✓ PDF файл успешно создан: {filename}")
+        doc.build(LazyFlowables(tables()))
+        elapsed = time.time() - start_time
+        print(f"✓ PDF файл успешно создан: {filename} ({counters['rows']} строк, {counters['tables']} таблиц, {elapsed:.2f} сек)")
         return filename
     except Exception as e:
+        if products.failed:
+            # Ошибку обхода отдаем задаче как есть, а не как «не удалось сохранить файл»
+            raise
         print(f"✗ Ошибка при создании PDF файла: {str(e)}")
         import traceback
         traceback.print_exc()
         return None
 
-@app.route('/')
-def index():
-    """Главная страница"""
-    return send_from_directory('.', 'index.html')
+# ===== Фоновые задачи (очередь парсинга) =====
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', 6 * 3600))
+# Подпись вида задачи в сообщении об ошибке: «Ошибка парсинга: ...»
+JOB_KIND_LABELS = {'parse': 'парсинга', 'warm_cards': 'прогрева карточек', 'seo_bulk': 'SEO-анализа'}
 
-@app.route('/health')
-def health():
-    return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat()
-    })
+class Job:
+    """Фоновая задача с прогрессом и результатом"""
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'  # queued, running, done, failed
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = Lock()
 
-@app.route('/api/status')
-def api_status():
-    return jsonify({
-        "status": "ok",
-        "message": "Wildberries Parser API is running",
-        "version": "1.0.0"
-    })
+    def update_progress(self, progress):
+        with self._lock:
+            self.progress.update(progress)
 
-@app.route('/parse', methods=['POST'])
-def parse():
-    try:
-        data = request.get_json()
-        seller_url = data.get('seller_url')
-        file_format = data.get('format', 'csv')  # По умолчанию CSV
-        print(f"Получен запрос на парсинг. URL: {seller_url}, Формат: {file_format}")  # Отладочный вывод
-        if not seller_url:
-            return jsonify({'error': 'URL продавца не указан'}), 400
-        # Парсинг товаров
-        parser = WildberriesParser()
-        products = parser.parse_seller_products(seller_url)
-        if not products:
-            return jsonify({'error': 'Товары не найдены'}), 404
-        # Генерация имени файла с учетом формата
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'products_{timestamp}.{file_format}'
-        # Сохранение в выбранном формате
-        if file_format == 'xlsx':
-            save_to_xlsx(products, filename)
-        elif file_format == 'pdf':
-            save_to_pdf(products, filename)
-        else:  # По умолчанию CSV
-            save_to_csv(products, filename)
-        # Получаем размер файла
-        file_size = os.path.getsize(filename)
-        file_size_mb = round(file_size / (1024 * 1024), 2)
-        print(f"Файл сохранен: {filename}, размер: {file_size_mb} МБ")  # Отладочный вывод
-        return jsonify({
-            'success': True,
-            'products_count': len(products),
-            'filename': filename,
-            'format': file_format,
-            'file_size_mb': file_size_mb
-        })
-    except Exception as e:
-        print(f"Ошибка при парсинге: {str(e)}")  # Отладочный вывод
-        return jsonify({'error': f'Ошибка парсинга: {str(e)}'}), 500
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'progress': dict(self.progress),
+                'error': self.error,
+                'created_at': datetime.fromtimestamp(self.created_at).isoformat(),
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat() if self.started_at else None,
+                'finished_at': datetime.fromtimestamp(self.finished_at).isoformat() if self.finished_at else None,
+                'elapsed_sec': round((self.finished_at or time.time()) - (self.started_at or self.created_at), 1)
+            }
 
-@app.route('/check-position', methods=['POST'])
-def check_position():
-    """Endpoint для проверки позиций товара"""
-    print("\n=== НОВЫЙ ЗАПРОС check-position ===")
-    try:
-        data = request.json
-        product_url = data.get('product_url')
+class JobQueue:
+    """Пул потоков для долгих задач, чтобы не держать поток gunicorn"""
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = Lock()
+
+    def submit(self, kind, func, params):
+        self._cleanup()
+        job = Job(kind, params)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func)
+        print(f"[JOBS] Задача {job.id} ({kind}) поставлена в очередь")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, func):
+        # Статус меняется под блокировкой задачи: to_dict читает его из потоков запросов
+        with job._lock:
+            job.status = 'running'
+            job.started_at = time.time()
+        result = error = None
+        try:
+            with app.app_context():
+                result = func(job)
+        except Exception as e:
+            print(f"[JOBS] Задача {job.id} завершилась с ошибкой: {e}")
+            import traceback
+            traceback.print_exc()
+            error = str(e)
+        with job._lock:
+            job.result = result
+            job.error = error
+            job.status = 'done' if error is None else 'failed'
+            job.finished_at = time.time()
+        print(f"[JOBS] Задача {job.id}: {job.status} за {job.finished_at - job.started_at:.1f} сек")
+
+    def _cleanup(self):
+        """Удаляем завершенные задачи старше JOB_TTL_SECONDS"""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at and now - job.finished_at > JOB_TTL_SECONDS]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+job_queue = JobQueue(JOB_WORKERS)
+
+# Обходы, которые сейчас выполняются в этом процессе (защита от двойного продолжения)
+_active_crawls = set()
+_active_crawls_lock = Lock()
+
+# ===== Отслеживание позиций (история) =====
+RANK_TRACKER_ENABLED = os.getenv('RANK_TRACKER_ENABLED', '1') == '1'
+RANK_TRACKER_INTERVAL_MINUTES = int(os.getenv('RANK_TRACKER_INTERVAL_MINUTES', 360))
+RANK_TRACKER_MIN_INTERVAL_MINUTES = 15
+# Отдельный бюджет запросов к search.wb.ru для трекера, чтобы фоновые
+# проверки не отнимали лимит у пользовательских /check-position
+RANK_TRACKER_RPS = float(os.getenv('RANK_TRACKER_RPS', 1))
+RANK_TRACKER_WORKERS = int(os.getenv('RANK_TRACKER_WORKERS', 2))
+RANK_TRACKER_MAX_PAGES = int(os.getenv('RANK_TRACKER_MAX_PAGES', 10))
+RANK_TRACKER_POLL_SECONDS = 30
+RANK_TRACKER_BATCH = 500
+
+class TrackedPosition(db.Model):
+    """Отслеживаемая тройка (товар, запрос, регион)"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, index=True)
+    nm_id = db.Column(db.String(32), nullable=False)
+    keyword = db.Column(db.String(256), nullable=False)
+    dest = db.Column(db.String(32), nullable=False, default='-1257786')
+    interval_minutes = db.Column(db.Integer, nullable=False, default=RANK_TRACKER_INTERVAL_MINUTES)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    next_check_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_checked_at = db.Column(db.DateTime)
+    last_position = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('user_id', 'nm_id', 'keyword', 'dest', name='uq_tracked_position_user'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'nm_id': self.nm_id,
+            'keyword': self.keyword,
+            'dest': self.dest,
+            'interval_minutes': self.interval_minutes,
+            'active': self.active,
+            'next_check_at': self.next_check_at.isoformat() if self.next_check_at else None,
+            'last_checked_at': self.last_checked_at.isoformat() if self.last_checked_at else None,
+            'last_position': self.last_position
+        }
+
+class PositionPoint(db.Model):
+    """Точка временного ряда позиций: 0 — товар не найден в пределах глубины поиска"""
+    id = db.Column(db.Integer, primary_key=True)
+    tracked_id = db.Column(db.Integer, nullable=False)
+    checked_at = db.Column(db.DateTime, nullable=False)
+    position = db.Column(db.SmallInteger, nullable=False)
+    __table_args__ = (db.Index('ix_position_point_tracked_time', 'tracked_id', 'checked_at'),)
+
+class RankTracker:
+    """Планировщик периодических проверок позиций
+
+    Каждая тройка проверяется раз в interval_minutes. Первая проверка
+    сдвигается на постоянное смещение внутри интервала (по хешу тройки),
+    а следующие сохраняют эту фазу, поэтому тысячи троек распределяются по
+    интервалу равномерно, а не выполняются одной пачкой. Все запросы идут
+    через собственный AdaptiveRateLimiter с бюджетом RANK_TRACKER_RPS.
+
+    Подошедшие тройки группируются по (запрос, регион): одна проверка
+    search_keyword_positions отвечает сразу за все товары группы.
+    Перед проверкой тройка «захватывается» условным UPDATE next_check_at,
+    поэтому несколько процессов не проверяют одно и то же дважды.
+    """
+    def __init__(self, rps=RANK_TRACKER_RPS, workers=RANK_TRACKER_WORKERS, max_pages=RANK_TRACKER_MAX_PAGES):
+        self.limiter = AdaptiveRateLimiter(rate=rps)
+        self.workers = max(1, workers)
+        self.max_pages = max_pages
+        self.checks = 0
+        self.last_run_at = None
+        self._stop = Event()
+        self._thread = None
+
+    @staticmethod
+    def phase_offset(nm_id, keyword, dest, interval_minutes):
+        """Постоянное смещение первой проверки внутри интервала"""
+        digest = hashlib.sha1(f'{nm_id}|{keyword}|{dest}'.encode('utf-8')).hexdigest()
+        return timedelta(seconds=int(digest[:8], 16) % max(60, interval_minutes * 60))
+
+    def register(self, nm_id, keyword, dest='-1257786', interval_minutes=None, user_id=None):
+        """Добавляет тройку в отслеживание (или включает ранее отключенную)"""
+        interval_minutes = max(RANK_TRACKER_MIN_INTERVAL_MINUTES, int(interval_minutes or RANK_TRACKER_INTERVAL_MINUTES))
+        keyword = ' '.join(keyword.split())
+        tracked = TrackedPosition.query.filter_by(user_id=user_id, nm_id=str(nm_id), keyword=keyword,
+                                                  dest=str(dest)).first()
+        now = datetime.now()
+        if tracked is None:
+            tracked = TrackedPosition(nm_id=str(nm_id), keyword=keyword, dest=str(dest), user_id=user_id,
+                                      created_at=now)
+            db.session.add(tracked)
+        elif tracked.active and tracked.interval_minutes == interval_minutes:
+            return tracked
+        tracked.active = True
+        tracked.interval_minutes = interval_minutes
+        tracked.next_check_at = now + self.phase_offset(nm_id, keyword, dest, interval_minutes)
+        db.session.commit()
+        return tracked
+
+    def _claim(self, tracked, now):
+        """Переносит next_check_at на следующий интервал с сохранением фазы; False, если тройку уже взял другой процесс"""
+        interval = timedelta(minutes=tracked.interval_minutes)
+        next_check_at = tracked.next_check_at + interval
+        if next_check_at <= now:
+            missed = (now - tracked.next_check_at) // interval
+            next_check_at = tracked.next_check_at + interval * (missed + 1)
+        claimed = (TrackedPosition.query
+                   .filter_by(id=tracked.id, next_check_at=tracked.next_check_at)
+                   .update({'next_check_at': next_check_at}, synchronize_session=False))
+        return claimed == 1
+
+    def run_due(self, parser=None):
+        """Проверяет все тройки, время которых подошло; возвращает число проверок"""
+        now = datetime.now()
+        due = (TrackedPosition.query
+               .filter(TrackedPosition.active.is_(True), TrackedPosition.next_check_at <= now)
+               .order_by(TrackedPosition.next_check_at)
+               .limit(RANK_TRACKER_BATCH)
+               .all())
+        groups = {}
+        for tracked in due:
+            if self._claim(tracked, now):
+                groups.setdefault((tracked.keyword, tracked.dest), []).append(tracked)
+        db.session.commit()
+        if not groups:
+            return 0
+        parser = parser or WildberriesParser()
+        print(f"[RANK] Проверка {sum(len(g) for g in groups.values())} позиций по {len(groups)} запросам")
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(groups)), thread_name_prefix='rank') as executor:
+            futures = {
+                executor.submit(parser.search_keyword_positions, [t.nm_id for t in group], keyword,
+                                self.max_pages, dest, self.limiter): group
+                for (keyword, dest), group in groups.items()
+            }
+            checked = 0
+            for future in as_completed(futures):
+                result = future.result()
+                if result['error'] and not result['pages_scanned']:
+                    # Выдачу не получили совсем: точку не пишем, проверим в следующем интервале
+                    continue
+                checked_at = datetime.now()
+                for tracked in futures[future]:
+                    if result['error'] and tracked.nm_id not in result['positions']:
+                        # Выдача просмотрена не до конца: «не найден» здесь не достоверен
+                        continue
+                    position = result['positions'].get(tracked.nm_id, 0)
+                    db.session.add(PositionPoint(tracked_id=tracked.id, checked_at=checked_at, position=position))
+                    tracked.last_position = position
+                    tracked.last_checked_at = checked_at
+                    checked += 1
+                db.session.commit()
+        self.checks += checked
+        self.last_run_at = datetime.now()
+        return checked
+
+    def history(self, tracked_id, since=None, until=None):
+        """Точки временного ряда с изменением относительно предыдущей проверки
+
+        delta = позиция - предыдущая позиция: отрицательное значение — товар
+        поднялся. Если товар в одной из проверок не найден (0), delta = None.
+        """
+        query = PositionPoint.query.filter_by(tracked_id=tracked_id)
+        if since:
+            query = query.filter(PositionPoint.checked_at >= since)
+        if until:
+            query = query.filter(PositionPoint.checked_at <= until)
+        points = []
+        previous = None
+        for point in query.order_by(PositionPoint.checked_at).all():
+            delta = point.position - previous if previous and point.position else None
+            points.append({'checked_at': point.checked_at.isoformat(), 'position': point.position, 'delta': delta})
+            previous = point.position
+        found = [p['position'] for p in points if p['position']]
+        summary = {
+            'points': len(points),
+            'first': points[0]['position'] if points else None,
+            'last': points[-1]['position'] if points else None,
+            'best': min(found) if found else None,
+            'worst': max(found) if found else None,
+            'change': points[-1]['position'] - points[0]['position'] if points and points[0]['position'] and points[-1]['position'] else None
+        }
+        return points, summary
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    self.run_due()
+            except Exception as e:
+                print(f"[RANK] Ошибка планировщика позиций: {e}")
+                import traceback
+                traceback.print_exc()
+            self._stop.wait(RANK_TRACKER_POLL_SECONDS)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, name='rank-tracker', daemon=True)
+        self._thread.start()
+        print(f"[RANK] Планировщик позиций запущен (бюджет {self.limiter.rate} запр/сек)")
+
+    def stop(self):
+        self._stop.set()
+
+rank_tracker = RankTracker()
+
+def seller_nm_ids(parser, seller_url, progress_callback=None):
+    """Артикулы продавца: из последнего снимка в хранилище, а если его нет — из обхода каталога
+
+    Возвращает (seller_id, список артикулов, источник: 'snapshot' или 'crawl').
+    """
+    seller_id = parser.get_seller_id(seller_url)
+    if product_store.last_crawl(seller_id):
+        nm_ids = [p.get('Артикул') for p in product_store.iter_products(seller_id)]
+        source = 'snapshot'
+    else:
+        nm_ids = [p.get('Артикул') for p in parser.iter_seller_products(seller_url, progress_callback=progress_callback)]
+        source = 'crawl'
+    return seller_id, list(dict.fromkeys(str(nm_id) for nm_id in nm_ids if nm_id)), source
+
+def run_warm_cards_job(job):
+    """Прогрев product_card_cache для всего ассортимента продавца
+
+    Карточки загружаются пачками card.wb.ru, описания (по желанию) —
+    через description_resolver параллельно.
+    """
+    parser = WildberriesParser()
+    seller_id, nm_ids, source = seller_nm_ids(parser, job.params['seller_url'], job.update_progress)
+    job.update_progress({'seller_id': seller_id, 'source': source, 'products': len(nm_ids), 'cards': 0, 'descriptions': 0})
+    if len(nm_ids) > CARD_CACHE_SIZE and not CARD_CACHE_DIR:
+        print(f"⚠️  Ассортимент ({len(nm_ids)}) больше WB_CARD_CACHE_SIZE={CARD_CACHE_SIZE}, "
+              f"без WB_CARD_CACHE_DIR часть карточек будет вытеснена")
+    started = time.time()
+    limiter = AdaptiveRateLimiter(rate=CATALOG_RPS)
+    cards = 0
+    chunk = STOCKS_BATCH_SIZE * STOCKS_CONCURRENCY
+    for i in range(0, len(nm_ids), chunk):
+        cards += len(parser.get_cards(nm_ids[i:i + chunk], limiter=limiter))
+        job.update_progress({'cards': cards})
+    descriptions = 0
+    if job.params.get('descriptions'):
+        by_category = {}
+        with ThreadPoolExecutor(max_workers=DESCRIPTION_WORKERS, thread_name_prefix='warm') as executor:
+            for nm_id, resolved in zip(nm_ids, executor.map(parser.resolve_description, nm_ids)):
+                if resolved.get('description'):
+                    descriptions += 1
+                    by_category.setdefault(resolved.get('category') or '', {})[nm_id] = resolved['description']
+                job.update_progress({'descriptions': descriptions})
+        for category, documents in by_category.items():
+            if category:
+                keyword_indexes.add_documents(category, documents)
+    return {
+        'success': True,
+        'seller_id': seller_id,
+        'source': source,
+        'products': len(nm_ids),
+        'cards': cards,
+        'descriptions': descriptions,
+        'elapsed_sec': round(time.time() - started, 1),
+        'cache': {'cards': product_card_cache.cards.stats(), 'descriptions': product_card_cache.descriptions.stats()}
+    }
+
+SEO_BULK_CONCURRENCY = int(os.getenv('SEO_BULK_CONCURRENCY', 8))
+SEO_BULK_MAX_CONCURRENCY = 32
+SEO_BULK_MAX_ITEMS = int(os.getenv('SEO_BULK_MAX_ITEMS', 5000))
+
+def run_seo_bulk_job(job):
+    """SEO-анализ всего ассортимента продавца или списка артикулов
+
+    Карточки загружаются один раз пачками, конкуренты и индекс ключевых
+    слов строятся один раз на категорию, затем товары анализируются пулом
+    потоков. Ошибка одного товара попадает в его строку отчета и не
+    останавливает остальные. Отчет — CSV или XLSX для /download.
+    """
+    parser = WildberriesParser()
+    if job.params.get('seller_url'):
+        seller_id, nm_ids, source = seller_nm_ids(parser, job.params['seller_url'], job.update_progress)
+    else:
+        seller_id, nm_ids, source = None, job.params['nm_ids'], 'list'
+    truncated = max(0, len(nm_ids) - SEO_BULK_MAX_ITEMS)
+    nm_ids = nm_ids[:SEO_BULK_MAX_ITEMS]
+    if not nm_ids:
+        raise ValueError('Товары не найдены')
+    started = time.time()
+    job.update_progress({'message': 'Загрузка карточек...', 'total': len(nm_ids), 'source': source,
+                         'processed': 0, 'failed': 0})
+    cards = {}
+    chunk = STOCKS_BATCH_SIZE * STOCKS_CONCURRENCY
+    limiter = AdaptiveRateLimiter(rate=CATALOG_RPS)
+    for i in range(0, len(nm_ids), chunk):
+        cards.update(parser.get_cards(nm_ids[i:i + chunk], limiter=limiter))
+
+    categories = sorted({card.get('subjectName') for card in cards.values() if card.get('subjectName')})
+    job.update_progress({'message': f'Анализ конкурентов ({len(categories)} категорий)...', 'categories': len(categories)})
+    competitors_by_category = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(4, len(categories))), thread_name_prefix='seo-categories') as executor:
+        futures = {executor.submit(parser.analyze_competitors_seo, category): category for category in categories}
+        for future in as_completed(futures):
+            try:
+                competitors_by_category[futures[future]] = future.result()
+            except Exception as e:
+                print(f"⚠️  Конкуренты категории '{futures[future]}' не получены: {e}")
+                competitors_by_category[futures[future]] = []
+
+    def analyze(nm_id):
+        card = cards.get(nm_id) or {}
+        url = f"https://www.wildberries.ru/catalog/{nm_id}/detail.aspx"
+        row = {
+            'Артикул': nm_id,
+            'Ссылка': url,
+            'Наименование': card.get('name', ''),
+            'Категория': card.get('subjectName', ''),
+            'Источник описания': '',
+            'Длина описания': 0,
+            'Ключевые слова': '',
+            'Рекомендации': '',
+            'Оптимизированное описание': '',
+            'Ошибка': ''
+        }
+        try:
+            if not card:
+                raise ValueError('Карточка не найдена')
+            resolved = parser.resolve_description(nm_id)
+            description = resolved['description']
+            source_name = resolved['source']
+            if not description and job.params.get('browser_fallback'):
+                description = parser.get_description_playwright(url)
+                source_name = 'playwright' if description else None
+            category = row['Категория'] or resolved.get('category', '')
+            report = parser.build_seo_report(description, category, competitors_by_category.get(category, []))
+            row.update({
+                'Категория': category,
+                'Источник описания': source_name or 'нет описания',
+                'Длина описания': len(description),
+                'Ключевые слова': ', '.join(report['keywords']),
+                'Рекомендации': '\n'.join(report['recommendations']),
+                'Оптимизированное описание': report['optimized_description']
+            })
+        except Exception as e:
+            row['Ошибка'] = f"{type(e).__name__}: {e}"
+        return row
+
+    job.update_progress({'message': 'Анализ товаров...'})
+    rows = {}
+    failed = 0
+    concurrency = min(job.params.get('concurrency') or SEO_BULK_CONCURRENCY, SEO_BULK_MAX_CONCURRENCY)
+    analysis_started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='seo-bulk') as executor:
+        futures = {executor.submit(analyze, nm_id): nm_id for nm_id in nm_ids}
+        for future in as_completed(futures):
+            row = future.result()
+            rows[futures[future]] = row
+            failed += bool(row['Ошибка'])
+            elapsed = time.time() - analysis_started
+            job.update_progress({
+                'processed': len(rows),
+                'failed': failed,
+                'items_per_sec': round(len(rows) / elapsed, 2) if elapsed else None
+            })
+
+    job.update_progress({'message': 'Формирование отчета...'})
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    file_format = job.params.get('format', 'csv')
+    filename = f'seo_{seller_id or "list"}_{timestamp}_{job.id[:8]}.{file_format}'
+    ordered_rows = (rows[nm_id] for nm_id in nm_ids)
+    if file_format == 'xlsx':
+        saved = save_to_xlsx(ordered_rows, filename, sheet_name='SEO')
+    else:
+        saved = save_to_csv(ordered_rows, filename)
+    if not saved or not os.path.exists(filename):
+        raise ValueError(f'Не удалось сохранить файл {filename}')
+    elapsed = time.time() - started
+    job.update_progress({'message': 'Готово'})
+    return {
+        'success': True,
+        'filename': filename,
+        'download_url': f'/download/{filename}',
+        'format': file_format,
+        'seller_id': seller_id,
+        'source': source,
+        'items': len(rows),
+        'failed': failed,
+        'truncated': truncated,
+        'categories': len(categories),
+        'elapsed_sec': round(elapsed, 1),
+        'items_per_sec': round(len(rows) / elapsed, 2) if elapsed else None
+    }
+
+def run_parse_job(job):
+    """Парсинг продавца и сохранение файла в фоне
+
+    Страницы идут потоком: парсер -> (уточнение остатков) -> хранилище
+    снимков, затем файл пишется потоком из хранилища. Поэтому память
+    зависит от размера страницы, а не от размера каталога.
+    Если снимок продавца свежее max_age_minutes, каталог не обходится заново.
+    """
+    file_format = job.params['format']
+    parser = WildberriesParser()
+    seller_id = parser.get_seller_id(job.params['seller_url'])
+    max_age_minutes = job.params.get('max_age_minutes')
+    crawl = product_store.last_crawl(seller_id)
+    resume_crawl = product_store.resumable_crawl(seller_id) if job.params.get('resume') else None
+    if (not resume_crawl and max_age_minutes and crawl and crawl.finished_at
+            and datetime.now() - crawl.finished_at <= timedelta(minutes=float(max_age_minutes))):
+        print(f"✓ Используем снимок продавца {seller_id} от {crawl.started_at}")
+        job.update_progress({
+            'seller_id': seller_id,
+            'products': crawl.products_count,
+            'message': 'Используем сохраненный снимок'
+        })
+    else:
+        if resume_crawl:
+            crawl = resume_crawl
+            start_page = crawl.last_page + 1
+            stats = json.loads(crawl.stats or '{}')
+            # Чекпоинты, записанные до выравнивания счетчиков, могли опережать last_page
+            stats.update({'products': crawl.products_count or 0, 'pages_done': crawl.last_page})
+            crawl.status = 'running'
+            db.session.commit()
+            print(f"↻ Продолжаем обход {crawl.id} продавца {seller_id} со страницы {start_page}")
+            job.update_progress({'resumed_from_page': start_page})
+        else:
+            crawl = product_store.start_crawl(seller_id)
+            start_page = 1
+            stats = {}
+        with _active_crawls_lock:
+            if crawl.id in _active_crawls:
+                raise ValueError('Этот обход продавца уже выполняется')
+            _active_crawls.add(crawl.id)
+        try:
+            pages = parser.iter_seller_pages(
+                seller_id,
+                progress_callback=job.update_progress,
+                concurrency=job.params.get('concurrency'),
+                rps=job.params.get('rps'),
+                start_page=start_page,
+                stats=stats
+            )
+            if job.params.get('enrich_stocks'):
+                pages = parser.iter_enriched_pages(pages, progress_callback=job.update_progress)
+            last_page = start_page - 1
+            try:
+                for page_products in pages:
+                    # Страницы приходят строго по порядку, поэтому чекпоинт — номер последней сохраненной
+                    last_page += 1
+                    product_store.save_page(crawl, page_products, last_page=last_page, stats=stats)
+                    job.update_progress({'new_products': crawl.new_count, 'changed_products': crawl.changed_count})
+            except Exception:
+                db.session.rollback()
+                product_store.finish_crawl(crawl, 'failed')
+                raise
+        finally:
+            with _active_crawls_lock:
+                _active_crawls.discard(crawl.id)
+        if not crawl.products_count:
+            product_store.finish_crawl(crawl, 'failed')
+            raise ValueError('Товары не найдены')
+        if not stats.get('completed'):
+            # Обход остановлен ошибками: выгружаем собранное, чекпоинт позволит продолжить
+            print(f"⚠️  Обход {crawl.id} прерван на странице {crawl.last_page}, его можно продолжить")
+            product_store.finish_crawl(crawl, 'interrupted')
+            job.update_progress({'interrupted': True, 'last_page': crawl.last_page})
+        else:
+            product_store.finish_crawl(crawl)
+    
+    job.update_progress({'message': 'Формирование файла...'})
+    written = {'count': 0}
+    def counted_products():
+        for product in product_store.iter_products(seller_id, seen_since=crawl.started_at):
+            written['count'] += 1
+            yield product
+    # Генерация имени файла с учетом формата
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f'products_{timestamp}_{job.id[:8]}.{file_format}'
+    # Сохранение в выбранном формате
+    if file_format == 'xlsx':
+        saved = save_to_xlsx(counted_products(), filename)
+    elif file_format == 'pdf':
+        saved = save_to_pdf(
+            counted_products(),
+            filename,
+            columns=job.params.get('pdf_columns'),
+            wrap=job.params.get('pdf_wrap', False)
+        )
+    else:  # По умолчанию CSV
+        saved = save_to_csv(counted_products(), filename)
+    if not written['count']:
+        raise ValueError('Товары не найдены')
+    if not saved or not os.path.exists(filename):
+        raise ValueError(f'Не удалось сохранить файл {filename}')
+    # Получаем размер файла
+    file_size = os.path.getsize(filename)
+    file_size_mb = round(file_size / (1024 * 1024), 2)
+    print(f"Файл сохранен: {filename}, размер: {file_size_mb} МБ")  # Отладочный вывод
+    job.update_progress({'message': 'Готово'})
+    return {
+        'success': True,
+        'interrupted': crawl.status == 'interrupted',
+        'products_count': written['count'],
+        'filename': filename,
+        'format': file_format,
+        'file_size_mb': file_size_mb,
+        'snapshot': crawl.to_dict()
+    }
+
+@app.route('/')
+def index():
+    """Главная страница"""
+    return send_from_directory('.', 'index.html')
+
+@app.route('/health')
+def health():
+    return jsonify({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat()
+    })
+
+@app.route('/api/status')
+def api_status():
+    return jsonify({
+        "status": "ok",
+        "message": "Wildberries Parser API is running",
+        "version": "1.0.0"
+    })
+
+@app.route('/api/http-stats')
+def api_http_stats():
+    """Статистика общего HTTP-клиента: запросы, ошибки и переиспользование соединений по группам хостов"""
+    return jsonify({
+        'pools': http_client.stats(),
+        'config': {
+            'pool_size': http_client.pool_size,
+            'timeout': http_client.timeout,
+            'retries': http_client.retries,
+            'backoff': http_client.backoff
+        }
+    })
+
+@app.route('/api/description-stats')
+def api_description_stats():
+    """Задержка и доля успехов JSON-источников описаний, текущий порядок их запуска"""
+    return jsonify(description_resolver.stats())
+
+@app.route('/api/browser-stats')
+def api_browser_stats():
+    """Пул браузеров Playwright: запуски, задачи, перезапуски, заблокированные запросы"""
+    return jsonify(browser_pool.stats())
+
+@app.route('/api/cache-stats', methods=['GET', 'DELETE'])
+def api_cache_stats():
+    """Статистика кэшей ответов WB (попадания, промахи, доля попаданий); DELETE очищает кэши
+
+    Очистка сбрасывает кэши всем пользователям, поэтому требует входа.
+    """
+    if request.method == 'DELETE' and not current_user.is_authenticated:
+        return login_manager.unauthorized()
+    caches = {
+        'search': search_cache,
+        'cards': product_card_cache.cards,
+        'descriptions': product_card_cache.descriptions,
+        'competitors': competitors_cache,
+        'review_replies': review_reply_cache.cache
+    }
+    if request.method == 'DELETE':
+        for cache in caches.values():
+            cache.clear()
+    return jsonify({name: cache.stats() for name, cache in caches.items()})
+
+@app.route('/parse', methods=['POST'])
+def parse():
+    """Ставит парсинг продавца в очередь и сразу возвращает job_id"""
+    try:
+        data = request.get_json(silent=True) or {}
+        seller_url = data.get('seller_url')
+        file_format = data.get('format', 'csv')  # По умолчанию CSV
+        print(f"Получен запрос на парсинг. URL: {seller_url}, Формат: {file_format}")  # Отладочный вывод
+        if not seller_url:
+            return jsonify({'error': 'URL продавца не указан'}), 400
+        if file_format not in ('csv', 'xlsx', 'pdf'):
+            file_format = 'csv'
+        # Числовые параметры проверяем здесь, а не в фоновой задаче
+        try:
+            concurrency = int(data['concurrency']) if data.get('concurrency') not in (None, '') else None
+            rps = float(data['rps']) if data.get('rps') not in (None, '') else None
+            max_age_minutes = float(data['max_age_minutes']) if data.get('max_age_minutes') not in (None, '') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'concurrency, rps и max_age_minutes должны быть числами'}), 400
+        if (concurrency is not None and concurrency < 1) or (rps is not None and rps <= 0) \
+                or (max_age_minutes is not None and max_age_minutes < 0):
+            return jsonify({'error': 'concurrency и rps должны быть больше 0, max_age_minutes — не меньше 0'}), 400
+        pdf_columns = data.get('pdf_columns')
+        if isinstance(pdf_columns, str):
+            pdf_columns = [c.strip() for c in pdf_columns.split(',') if c.strip()]
+        job = job_queue.submit('parse', run_parse_job, {
+            'seller_url': seller_url,
+            'format': file_format,
+            'concurrency': concurrency,
+            'rps': rps,
+            'enrich_stocks': bool(data.get('enrich_stocks')),
+            'pdf_columns': pdf_columns or None,
+            'pdf_wrap': bool(data.get('pdf_wrap')),
+            'max_age_minutes': max_age_minutes,
+            'resume': bool(data.get('resume'))
+        })
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status_url': f'/jobs/{job.id}',
+            'result_url': f'/jobs/{job.id}/result'
+        }), 202
+    except Exception as e:
+        print(f"Ошибка при парсинге: {str(e)}")  # Отладочный вывод
+        return jsonify({'error': f'Ошибка парсинга: {str(e)}'}), 500
+
+@app.route('/keywords', methods=['GET'])
+def keyword_index_stats():
+    """Индексы ключевых слов: категории и число документов; ?category= — самые частые термины категории"""
+    category = request.args.get('category')
+    if category:
+        index = keyword_indexes.get(category)
+        return jsonify({'category': index.category, 'documents': index.documents,
+                        'top_terms': index.top_terms(request.args.get('limit', 50, type=int))})
+    return jsonify({'categories': keyword_indexes.stats()})
+
+@app.route('/keywords/rank', methods=['POST'])
+def rank_keywords():
+    """TF-IDF ключевые слова для пачки текстов относительно индекса категории
+
+    Тело запроса: texts (список строк), category, top_n, add_to_index
+    (пополнить индекс этими текстами — тогда нужны ids той же длины).
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('texts') or [], list):
+        return jsonify({'error': 'texts должен быть списком строк'}), 400
+    texts = [str(text) for text in data.get('texts') or []]
+    if not texts:
+        return jsonify({'error': 'Не переданы тексты'}), 400
+    try:
+        top_n = max(1, min(int(data.get('top_n') or 20), 200))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_n должно быть целым числом'}), 400
+    category = data.get('category') or ''
+    if data.get('add_to_index') and category and len(data.get('ids') or []) == len(texts):
+        index = keyword_indexes.add_documents(category, dict(zip(data['ids'], texts)))
+    else:
+        index = keyword_indexes.get(category) if category else KeywordIndex('')
+    started = time.time()
+    ranked = index.rank(texts, top_n)
+    return jsonify({
+        'category': index.category,
+        'documents': index.documents,
+        'results': ranked,
+        'elapsed_sec': round(time.time() - started, 3)
+    })
+
+@app.route('/cards/warm', methods=['POST'])
+def warm_cards():
+    """Ставит прогрев кэша карточек (и описаний, descriptions=true) продавца в очередь"""
+    data = request.get_json() or {}
+    seller_url = data.get('seller_url')
+    if not seller_url:
+        return jsonify({'error': 'URL продавца не указан'}), 400
+    job = job_queue.submit('warm_cards', run_warm_cards_job, {
+        'seller_url': seller_url,
+        'descriptions': bool(data.get('descriptions'))
+    })
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}',
+        'result_url': f'/jobs/{job.id}/result'
+    }), 202
+
+@app.route('/cards/<nm_id>', methods=['GET'])
+def product_card(nm_id):
+    """Карточка товара и описание из кэша (загружаются при промахе); description=false — без описания"""
+    if not nm_id.isdigit():
+        return jsonify({'error': 'Неверный артикул'}), 400
+    parser = WildberriesParser()
+    card = parser.get_card(nm_id)
+    if not card:
+        return jsonify({'error': 'Карточка не найдена'}), 404
+    result = {'nm_id': nm_id, 'card': card, 'stocks': parser.sum_stocks(card)}
+    if request.args.get('description', 'true') != 'false':
+        result['description'] = parser.resolve_description(nm_id)
+    return jsonify(result)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Статус и прогресс фоновой задачи"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """Результат фоновой задачи (202, пока задача выполняется)"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    if job.status == 'failed':
+        label = JOB_KIND_LABELS.get(job.kind, 'задачи')
+        return jsonify({'error': f'Ошибка {label}: {job.error}', 'job': job.to_dict()}), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 202
+    return jsonify(job.result)
+
+@app.route('/sellers/<seller_id>/snapshots', methods=['GET'])
+def seller_snapshots(seller_id):
+    """Список обходов (снимков) каталога продавца"""
+    crawls = (SellerCrawl.query
+              .filter_by(seller_id=str(seller_id))
+              .order_by(SellerCrawl.started_at.desc())
+              .limit(request.args.get('limit', 50, type=int))
+              .all())
+    return jsonify({'seller_id': seller_id, 'snapshots': [c.to_dict() for c in crawls]})
+
+@app.route('/sellers/<seller_id>/changes', methods=['GET'])
+def seller_changes(seller_id):
+    """Изменения цены, остатка, рейтинга и отзывов между снимками
+
+    Интервал задается либо since/until (ISO дата-время), либо номерами
+    снимков from_snapshot/to_snapshot.
+    """
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = datetime.fromisoformat(since) if since else None
+        until = datetime.fromisoformat(until) if until else None
+        from_snapshot = request.args.get('from_snapshot', type=int)
+        to_snapshot = request.args.get('to_snapshot', type=int)
+        if from_snapshot:
+            crawl = db.session.get(SellerCrawl, from_snapshot)
+            if not crawl or crawl.seller_id != str(seller_id):
+                return jsonify({'error': 'Снимок не найден'}), 404
+            since = crawl.started_at
+        if to_snapshot:
+            crawl = db.session.get(SellerCrawl, to_snapshot)
+            if not crawl or crawl.seller_id != str(seller_id):
+                return jsonify({'error': 'Снимок не найден'}), 404
+            until = crawl.started_at
+    except ValueError as e:
+        return jsonify({'error': f'Неверный формат параметров: {e}'}), 400
+    changes = product_store.changes(
+        seller_id,
+        since=since,
+        until=until,
+        article=request.args.get('article'),
+        field=request.args.get('field'),
+        limit=request.args.get('limit', 1000, type=int)
+    )
+    return jsonify({'seller_id': seller_id, 'changes': changes})
+
+@app.route('/check-position', methods=['POST'])
+def check_position():
+    """Endpoint для проверки позиций товара
+
+    Ключевые слова проверяются параллельно (POSITION_CONCURRENCY потоков)
+    под общим лимитом search_limiter. При stream=true результаты отдаются
+    построчно в формате NDJSON по мере готовности, последняя строка — {"done": true}.
+    """
+    print("\n=== НОВЫЙ ЗАПРОС check-position ===")
+    try:
+        data = request.json
+        product_url = data.get('product_url')
         keywords = data.get('keywords', [])
+        stream = bool(data.get('stream'))
         
         print(f"Получены данные:")
         print(f"  URL: {product_url}")
-        print(f"  Ключевые слова: {keywords}")
+        print(f"  Ключевые слова: {len(keywords)} шт.")
         
         if not product_url or not keywords:
             print("ОШИБКА: Не все параметры указаны")
             return jsonify({'error': 'Не все параметры указаны'}), 400
         
+        # Убираем пустые и повторяющиеся ключевые слова, сохраняя порядок
+        keywords = list(dict.fromkeys(k.strip() for k in keywords if k and k.strip()))
+        truncated = max(0, len(keywords) - POSITION_MAX_KEYWORDS)
+        keywords = keywords[:POSITION_MAX_KEYWORDS]
+        
         parser = WildberriesParser()
-        results = []
         
-        for keyword in keywords[:10]:
-            if keyword and keyword.strip():
-                try:
-                    print(f"\nПоиск для ключевого слова: '{keyword}'")
-                    position = parser.search_product_position(product_url, keyword.strip())
-                    
-                    # Гарантируем, что position - это целое число >= 0
-                    if position is None or not isinstance(position, (int, float)) or position < 0:
-                        position = 0
-                    else:
-                        position = int(position)
-                    
-                    results.append({
-                        'keyword': keyword.strip(),
-                        'position': position
-                    })
-                    print(f"Результат: позиция {position}")
-                    
-                except Exception as e:
-                    print(f"ОШИБКА при поиске для '{keyword}': {e}")
-                    import traceback
-                    traceback.print_exc()
-                    results.append({
-                        'keyword': keyword.strip(),
-                        'position': 0
-                    })
+        def check_keyword(keyword):
+            try:
+                print(f"\nПоиск для ключевого слова: '{keyword}'")
+                position = parser.search_product_position(product_url, keyword, raise_errors=True)
                 
-                time.sleep(0.5)
+                # Гарантируем, что position - это целое число >= 0
+                if position is None or not isinstance(position, (int, float)) or position < 0:
+                    position = 0
+                else:
+                    position = int(position)
+                print(f"Результат для '{keyword}': позиция {position}")
+                return {'keyword': keyword, 'position': position}
+            except Exception as e:
+                print(f"ОШИБКА при поиске для '{keyword}': {e}")
+                import traceback
+                traceback.print_exc()
+                # Позиция 0 означает «не найден»; ошибка WB отмечается отдельно
+                return {'keyword': keyword, 'position': 0, 'error': f"{type(e).__name__}: {e}"}
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, min(POSITION_CONCURRENCY, len(keywords))),
+                                      thread_name_prefix='position')
+        futures = [executor.submit(check_keyword, keyword) for keyword in keywords]
+        
+        if stream:
+            def generate():
+                try:
+                    for future in as_completed(futures):
+                        yield json.dumps(future.result(), ensure_ascii=False) + '\n'
+                    yield json.dumps({'done': True, 'total': len(keywords), 'truncated': truncated}) + '\n'
+                finally:
+                    # Клиент мог отключиться — не проверяем оставшиеся слова
+                    executor.shutdown(wait=False, cancel_futures=True)
+            return Response(generate(), mimetype='application/x-ndjson')
+        
+        try:
+            results = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
         
         print(f"\nИтоговые результаты: {results}")
         return jsonify({
             'success': True,
-            'results': results
+            'results': results,
+            'truncated': truncated
         })
         
     except Exception as e:
@@ -1239,28 +3867,153 @@ def check_position():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/check-positions-batch', methods=['POST'])
+def check_positions_batch():
+    """Позиции многих товаров по многим запросам за один проход выдачи на запрос
+
+    Тело запроса: nm_ids (артикулы или ссылки на товары), keywords,
+    max_pages (глубина, по умолчанию 10), dest (регион), stream.
+    При stream=true результаты по каждому запросу отдаются построчно (NDJSON).
+    """
+    try:
+        data = request.json or {}
+        nm_ids = []
+        for item in data.get('nm_ids') or data.get('product_urls') or []:
+            match = re.search(r'(\d+)', str(item).split('/catalog/')[-1])
+            if match:
+                nm_ids.append(match.group(1))
+        nm_ids = list(dict.fromkeys(nm_ids))[:POSITION_MAX_PRODUCTS]
+        keywords = list(dict.fromkeys(str(k).strip() for k in data.get('keywords') or [] if k and str(k).strip()))
+        truncated = max(0, len(keywords) - POSITION_MAX_KEYWORDS)
+        keywords = keywords[:POSITION_MAX_KEYWORDS]
+        if not nm_ids or not keywords:
+            return jsonify({'error': 'Не указаны товары или ключевые слова'}), 400
+        max_pages = max(1, min(int(data.get('max_pages') or 10), POSITION_MAX_PAGES))
+        dest = str(data.get('dest') or '-1257786')
+        print(f"Пакетная проверка позиций: {len(nm_ids)} товаров × {len(keywords)} запросов, глубина {max_pages} стр.")
+        
+        parser = WildberriesParser()
+        results = parser.iter_positions_batch(nm_ids, keywords, max_pages=max_pages, dest=dest)
+        
+        if data.get('stream'):
+            def generate():
+                try:
+                    for result in results:
+                        yield json.dumps(result, ensure_ascii=False) + '\n'
+                    yield json.dumps({'done': True, 'total': len(keywords), 'truncated': truncated}) + '\n'
+                finally:
+                    results.close()
+            return Response(generate(), mimetype='application/x-ndjson')
+        
+        keyword_results = sorted(results, key=lambda r: keywords.index(r['keyword']))
+        by_product = {nm_id: {r['keyword']: r['positions'].get(nm_id, 0) for r in keyword_results} for nm_id in nm_ids}
+        return jsonify({
+            'success': True,
+            'results': keyword_results,
+            'by_product': by_product,
+            'truncated': truncated
+        })
+    except Exception as e:
+        print(f"ОШИБКА пакетной проверки позиций: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/positions/tracked', methods=['POST'])
+@login_required
+def track_positions():
+    """Добавляет тройки (товар, запрос, регион) в периодическую проверку позиций
+
+    Тело запроса: nm_id (или product_url), keywords (или keyword), dest,
+    interval_minutes.
+    """
+    data = request.json or {}
+    match = re.search(r'(\d+)', str(data.get('nm_id') or data.get('product_url') or '').split('/catalog/')[-1])
+    keywords = data.get('keywords') or ([data['keyword']] if data.get('keyword') else [])
+    keywords = list(dict.fromkeys(' '.join(str(k).split()) for k in keywords if k and str(k).strip()))
+    if not match or not keywords:
+        return jsonify({'error': 'Не указан товар или ключевые слова'}), 400
+    tracked = [rank_tracker.register(match.group(1), keyword, str(data.get('dest') or '-1257786'),
+                                     data.get('interval_minutes'), current_user.id)
+               for keyword in keywords[:POSITION_MAX_KEYWORDS]]
+    return jsonify({'success': True, 'tracked': [t.to_dict() for t in tracked]}), 201
+
+@app.route('/positions/tracked', methods=['GET'])
+@login_required
+def list_tracked_positions():
+    """Отслеживаемые тройки текущего пользователя с последней позицией"""
+    query = TrackedPosition.query.filter_by(user_id=current_user.id, active=True)
+    if request.args.get('nm_id'):
+        query = query.filter_by(nm_id=request.args['nm_id'])
+    if request.args.get('keyword'):
+        query = query.filter_by(keyword=request.args['keyword'])
+    tracked = query.order_by(TrackedPosition.nm_id, TrackedPosition.keyword).all()
+    return jsonify({
+        'tracked': [t.to_dict() for t in tracked],
+        'tracker': {'checks': rank_tracker.checks, 'rps': rank_tracker.limiter.rate,
+                    'last_run_at': rank_tracker.last_run_at.isoformat() if rank_tracker.last_run_at else None}
+    })
+
+@app.route('/positions/tracked/<int:tracked_id>', methods=['DELETE'])
+@login_required
+def untrack_position(tracked_id):
+    """Отключает проверку тройки; история сохраняется"""
+    tracked = db.session.get(TrackedPosition, tracked_id)
+    if not tracked or tracked.user_id != current_user.id:
+        return jsonify({'error': 'Не найдено'}), 404
+    tracked.active = False
+    db.session.commit()
+    return jsonify({'success': True})
+
+@app.route('/positions/tracked/<int:tracked_id>/history', methods=['GET'])
+@login_required
+def tracked_position_history(tracked_id):
+    """История позиций тройки за интервал since/until (ISO дата-время) с изменениями"""
+    tracked = db.session.get(TrackedPosition, tracked_id)
+    if not tracked or tracked.user_id != current_user.id:
+        return jsonify({'error': 'Не найдено'}), 404
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = datetime.fromisoformat(since) if since else None
+        until = datetime.fromisoformat(until) if until else None
+    except ValueError as e:
+        return jsonify({'error': f'Неверный формат параметров: {e}'}), 400
+    points, summary = rank_tracker.history(tracked_id, since, until)
+    return jsonify({'tracked': tracked.to_dict(), 'summary': summary, 'points': points})
+
 @app.route('/analyze-adrates', methods=['POST'])
 def analyze_adrates():
     """Endpoint для анализа рекламных ставок"""
     try:
         data = request.json
         query = data.get('query')
-        region = data.get('region', '-1114822')
+        regions = data.get('regions') or data.get('region', '-1114822')
+        pages = data.get('pages', 1)
         
         if not query:
             return jsonify({'error': 'Поисковый запрос не указан'}), 400
         
         parser = WildberriesParser()
-        results = parser.analyze_ad_rates(query, region)
+        started = time.time()
+        results = parser.analyze_ad_rates(query, regions, pages)
         
-        if not results:
-            return jsonify({'error': 'Не удалось получить данные о ставках. Попробуйте другой запрос.'}), 404
+        # regions заполнен всегда (по одной сводке на запрошенный регион), поэтому смотрим только на слоты
+        if not results['results']:
+            failed = any(summary.get('error') for summary in results['regions'].values()) or not results['regions']
+            return jsonify({
+                'error': (failed and results.get('reason')) or 'Не удалось получить данные о ставках. Попробуйте другой запрос.',
+                'regions': results['regions']
+            }), 404
         
-        # Если results — dict с results и reason, возвращаем их как есть
-        if isinstance(results, dict) and 'results' in results:
-            return jsonify({'success': True, 'results': results['results'], 'reason': results.get('reason')})
-        else:
-            return jsonify({'success': True, 'results': results})
+        return jsonify({
+            'success': True,
+            'results': results['results'],
+            'regions': results['regions'],
+            'articles': results['articles'],
+            'reason': results.get('reason'),
+            'elapsed_sec': round(time.time() - started, 2)
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1276,7 +4029,9 @@ def analyze_competitors():
             return jsonify({'error': 'Ссылка на товар не указана'}), 400
         
         parser = WildberriesParser()
-        results = parser.analyze_competitors(product_url)
+        results = parser.analyze_competitors(product_url, data.get('top_n'))
+        if 'error' in results:
+            return jsonify(results), 400
         
         return jsonify(results)
         
@@ -1301,6 +4056,43 @@ def analyze_seo():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/analyze-seo/bulk', methods=['POST'])
+def analyze_seo_bulk():
+    """Ставит SEO-анализ ассортимента продавца (seller_url) или списка артикулов (nm_ids) в очередь
+
+    Дополнительно: format (csv или xlsx), concurrency, browser_fallback
+    (искать описание в браузере, если JSON-источники его не дали).
+    """
+    data = request.get_json(silent=True) or {}
+    nm_ids = []
+    for item in data.get('nm_ids') or []:
+        match = re.search(r'(\d+)', str(item).split('/catalog/')[-1])
+        if match:
+            nm_ids.append(match.group(1))
+    nm_ids = list(dict.fromkeys(nm_ids))
+    if not data.get('seller_url') and not nm_ids:
+        return jsonify({'error': 'Укажите URL продавца или список артикулов'}), 400
+    # Проверяем здесь, а не в фоновой задаче
+    try:
+        concurrency = int(data['concurrency']) if data.get('concurrency') not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency должно быть целым числом'}), 400
+    if concurrency is not None and not 1 <= concurrency <= SEO_BULK_MAX_CONCURRENCY:
+        return jsonify({'error': f'concurrency должно быть от 1 до {SEO_BULK_MAX_CONCURRENCY}'}), 400
+    job = job_queue.submit('seo_bulk', run_seo_bulk_job, {
+        'seller_url': data.get('seller_url'),
+        'nm_ids': nm_ids,
+        'format': 'xlsx' if data.get('format') == 'xlsx' else 'csv',
+        'concurrency': concurrency,
+        'browser_fallback': bool(data.get('browser_fallback'))
+    })
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f'/jobs/{job.id}',
+        'result_url': f'/jobs/{job.id}/result'
+    }), 202
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
@@ -1331,7 +4123,7 @@ def wb_campaigns():
     last_error = None
     for url in urls:
         try:
-            r = requests.get(url, headers=headers, timeout=15)
+            r = http_client.get(url, headers=headers, timeout=15)
             if r.status_code == 404:
                 last_error = f'404 Not Found for {url}'
                 continue
@@ -1366,7 +4158,7 @@ def wb_campaign_rates():
         'X-Supplier-ID': getattr(current_user, 'supplier_id', '')
     }
     try:
-        r = requests.get(url, headers=headers, timeout=15)
+        r = http_client.get(url, headers=headers, timeout=15)
         r.raise_for_status()
         return jsonify(r.json())
     except Exception as e:
@@ -1393,7 +4185,7 @@ def wb_my_products():
         "filter": {}
     }
     try:
-        r = requests.post(url, headers=headers, json=body, timeout=20)
+        r = http_client.post(url, headers=headers, json=body, timeout=20)
         if r.status_code != 200:
             print(f"[WB PRODUCTS] Status: {r.status_code}, Response: {r.text}")
             return jsonify({'error': f'WB API status {r.status_code}: {r.text[:300]}'})
@@ -1439,7 +4231,7 @@ def wb_product_info():
     url = 'https://suppliers.wildberries.ru/content/v1/card/by-nm'
     body = {"nmID": int(nm_id)}
     try:
-        r = requests.post(url, headers=headers, json=body, timeout=15)
+        r = http_client.post(url, headers=headers, json=body, timeout=15)
         r.raise_for_status()
         data = r.json()
         prod = data.get('data', {})
@@ -1447,131 +4239,793 @@ def wb_product_info():
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении информации о товаре: {e}'}), 500
 
+# ===== Отзывы WB (feedbacks-api) =====
+WB_FEEDBACKS_URL = 'https://feedbacks-api.wildberries.ru/api/v1/feedbacks'
+WB_FEEDBACK_URL = 'https://feedbacks-api.wildberries.ru/api/v1/feedback'  # Один отзыв по id
+WB_FEEDBACKS_TAKE = min(int(os.getenv('WB_FEEDBACKS_TAKE', 1000)), 5000)  # Отзывов за запрос (WB допускает до 5000)
+WB_FEEDBACKS_MAX_SKIP = 199990  # Дальше WB не отдает
+WB_FEEDBACKS_RPS = float(os.getenv('WB_FEEDBACKS_RPS', 3))
+REVIEWS_PAGE_SIZE = 100
+REVIEWS_MAX_PAGE_SIZE = 1000
+REVIEWS_STREAM_BUFFER = 1000  # Отзывов в очереди между потоками загрузки и клиентом
+REVIEW_KINDS = ('new', 'answered')
+
+def feedback_to_dict(f):
+    if not isinstance(f, dict):
+        return {'raw': f}
+    product = f.get('productDetails', {})
+    # Собираем текст отзыва из text, pros, cons
+    text_parts = []
+    if f.get('pros'): text_parts.append(f.get('pros'))
+    if f.get('cons'): text_parts.append(f.get('cons'))
+    if f.get('text'): text_parts.append(f.get('text'))
+    text = '\n'.join([t for t in text_parts if t])
+    answer = f.get('answer', '')
+    if isinstance(answer, dict):
+        answer = answer.get('text', '')
+    return {
+        'id': f.get('id'),
+        'date': f.get('createdDate', '')[:10],
+        'createdDate': f.get('createdDate', ''),
+        'product': product.get('productName', product.get('nmId', '')),
+        'article': product.get('nmId', ''),
+        'stars': f.get('productValuation', ''),
+        'text': text,
+        'user': f.get('userName', ''),
+        'answer': answer
+    }
+
+def parse_wb_datetime(value):
+    """createdDate WB (ISO, обычно с Z) -> datetime в UTC без tzinfo"""
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_review_filters(args):
+    """Фильтры отзывов из query string: stars (5 или 4,5), nm_id, date_from, date_to (ISO, UTC)
+
+    date_to в виде даты без времени включает весь день. Даты со смещением
+    (+03:00, Z) переводятся в UTC без tzinfo, как createdDate в parse_wb_datetime.
+    Неверная дата — ValueError.
+    """
+    def parse_date(value):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    date_from = args.get('date_from')
+    date_to = args.get('date_to')
+    filters = {
+        'stars': {int(star) for star in re.findall(r'[1-5]', args.get('stars') or '')},
+        'nm_id': (args.get('nm_id') or '').strip() or None,
+        'date_from': parse_date(date_from) if date_from else None,
+        'date_to': parse_date(date_to) if date_to else None
+    }
+    if date_to and len(date_to) == 10:
+        filters['date_to'] += timedelta(days=1)
+    return filters
+
+def feedback_matches(f, filters):
+    if filters.get('stars') and f.get('productValuation') not in filters['stars']:
+        return False
+    if filters.get('nm_id') and str((f.get('productDetails') or {}).get('nmId', '')) != filters['nm_id']:
+        return False
+    if filters.get('date_from') or filters.get('date_to'):
+        created = parse_wb_datetime(f.get('createdDate', ''))
+        if not created:
+            return False
+        if filters.get('date_from') and created < filters['date_from']:
+            return False
+        if filters.get('date_to') and created >= filters['date_to']:
+            return False
+    return True
+
+def iter_wb_feedbacks(token, answered, skip=0, filters=None, take=WB_FEEDBACKS_TAKE, limiter=None,
+                      max_rate_limit_retries=5):
+    """Все отзывы одного вида (новые или отвеченные) постранично через skip/take
+
+    Отдает пары (skip следующего отзыва, отзыв WB) от новых к старым.
+    nm_id и даты передаются WB, чтобы не выкачивать лишнее; оценка
+    проверяется на нашей стороне в feedback_matches.
+    """
+    filters = filters or {}
+    limiter = limiter or AdaptiveRateLimiter(rate=WB_FEEDBACKS_RPS)
+    headers = {
+        'Authorization': token,
+        'Content-Type': 'application/json'
+    }
+    params = {'isAnswered': 'true' if answered else 'false', 'take': take, 'order': 'dateDesc'}
+    if filters.get('nm_id'):
+        params['nmId'] = filters['nm_id']
+    if filters.get('date_from'):
+        params['dateFrom'] = int(filters['date_from'].replace(tzinfo=timezone.utc).timestamp())
+    if filters.get('date_to'):
+        params['dateTo'] = int(filters['date_to'].replace(tzinfo=timezone.utc).timestamp())
+    while skip <= WB_FEEDBACKS_MAX_SKIP:
+        params['skip'] = skip
+        for attempt in range(max_rate_limit_retries + 1):
+            limiter.acquire()
+            r = http_client.get(WB_FEEDBACKS_URL, headers=headers, params=params, timeout=30)
+            if r.status_code == 429:
+                limiter.on_throttle()
+                continue
+            r.raise_for_status()
+            limiter.on_success()
+            break
+        else:
+            raise requests.exceptions.HTTPError(f'HTTP 429: отзывы, skip={skip}')
+        try:
+            data = r.json()
+        except ValueError:
+            raise ValueError(f'WB API вернул не JSON: {r.text[:300]}')
+        feedbacks = ((data.get('data') or {}).get('feedbacks') or []) if isinstance(data, dict) else []
+        for offset, f in enumerate(feedbacks, 1):
+            yield skip + offset, f
+        if len(feedbacks) < take:
+            return
+        skip += len(feedbacks)
+
+def fetch_wb_feedback(token, feedback_id, limiter=None, max_rate_limit_retries=5):
+    """Один отзыв WB по id в виде feedback_to_dict; None — отзыва больше нет (удален)"""
+    limiter = limiter or AdaptiveRateLimiter(rate=WB_FEEDBACKS_RPS)
+    headers = {
+        'Authorization': token,
+        'Content-Type': 'application/json'
+    }
+    for attempt in range(max_rate_limit_retries + 1):
+        limiter.acquire()
+        r = http_client.get(WB_FEEDBACK_URL, headers=headers, params={'id': feedback_id}, timeout=30)
+        if r.status_code == 429:
+            limiter.on_throttle()
+            continue
+        if r.status_code == 404:
+            limiter.on_success()
+            return None
+        r.raise_for_status()
+        limiter.on_success()
+        break
+    else:
+        raise requests.exceptions.HTTPError(f'HTTP 429: отзыв {feedback_id}')
+    try:
+        data = r.json()
+    except ValueError:
+        raise ValueError(f'WB API вернул не JSON: {r.text[:300]}')
+    feedback = data.get('data') if isinstance(data, dict) else None
+    if not isinstance(feedback, dict) or not feedback.get('id'):
+        return None
+    return feedback_to_dict(feedback)
+
+def collect_feedbacks_page(token, answered, skip, filters, limit, limiter=None):
+    """До limit подходящих отзывов начиная с skip: (отзывы, skip для следующей страницы или None)"""
+    items = []
+    feedbacks = iter_wb_feedbacks(token, answered, skip, filters,
+                                  take=min(WB_FEEDBACKS_TAKE, max(limit * 2, 100)), limiter=limiter)
+    try:
+        for next_skip, f in feedbacks:
+            if feedback_matches(f, filters):
+                items.append(feedback_to_dict(f))
+                if len(items) >= limit:
+                    return items, next_skip
+    finally:
+        feedbacks.close()
+    return items, None
+
+def iter_feedbacks_parallel(token, positions, filters, limiter=None, kind_filters=None):
+    """Отзывы нескольких видов по мере загрузки: каждый вид читается в своем потоке
+
+    positions — {'new': skip, 'answered': skip}; kind_filters — свои
+    фильтры для отдельных видов вместо filters. Отдает кортежи
+    (вид, skip, отзыв, ошибка): отзыв — для подходящих фильтрам, отзыв
+    None — вид закончился (skip None) или упал с ошибкой (skip — откуда
+    продолжить). Если потребитель остановился, потоки завершаются сами.
+    """
+    results = queue.Queue(maxsize=REVIEWS_STREAM_BUFFER)
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker(kind, skip):
+        position = skip
+        kind_filter = (kind_filters or {}).get(kind, filters)
+        feedbacks = iter_wb_feedbacks(token, kind == 'answered', skip, kind_filter, limiter=limiter)
+        try:
+            for position, f in feedbacks:
+                if stop.is_set():
+                    return
+                if feedback_matches(f, kind_filter) and not put((kind, position, feedback_to_dict(f), None)):
+                    return
+            put((kind, None, None, None))
+        except Exception as e:
+            put((kind, position, None, e))
+        finally:
+            feedbacks.close()
+
+    workers = [Thread(target=worker, args=(kind, skip), name=f'reviews-{kind}', daemon=True)
+               for kind, skip in positions.items() if skip is not None]
+    for thread in workers:
+        thread.start()
+    pending = len(workers)
+    try:
+        while pending:
+            item = results.get()
+            if item[2] is None:
+                pending -= 1
+            yield item
+    finally:
+        stop.set()
+
+def encode_reviews_cursor(positions):
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode().rstrip('=')
+
+def decode_reviews_cursor(cursor):
+    """Курсор следующей страницы -> {'new': позиция, 'answered': позиция}
+
+    Позиция — skip в WB (int), ключ [createdDate, id] последнего отзыва
+    страницы локальной копии или None, если отзывы этого вида закончились.
+    """
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('Неверный курсор')
+
+    def valid(value):
+        # bool — подкласс int: {"new": true} не должен дойти до WB как skip=True
+        if value is None or (isinstance(value, int) and not isinstance(value, bool) and value >= 0):
+            return True
+        return (isinstance(value, list) and len(value) == 2 and all(isinstance(v, str) for v in value)
+                and parse_wb_datetime(value[0]) is not None)
+
+    if not isinstance(positions, dict) or not set(positions) <= set(REVIEW_KINDS) \
+            or not all(valid(v) for v in positions.values()):
+        raise ValueError('Неверный курсор')
+    return positions
+
+# ===== Локальная копия отзывов =====
+REVIEW_SYNC_ENABLED = os.getenv('REVIEW_SYNC_ENABLED', '1') == '1'
+REVIEW_SYNC_INTERVAL_MINUTES = int(os.getenv('REVIEW_SYNC_INTERVAL_MINUTES', 15))
+REVIEW_FULL_SYNC_HOURS = int(os.getenv('REVIEW_FULL_SYNC_HOURS', 24))
+# Сколько пропавших из списка неотвеченных отзывов перепроверять по одному за синхронизацию
+REVIEW_RECHECK_MAX = int(os.getenv('REVIEW_RECHECK_MAX', 200))
+REVIEW_SYNC_OVERLAP = timedelta(minutes=10)
+REVIEW_SYNC_WORKERS = int(os.getenv('REVIEW_SYNC_WORKERS', 2))
+REVIEW_SYNC_BATCH = 500
+REVIEW_SYNC_POLL_SECONDS = 60
+
+class Review(db.Model):
+    """Отзыв WB в локальной копии (запись feedback_to_dict и поля для фильтров)"""
+    id = db.Column(db.String(64), primary_key=True)  # id отзыва WB
+    supplier_id = db.Column(db.String(32), nullable=False)
+    nm_id = db.Column(db.String(32))
+    stars = db.Column(db.SmallInteger)
+    is_answered = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime)  # createdDate в UTC
+    data = db.Column(db.Text, nullable=False)  # JSON feedback_to_dict
+    synced_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.Index('ix_review_supplier_answered_created', 'supplier_id', 'is_answered', 'created_at'),
+        db.Index('ix_review_supplier_nm', 'supplier_id', 'nm_id'),
+    )
+
+class ReviewSyncState(db.Model):
+    """Состояние синхронизации отзывов продавца"""
+    supplier_id = db.Column(db.String(32), primary_key=True)
+    last_created_at = db.Column(db.DateTime)  # самый новый createdDate в копии (UTC)
+    synced_at = db.Column(db.DateTime)
+    full_synced_at = db.Column(db.DateTime)
+    next_sync_at = db.Column(db.DateTime)
+    reviews_count = db.Column(db.Integer, default=0)
+    stats = db.Column(db.Text)  # JSON статистики последней синхронизации
+    error = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            'supplier_id': self.supplier_id,
+            'last_created_at': self.last_created_at.isoformat() if self.last_created_at else None,
+            'synced_at': self.synced_at.isoformat() if self.synced_at else None,
+            'full_synced_at': self.full_synced_at.isoformat() if self.full_synced_at else None,
+            'next_sync_at': self.next_sync_at.isoformat() if self.next_sync_at else None,
+            'reviews_count': self.reviews_count,
+            'stats': json.loads(self.stats) if self.stats else None,
+            'error': self.error
+        }
+
+class ReviewMirror:
+    """Локальная копия отзывов WB по продавцам (supplier_id) с инкрементальной синхронизацией
+
+    Первая синхронизация и затем раз в REVIEW_FULL_SYNC_HOURS выкачивают
+    все отзывы; отзывы, которых в полной выгрузке не оказалось, удаляются
+    из копии. Между ними запрашиваются весь список неотвеченных (он
+    небольшой) и отвеченные новее последнего увиденного createdDate (с
+    перекрытием REVIEW_SYNC_OVERLAP). Фильтра по дате ответа у WB нет,
+    поэтому ответы, данные в кабинете WB, находятся по разнице: отзыв,
+    пропавший из списка неотвеченных, перечитывается по id — он либо
+    отвечен, либо удален. Ответы, отправленные через приложение,
+    отмечаются в копии сразу (mark_answered). Вкладка «Отзывы» читает
+    список из локальной таблицы.
+    """
+    def __init__(self, workers=REVIEW_SYNC_WORKERS):
+        self.workers = max(1, workers)
+        self.syncs = 0
+        self.last_run_at = None
+        self._locks = {}
+        self._locks_lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _supplier_lock(self, supplier_id):
+        with self._locks_lock:
+            return self._locks.setdefault(str(supplier_id), Lock())
+
+    def state(self, supplier_id):
+        return db.session.get(ReviewSyncState, str(supplier_id))
+
+    def is_ready(self, supplier_id):
+        """Копия продавца хотя бы раз синхронизирована полностью"""
+        state = self.state(supplier_id)
+        return bool(state and state.full_synced_at)
+
+    def sync(self, supplier_id, token, full=None):
+        """Синхронизирует копию продавца и возвращает статистику; одновременная синхронизация того же продавца ждет текущую
+
+        full=None — по расписанию (полная, если копии нет или она устарела),
+        True — полная, False — только инкрементальная: полная выкачивает все
+        отзывы и может идти минутами, поэтому из запросов пользователя ее
+        запускают только в фоне (sync_in_background). Инкрементальная без
+        полной копии невозможна — ValueError.
+        """
+        with self._supplier_lock(supplier_id):
+            return self._sync(str(supplier_id), token, full)
+
+    def sync_in_background(self, supplier_id, token, full=None):
+        """Запускает синхронизацию в отдельном потоке, если продавец сейчас не синхронизируется"""
+        lock = self._supplier_lock(supplier_id)
+
+        def run():
+            if not lock.acquire(blocking=False):
+                return
+            try:
+                with app.app_context():
+                    self._sync(str(supplier_id), token, full)
+            except Exception as e:
+                print(f"[REVIEWS] Ошибка синхронизации отзывов продавца {supplier_id}: {e}")
+            finally:
+                lock.release()
+
+        Thread(target=run, name=f'reviews-sync-{supplier_id}', daemon=True).start()
+
+    def _sync(self, supplier_id, token, full):
+        state = self.state(supplier_id)
+        if state is None:
+            state = ReviewSyncState(supplier_id=supplier_id)
+            db.session.add(state)
+        started_at = datetime.now()
+        utc_now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if full is None:
+            full = (not state.full_synced_at
+                    or started_at - state.full_synced_at >= timedelta(hours=REVIEW_FULL_SYNC_HOURS))
+        elif not full and not state.full_synced_at:
+            db.session.rollback()
+            raise ValueError('Копия отзывов еще не синхронизирована полностью')
+        kind_filters = None
+        if not full:
+            # Без единого отзыва в копии отсчитываем от времени последней полной синхронизации (в UTC)
+            new_since = (state.last_created_at or utc_now - (started_at - state.full_synced_at)) - REVIEW_SYNC_OVERLAP
+            kind_filters = {'new': {}, 'answered': {'date_from': new_since}}
+        stats = {'full': full, 'fetched': 0, 'inserted': 0, 'updated': 0, 'rechecked': 0, 'deleted': 0,
+                 'errors': {}}
+        counts = dict.fromkeys(REVIEW_KINDS, 0)
+        newest = None
+        batch = []
+        limiter = AdaptiveRateLimiter(rate=WB_FEEDBACKS_RPS)
+        for kind, position, review, error in iter_feedbacks_parallel(
+                token, {kind: 0 for kind in REVIEW_KINDS}, {}, limiter, kind_filters):
+            if error is not None:
+                stats['errors'][kind] = str(error)
+            if review is None:
+                continue
+            counts[kind] += 1
+            batch.append((kind, review))
+            if len(batch) >= REVIEW_SYNC_BATCH:
+                newest = max(filter(None, [newest, self._save(supplier_id, batch, stats, started_at)]), default=None)
+                batch = []
+        newest = max(filter(None, [newest, self._save(supplier_id, batch, stats, started_at)]), default=None)
+        # Дальше WB_FEEDBACKS_MAX_SKIP список не отдается: выгрузка вида могла оборваться без ошибки
+        complete = {kind: kind not in stats['errors'] and counts[kind] < WB_FEEDBACKS_MAX_SKIP
+                    for kind in REVIEW_KINDS}
+        if full and all(complete.values()):
+            stats['deleted'] += (Review.query
+                                 .filter(Review.supplier_id == supplier_id, Review.synced_at < started_at)
+                                 .delete(synchronize_session=False))
+            db.session.commit()
+        elif not full and complete['new']:
+            self._recheck(supplier_id, token, stats, started_at, limiter)
+
+        finished_at = datetime.now()
+        state.synced_at = finished_at
+        state.next_sync_at = finished_at + timedelta(minutes=REVIEW_SYNC_INTERVAL_MINUTES)
+        state.reviews_count = Review.query.filter_by(supplier_id=supplier_id).count()
+        stats['elapsed_sec'] = round((finished_at - started_at).total_seconds(), 1)
+        state.stats = json.dumps(stats, ensure_ascii=False)
+        if stats['errors']:
+            # Отзывы идут от новых к старым: при обрыве отметку не сдвигаем, чтобы не потерять пропущенные
+            state.error = '; '.join(f'{kind}: {error}' for kind, error in stats['errors'].items())
+        else:
+            state.error = None
+            state.last_created_at = max(filter(None, [state.last_created_at, newest]), default=None)
+            if full:
+                state.full_synced_at = finished_at
+        db.session.commit()
+        self.syncs += 1
+        print(f"[REVIEWS] Продавец {supplier_id}: {'полная' if full else 'инкрементальная'} синхронизация, "
+              f"получено {stats['fetched']}, новых {stats['inserted']}, изменено {stats['updated']}, "
+              f"перепроверено {stats['rechecked']}, удалено {stats['deleted']}"
+              f"{', ошибки: ' + state.error if state.error else ''}")
+        return stats
+
+    def _recheck(self, supplier_id, token, stats, started_at, limiter):
+        """Перечитывает по id неотвеченные отзывы, которых не было в полном списке неотвеченных
+
+        Такой отзыв ответили (в том числе в кабинете WB) или удалили. За раз
+        проверяется не больше REVIEW_RECHECK_MAX самых давно проверенных;
+        остальные дождутся следующей синхронизации. Ошибки отдельных отзывов
+        не останавливают синхронизацию и считаются в stats['recheck_errors'].
+        """
+        rows = (Review.query
+                .filter(Review.supplier_id == supplier_id, Review.is_answered.is_(False),
+                        Review.synced_at < started_at)
+                .order_by(Review.synced_at)
+                .limit(REVIEW_RECHECK_MAX)
+                .all())
+        for row in rows:
+            try:
+                review = fetch_wb_feedback(token, row.id, limiter)
+            except Exception as e:
+                stats['recheck_errors'] = stats.get('recheck_errors', 0) + 1
+                print(f"[REVIEWS] Не удалось перепроверить отзыв {row.id}: {e}")
+                # Чтобы один сбойный отзыв не занимал очередь проверки
+                row.synced_at = datetime.now()
+                db.session.commit()
+                continue
+            stats['rechecked'] += 1
+            if review is None:
+                db.session.delete(row)
+                db.session.commit()
+                stats['deleted'] += 1
+                continue
+            self._save(supplier_id, [('answered' if review.get('answer') else 'new', review)], stats, started_at)
+
+    def _save(self, supplier_id, batch, stats, started_at):
+        """Добавляет и обновляет отзывы пачки; возвращает самый поздний createdDate в ней"""
+        if not batch:
+            return None
+        ids = list({str(review['id']) for _, review in batch if review.get('id')})
+        existing = {row.id: row for row in Review.query.filter(Review.id.in_(ids))}
+        synced_at = datetime.now()
+        # Отзыв без разбираемого createdDate сортируется по времени получения (UTC, как createdDate),
+        # чтобы постраничный ключ [createdDate, id] всегда был заполнен
+        received_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        newest = None
+        for kind, review in batch:
+            review_id = str(review.get('id') or '')
+            if not review_id:
+                continue
+            stats['fetched'] += 1
+            answered = kind == 'answered'
+            created_at = parse_wb_datetime(review.get('createdDate', ''))
+            if created_at and (newest is None or created_at > newest):
+                newest = created_at
+            data = json.dumps(review, ensure_ascii=False)
+            row = existing.get(review_id)
+            if row is None:
+                row = Review(id=review_id, supplier_id=supplier_id, is_answered=answered, data=data,
+                             nm_id=str(review.get('article') or '') or None,
+                             stars=review['stars'] if isinstance(review.get('stars'), int) else None,
+                             created_at=created_at or received_at, synced_at=synced_at)
+                db.session.add(row)
+                existing[review_id] = row
+                stats['inserted'] += 1
+                continue
+            if row.is_answered and not answered and row.synced_at >= started_at:
+                # Отзыв ответили во время синхронизации и он попал в оба списка
+                continue
+            if created_at and row.created_at != created_at:
+                row.created_at = created_at
+            if row.data != data or row.is_answered != answered:
+                row.data = data
+                row.is_answered = answered
+                row.stars = review['stars'] if isinstance(review.get('stars'), int) else row.stars
+                stats['updated'] += 1
+            row.synced_at = synced_at
+        db.session.commit()
+        return newest
+
+    def mark_answered(self, supplier_id, feedback_id, text):
+        """Отмечает отзыв отвеченным сразу после отправки ответа, не дожидаясь синхронизации"""
+        row = db.session.get(Review, str(feedback_id))
+        if row is None or row.supplier_id != str(supplier_id):
+            return False
+        data = json.loads(row.data)
+        data['answer'] = text
+        row.data = json.dumps(data, ensure_ascii=False)
+        row.is_answered = True
+        # Синхронизация, идущая сейчас, не должна вернуть отзыв в неотвеченные или удалить его
+        row.synced_at = datetime.now()
+        db.session.commit()
+        return True
+
+    def query(self, supplier_id, filters, kind, limit, after=None):
+        """Страница отзывов вида kind из копии, от новых к старым
+
+        after — ключ [createdDate, id] последнего отзыва предыдущей страницы.
+        Возвращает (отзывы, ключ для следующей страницы или None).
+        """
+        query = Review.query.filter(Review.supplier_id == str(supplier_id),
+                                    Review.is_answered.is_(kind == 'answered'))
+        if filters.get('stars'):
+            query = query.filter(Review.stars.in_(sorted(filters['stars'])))
+        if filters.get('nm_id'):
+            query = query.filter(Review.nm_id == filters['nm_id'])
+        if filters.get('date_from'):
+            query = query.filter(Review.created_at >= filters['date_from'])
+        if filters.get('date_to'):
+            query = query.filter(Review.created_at < filters['date_to'])
+        if after:
+            created_at = parse_wb_datetime(after[0])
+            query = query.filter(db.or_(Review.created_at < created_at,
+                                        db.and_(Review.created_at == created_at, Review.id < after[1])))
+        rows = (query.order_by(Review.created_at.desc(), Review.id.desc())
+                .with_entities(Review.id, Review.created_at, Review.data)
+                .limit(limit + 1)
+                .all())
+        reviews = [json.loads(data) for _, _, data in rows[:limit]]
+        if len(rows) <= limit:
+            return reviews, None
+        last_id, last_created_at, _ = rows[limit - 1]
+        return reviews, [last_created_at.isoformat(), last_id]
+
+    def run_due(self):
+        """Синхронизирует продавцов, у которых подошло время; возвращает число синхронизаций"""
+        now = datetime.now()
+        tokens = {}
+        for supplier_id, token in (User.query
+                                   .filter(User.wb_token.isnot(None), User.wb_token != '',
+                                           User.supplier_id.isnot(None), User.supplier_id != '')
+                                   .with_entities(User.supplier_id, User.wb_token)):
+            tokens.setdefault(str(supplier_id), token)
+        if not tokens:
+            return 0
+        states = {s.supplier_id: s for s in ReviewSyncState.query.filter(ReviewSyncState.supplier_id.in_(list(tokens)))}
+        due = []
+        for supplier_id in tokens:
+            state = states.get(supplier_id)
+            if state is None:
+                db.session.add(ReviewSyncState(supplier_id=supplier_id, next_sync_at=now))
+                due.append(supplier_id)
+                continue
+            if state.next_sync_at and state.next_sync_at > now:
+                continue
+            # Захват: несколько процессов не синхронизируют одного продавца одновременно
+            claimed = (ReviewSyncState.query
+                       .filter_by(supplier_id=supplier_id, next_sync_at=state.next_sync_at)
+                       .update({'next_sync_at': now + timedelta(minutes=REVIEW_SYNC_INTERVAL_MINUTES)},
+                               synchronize_session=False))
+            if claimed == 1:
+                due.append(supplier_id)
+        try:
+            db.session.commit()
+        except Exception:
+            # Новое состояние уже добавил другой процесс
+            db.session.rollback()
+            return 0
+        if not due:
+            return 0
+
+        def run(supplier_id):
+            with app.app_context():
+                return self.sync(supplier_id, tokens[supplier_id])
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(due)), thread_name_prefix='reviews-sync') as executor:
+            futures = {executor.submit(run, supplier_id): supplier_id for supplier_id in due}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                except Exception as e:
+                    print(f"[REVIEWS] Ошибка синхронизации отзывов продавца {futures[future]}: {e}")
+        self.last_run_at = datetime.now()
+        return done
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    self.run_due()
+            except Exception as e:
+                print(f"[REVIEWS] Ошибка планировщика синхронизации отзывов: {e}")
+                import traceback
+                traceback.print_exc()
+            self._stop.wait(REVIEW_SYNC_POLL_SECONDS)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, name='review-sync', daemon=True)
+        self._thread.start()
+        print(f"[REVIEWS] Синхронизация отзывов запущена (раз в {REVIEW_SYNC_INTERVAL_MINUTES} мин)")
+
+    def stop(self):
+        self._stop.set()
+
+review_mirror = ReviewMirror()
+
 @app.route('/wb-reviews', methods=['GET'])
 @login_required
 def wb_reviews():
-    """Получить отзывы пользователя с фильтрами по звёздам и разбиением на новые/отвеченные"""
+    """Отзывы пользователя: новые и отвеченные, с фильтрами и постраничной выдачей
+
+    Параметры: stars (5 или 4,5), nm_id, date_from, date_to (ISO дата),
+    status (new, answered или all), limit (отзывов каждого вида на
+    странице), cursor (next_cursor предыдущей страницы).
+
+    Список читается из локальной копии (review_mirror); refresh=1 перед
+    этим догружает новые отзывы. Пока копия продавца не собрана, отзывы
+    запрашиваются у WB напрямую (как и при source=wb), а синхронизация
+    запускается в фоне. stream=1 отдает все подходящие отзывы из WB
+    построчно (NDJSON) по мере загрузки. Новые и отвеченные отзывы
+    загружаются из WB параллельно.
+    """
     token = getattr(current_user, 'wb_token', None)
     supplier_id = getattr(current_user, 'supplier_id', None)
     if not token:
         return jsonify({'error': 'Токен WB не найден в профиле пользователя'}), 403
     if not supplier_id:
         return jsonify({'error': 'Supplier ID не найден в профиле пользователя'}), 403
-    stars = request.args.get('stars', '')
+    try:
+        filters = parse_review_filters(request.args)
+        cursor = request.args.get('cursor')
+        if cursor:
+            positions = decode_reviews_cursor(cursor)
+        else:
+            status = request.args.get('status', 'all')
+            positions = {kind: 0 for kind in REVIEW_KINDS if status in ('all', kind)}
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры: {e}'}), 400
+    debug_token = f'{token[:6]}...{token[-4:]}'
+    stream = request.args.get('stream') in ('1', 'true')
+    limit = max(1, min(request.args.get('limit', REVIEWS_PAGE_SIZE, type=int), REVIEWS_MAX_PAGE_SIZE))
+
+    local_cursor = any(isinstance(v, list) for v in positions.values())
+    wb_cursor = any(isinstance(v, int) and v > 0 for v in positions.values())
+    if not stream and (local_cursor or (not wb_cursor and request.args.get('source') != 'wb')):
+        if local_cursor or review_mirror.is_ready(supplier_id):
+            if request.args.get('refresh') in ('1', 'true') and not local_cursor:
+                review_mirror.sync(supplier_id, token, full=False)
+            result = {'new': [], 'answered': []}
+            next_positions = {}
+            for kind, position in positions.items():
+                if position is not None:
+                    result[kind], next_positions[kind] = review_mirror.query(
+                        supplier_id, filters, kind, limit, position if isinstance(position, list) else None)
+            state = review_mirror.state(supplier_id)
+            has_more = any(position is not None for position in next_positions.values())
+            result.update({
+                'limit': limit,
+                'next_cursor': encode_reviews_cursor(next_positions) if has_more else None,
+                'source': 'local',
+                'synced_at': state.synced_at.isoformat() if state and state.synced_at else None,
+                'debug_token': debug_token
+            })
+            return jsonify(result)
+        review_mirror.sync_in_background(supplier_id, token)
+
+    limiter = AdaptiveRateLimiter(rate=WB_FEEDBACKS_RPS)
+    if stream:
+        def generate():
+            counts = {kind: 0 for kind in positions}
+            resume = {}
+            errors = {}
+            for kind, position, review, error in iter_feedbacks_parallel(token, positions, filters, limiter):
+                if review is not None:
+                    counts[kind] += 1
+                    review['status'] = kind
+                    yield json.dumps(review, ensure_ascii=False) + '\n'
+                elif error is not None:
+                    errors[kind] = str(error)
+                    resume[kind] = position
+            yield json.dumps({
+                'done': True,
+                'counts': counts,
+                'errors': errors,
+                'next_cursor': encode_reviews_cursor(resume) if resume else None
+            }, ensure_ascii=False) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    with ThreadPoolExecutor(max_workers=len(REVIEW_KINDS), thread_name_prefix='reviews') as executor:
+        futures = {kind: executor.submit(collect_feedbacks_page, token, kind == 'answered', skip, filters, limit, limiter)
+                   for kind, skip in positions.items() if skip is not None}
+    result = {'new': [], 'answered': []}
+    next_positions = {}
+    for kind, future in futures.items():
+        try:
+            result[kind], next_positions[kind] = future.result()
+        except Exception as e:
+            label = 'отвеченных' if kind == 'answered' else 'новых'
+            print(f"[WB REVIEWS] Ошибка при получении {label} отзывов: {e}")
+            return jsonify({'error': f'Ошибка при получении {label} отзывов: {e}', 'debug_token': debug_token}), 502
+    has_more = any(skip is not None for skip in next_positions.values())
+    result.update({
+        'limit': limit,
+        'next_cursor': encode_reviews_cursor(next_positions) if has_more else None,
+        'source': 'wb',
+        'debug_token': debug_token
+    })
+    return jsonify(result)
+
+@app.route('/wb-reviews/sync', methods=['GET', 'POST'])
+@login_required
+def wb_reviews_sync():
+    """Состояние локальной копии отзывов (GET) или синхронизация (POST)
+
+    POST догружает новые отзывы сразу (инкрементально). Полная синхронизация
+    (full=true или копии еще нет) запускается в фоне — ответ 202, ход виден
+    в GET.
+    """
+    token = getattr(current_user, 'wb_token', None)
+    supplier_id = getattr(current_user, 'supplier_id', None)
+    if not token or not supplier_id:
+        return jsonify({'error': 'Токен WB или Supplier ID не найден в профиле пользователя'}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if data.get('full') or not review_mirror.is_ready(supplier_id):
+            review_mirror.sync_in_background(supplier_id, token, full=True)
+            state = review_mirror.state(supplier_id)
+            return jsonify({'success': True, 'scheduled': 'full', 'state': state.to_dict() if state else None}), 202
+        stats = review_mirror.sync(supplier_id, token, full=False)
+        state = review_mirror.state(supplier_id)
+        return jsonify({'success': not stats['errors'], 'stats': stats, 'state': state.to_dict()})
+    state = review_mirror.state(supplier_id)
+    return jsonify({'state': state.to_dict() if state else None, 'ready': bool(state and state.full_synced_at)})
+
+def post_review_answer(token, feedback_id, text, limiter=None, max_rate_limit_retries=3):
+    """Отправляет ответ на отзыв в WB; возвращает None или текст ошибки"""
     headers = {
-        'Authorization': token,
+        'Authorization': f'Bearer {token}',
         'Content-Type': 'application/json'
     }
-    url = 'https://feedbacks-api.wildberries.ru/api/v1/feedbacks'
-    params = {
-        'isAnswered': 'false',
-        'take': 100,
-        'skip': 0
+    body = {
+        'id': feedback_id,
+        'text': text
     }
-    if stars:
-        params['rating'] = stars
-    # Получаем новые отзывы
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=15)
-        r.raise_for_status()
-        try:
-            data = r.json()
-            new_feedbacks = data.get('data', {}).get('feedbacks', [])
-        except Exception:
-            # Если не JSON, возвращаем текст
-            return jsonify({
-                'error': 'WB API вернул не JSON',
-                'debug_raw_response': r.text,
-                'debug_token': f'{token[:6]}...{token[-4:]}' if token else None,
-                'debug_request': {
-                    'url': url,
-                    'headers': headers,
-                    'params': params,
-                    'supplier_id': supplier_id,
-                    'authorization': token
-                }
-            }), 500
-    except Exception as e:
-        return jsonify({
-            'error': f'Ошибка при получении новых отзывов: {e}',
-            'debug_token': f'{token[:6]}...{token[-4:]}' if token else None,
-            'debug_request': {
-                'url': url,
-                'headers': headers,
-                'params': params,
-                'supplier_id': supplier_id,
-                'authorization': token
-            }
-        }), 500
-    # Получаем отвеченные отзывы
-    params['isAnswered'] = 'true'
-    try:
-        r = requests.get(url, headers=headers, params=params, timeout=15)
-        r.raise_for_status()
-        try:
-            data = r.json()
-            answered_feedbacks = data.get('data', {}).get('feedbacks', [])
-        except Exception:
-            return jsonify({
-                'error': 'WB API вернул не JSON',
-                'debug_raw_response': r.text,
-                'debug_token': f'{token[:6]}...{token[-4:]}' if token else None,
-                'debug_request': {
-                    'url': url,
-                    'headers': headers,
-                    'params': params,
-                    'supplier_id': supplier_id,
-                    'authorization': token
-                }
-            }), 500
+        for attempt in range(max_rate_limit_retries + 1):
+            if limiter:
+                limiter.acquire()
+            r = http_client.post(f'{WB_FEEDBACKS_URL}/answer', headers=headers, json=body, timeout=15)
+            if r.status_code == 429 and limiter:
+                limiter.on_throttle()
+                continue
+            break
     except Exception as e:
-        return jsonify({
-            'error': f'Ошибка при получении отвеченных отзывов: {e}',
-            'debug_token': f'{token[:6]}...{token[-4:]}' if token else None,
-            'debug_request': {
-                'url': url,
-                'headers': headers,
-                'params': params,
-                'supplier_id': supplier_id,
-                'authorization': token
-            }
-        }), 500
-    def feedback_to_dict(f):
-        if not isinstance(f, dict):
-            return {'raw': f}
-        product = f.get('productDetails', {})
-        # Собираем текст отзыва из text, pros, cons
-        text_parts = []
-        if f.get('pros'): text_parts.append(f.get('pros'))
-        if f.get('cons'): text_parts.append(f.get('cons'))
-        if f.get('text'): text_parts.append(f.get('text'))
-        text = '\n'.join([t for t in text_parts if t])
-        answer = f.get('answer', '')
-        if isinstance(answer, dict):
-            answer = answer.get('text', '')
-        return {
-            'id': f.get('id'),
-            'date': f.get('createdDate', '')[:10],
-            'createdDate': f.get('createdDate', ''),
-            'product': product.get('productName', product.get('nmId', '')),
-            'article': product.get('nmId', ''),
-            'stars': f.get('productValuation', ''),
-            'text': text,
-            'user': f.get('userName', ''),
-            'answer': answer
-        }
-    return jsonify({
-        'new': [feedback_to_dict(f) for f in new_feedbacks],
-        'answered': [feedback_to_dict(f) for f in answered_feedbacks],
-        'debug_token': f'{token[:6]}...{token[-4:]}' if token else None,
-        'debug_request': {
-            'url': url,
-            'headers': headers,
-            'params': params,
-            'supplier_id': supplier_id,
-            'authorization': token
-        }
-    })
+        return f'Ошибка при отправке ответа: {e}'
+    if r.status_code in (200, 204):
+        if limiter:
+            limiter.on_success()
+        return None
+    return f'Ошибка WB API: {r.status_code} {r.text}'
 
 @app.route('/wb-reply-review', methods=['POST'])
 @login_required
@@ -1588,27 +5042,183 @@ def wb_reply_review():
     text = data.get('text')
     if not feedback_id or not text:
         return jsonify({'error': 'Не все параметры указаны'}), 400
-    url = 'https://feedbacks-api.wildberries.ru/api/v1/feedbacks/answer'
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-    body = {
-        'id': feedback_id,
-        'text': text
-    }
-    try:
-        r = requests.post(url, headers=headers, json=body, timeout=15)
-        if r.status_code in (200, 204):
-            return jsonify({'success': True})
-        else:
-            return jsonify({'error': f'Ошибка WB API: {r.status_code} {r.text}'})
-    except Exception as e:
-        return jsonify({'error': f'Ошибка при отправке ответа: {e}'})
+    error = post_review_answer(token, feedback_id, text)
+    if error:
+        return jsonify({'error': error})
+    review_mirror.mark_answered(supplier_id, feedback_id, text)
+    return jsonify({'success': True})
 
 DEFAULT_AI_TOKEN = os.getenv('OPENAI_API_KEY')
 DEFAULT_AI_PROMPT = '''Ты проффесиональный менеджер маркетплейсов.Ты девушка. Сотрудник компании. У тебя стаж работы менеджера маркетплейсов 10 лет и еще 10 лет ты работала инженером-разработчиком. Твоя задача на текущем месте работы: Клиент оставляют отзывы на площадке Вайлдбериз, а ты должна на них отвечать. Отвечать максимально сдержанно, благодарно, вежлево, по делу, умно, доброжелательно, проффесионально. \n\nПожалуйста, сгенерируй вежливый и благодарственный ответ клиенту.  В ответ вставь название товара. Для того, чтоб наш товар чаще мелькал и прокачивался по сео. Но помни ты именно отвечаешь на отзыв, так что дабавь только готовый ответ. Я ничего корректировать не буду. Не нужно писать название компании или мое имя. Название товара не выделяй в ковычки. Также удаляй из названий товаров ковычки, если они будут и такой знак "\\" и меняй его на пробел и один знак ковычик такой ", без закрывающих ковычик и даже одинарные ковычи, тоже меняй на пробел. Отзывы не нужно делать абсолютно стандартными. Чуть добавь креатива. Также не нужно делать переход на другую строку, после приветствия. Должно оставаться ощущение, что пишет их именно человек. И важный момент: Если есть возможность, то нужно стараться написать такой ответ, что мы не виноваты и что мы во всем разберемся. Если клиент говорит про брак, то нужно просит вернуть товар по браку, чтоб мы отправили на экспертизу и попробовали разобраться. Если и мы виноваты то нужно говорить, что это не мы, а как бы это форс-мажор или как то так. Ну и конечно не нужно обвинять клиента. \n\nЕсли какие либо данные отсутствуют. Напиример отсутствует коментарий и недостатки, а толко стоит оценка. То нужно это учесть. Например максимальная оценка это 5. Если клиент просто поставил 5, то нужно его поблагодарить. Если 4, то поблагодорить и узнать в чем недостаток. Если 3, то тоже попросить уточнить в чем проблема, чтоб мы могли стать лучше и так далее.\n\nНе забывай обращать внимание на сегмент, чтоб понять лучше о чем речь. Но сам сегмент не обязательно указывать в отзывах. Это на твое усмотрение. Под сегментом я имею ввиду название категорий товаров. Если клиент поставил 5 и не оставил коментариев, то не нужно просить его написать что то. Нужно поблагодарить за пятерку.\n\n#Примеры нетривиальных отзывов и ответов:\n1. \nОтзыв:\nДостоинства: Заказывали метровую трубу, пришла с задержкой и 20 см. Отказ. ( и поставил оценку 1)\nОтвет:\nЗдравствуйте!\nВ ассортименте нашего магазина отсутствуют дымоходы длиной 20 см.\nТакже, согласно информации из карточки товара, к которой вы оставили отзыв, вами был заказан дымоход длиной 0,5 метра, а не 1 метр.\nЕсли вы считаете, что получили товар, не соответствующий заказу, просим в следующий раз оформить заявку на возврат и приложить фотографии самого изделия и штрихкода с упаковки. В случае, если товар действительно приобретён у нас, возврат будет одобрен.\nБлагодарим за понимание!\n\n#\n\nТакже мы не отвечаем за транспортировку. Ее выполняют другие компании. Мы стараемся упаковать товар так, чтоб максимально обезопасить от любых повреждений. Но все равно компании при доставке могут испортить товар. Добавь креативности +200 на отзывы с высокой оценкой.'''
 
+REVIEW_REPLY_MODEL = os.getenv('REVIEW_REPLY_MODEL', 'gpt-4o')
+REVIEW_REPLY_MAX_TOKENS = 400
+REVIEW_REPLY_TEMPERATURE = 0.9
+# Пакетная генерация: одновременных запросов к OpenAI и отзывов за запрос
+REVIEW_REPLY_CONCURRENCY = int(os.getenv('REVIEW_REPLY_CONCURRENCY', 8))
+REVIEW_REPLY_MAX_CONCURRENCY = 16
+REVIEW_REPLY_BULK_MAX = int(os.getenv('REVIEW_REPLY_BULK_MAX', 500))
+USAGE_FIELDS = ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens')
+# Кэш ответов на тривиальные отзывы (высокая оценка без текста или пара слов)
+REPLY_CACHE_VARIANTS = int(os.getenv('REPLY_CACHE_VARIANTS', 5))  # 0 — кэш выключен
+REPLY_CACHE_MIN_STARS = int(os.getenv('REPLY_CACHE_MIN_STARS', 5))
+REPLY_CACHE_TRIVIAL_CHARS = int(os.getenv('REPLY_CACHE_TRIVIAL_CHARS', 20))
+REPLY_CACHE_TTL = int(os.getenv('REPLY_CACHE_TTL', 7 * 24 * 3600))
+REPLY_CACHE_SIZE = int(os.getenv('REPLY_CACHE_SIZE', 10000))
+
+class ReviewReplyCache:
+    """Готовые ответы на тривиальные отзывы
+
+    Тривиальный отзыв — оценка не ниже REPLY_CACHE_MIN_STARS и текст не
+    длиннее REPLY_CACHE_TRIVIAL_CHARS («Отлично», «все супер»): короткая
+    жалоба на низкую оценку («не тот размер») требует ответа по существу.
+    Ключ — хеш промта, товар, оценка и нормализованный текст отзыва. На
+    ключ копится до REPLY_CACHE_VARIANTS сгенерированных ответов; когда
+    они набраны (или все недостающие уже генерируются), ответ берется из
+    них по кругу — одинаковые пятерки без текста к одному товару получают
+    разные, но уже готовые ответы без запроса к OpenAI.
+
+    Счетчик очереди вариантов живет только в памяти: попадание не
+    переписывает запись на диске и не продлевает ее жизнь. Новый вариант
+    сохраняется с временем жизни записи, в которую добавлен, — набор
+    ответов целиком обновляется раз в REPLY_CACHE_TTL.
+    """
+    def __init__(self, variants=REPLY_CACHE_VARIANTS, ttl=REPLY_CACHE_TTL, max_size=REPLY_CACHE_SIZE):
+        self.variants = variants
+        self.cache = TTLCache('review_replies', ttl, max_size,
+                              os.path.join(SEARCH_CACHE_DIR, 'review_replies') if SEARCH_CACHE_DIR else None)
+        self._inflight = {}
+        self._next = {}
+        self._cond = Condition()
+
+    @staticmethod
+    def normalize(text):
+        text = str(text or '').lower().replace('ё', 'е')
+        return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+    def key(self, prompt, review_text, product_name, stars):
+        """Ключ кэша или None, если отзыв не тривиальный (или кэш выключен)"""
+        try:
+            stars = int(stars)
+        except (TypeError, ValueError):
+            return None
+        text = self.normalize(review_text)
+        if self.variants <= 0 or stars < REPLY_CACHE_MIN_STARS or len(text) > REPLY_CACHE_TRIVIAL_CHARS:
+            return None
+        prompt_hash = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:16]
+        return (prompt_hash, self.normalize(product_name), str(stars), text)
+
+    def get_or_generate(self, key, generate):
+        """(ответ, usage, из кэша ли) — generate() вызывается, только если вариантов еще мало"""
+        with self._cond:
+            while True:
+                entry = self.cache.get(key) or {'replies': []}
+                inflight = self._inflight.get(key, 0)
+                if len(entry['replies']) + inflight < self.variants:
+                    self._inflight[key] = inflight + 1
+                    break
+                if entry['replies']:
+                    if key not in self._next and len(self._next) >= self.cache.max_size:
+                        # Счетчики только для порядка выдачи: при переполнении начинаем заново
+                        self._next.clear()
+                    index = self._next.get(key, 0)
+                    self._next[key] = index + 1
+                    return entry['replies'][index % len(entry['replies'])], None, True
+                # Все варианты еще генерируются: ждем первый
+                self._cond.wait(timeout=OPENAI_TIMEOUT)
+        reply = None
+        try:
+            reply, usage = generate()
+            return reply, usage, False
+        finally:
+            with self._cond:
+                self._inflight[key] -= 1
+                if not self._inflight[key]:
+                    del self._inflight[key]
+                if reply:
+                    entry = self.cache.get(key)
+                    if entry is None:
+                        entry = {'replies': [], 'expires_at': time.time() + self.cache.ttl}
+                    if reply not in entry['replies']:
+                        expires_at = entry.get('expires_at') or time.time() + self.cache.ttl
+                        ttl = expires_at - time.time()
+                        if ttl > 0:
+                            self.cache.set(key, {'replies': (entry['replies'] + [reply])[-self.variants:],
+                                                 'expires_at': expires_at}, ttl)
+                self._cond.notify_all()
+
+review_reply_cache = ReviewReplyCache()
+
+def generate_reply_text(api_key, prompt, review_text, product_name, stars, model=REVIEW_REPLY_MODEL):
+    """Ответ на отзыв от OpenAI через общий клиент get_openai_client: (текст ответа, usage)
+
+    Промт передается отдельным system-сообщением, а отзыв — коротким
+    user-сообщением после него: одинаковое начало запроса позволяет
+    OpenAI кэшировать обработку промта (prompt caching).
+    """
+    client = get_openai_client(api_key)
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": f"Отзыв: {review_text}\nТовар: {product_name}\nОценка: {stars}"}
+        ],
+        max_tokens=REVIEW_REPLY_MAX_TOKENS,
+        temperature=REVIEW_REPLY_TEMPERATURE
+    )
+    return (response.choices[0].message.content or '').strip(), response.usage
+
+def reply_for_review(api_key, prompt, review_text, product_name, stars):
+    """(ответ, usage, из кэша ли): тривиальные отзывы через review_reply_cache, остальные — generate_reply_text"""
+    def generate():
+        return generate_reply_text(api_key, prompt, review_text, product_name, stars)
+
+    key = review_reply_cache.key(prompt, review_text, product_name, stars)
+    if key is None:
+        return generate() + (False,)
+    return review_reply_cache.get_or_generate(key, generate)
+
+def usage_dict(usage):
+    """Токены из usage ответа OpenAI (объект клиента или dict); cached_tokens — из кэша промта OpenAI"""
+    if usage is None:
+        return {field: 0 for field in USAGE_FIELDS}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, 'model_dump') else vars(usage)
+    details = usage.get('prompt_tokens_details') or {}
+    if not isinstance(details, dict):
+        details = vars(details)
+    result = {field: usage.get(field) or 0 for field in USAGE_FIELDS if field != 'cached_tokens'}
+    result['cached_tokens'] = details.get('cached_tokens') or 0
+    return result
+
+def iter_generated_replies(api_key, prompt, reviews, concurrency=None):
+    """Параллельная генерация ответов на отзывы через общий клиент OpenAI
+
+    Генератор отдает результат по каждому отзыву по мере готовности:
+    index и id отзыва, reply и usage либо error. Ошибка одного отзыва не
+    прерывает остальные. concurrency проверяет вызывающий код.
+    """
+    concurrency = max(1, min(concurrency or REVIEW_REPLY_CONCURRENCY, REVIEW_REPLY_MAX_CONCURRENCY,
+                             len(reviews) or 1))
+
+    def generate(index, review):
+        result = {'index': index, 'id': review.get('id')}
+        try:
+            reply, usage, cached = reply_for_review(api_key, prompt, review.get('review_text', ''),
+                                                    review.get('product_name', ''), review.get('stars', ''))
+            result.update({'reply': reply, 'usage': usage_dict(usage), 'cached': cached})
+        except Exception as e:
+            result['error'] = f'Ошибка генерации ответа: {e}'
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='review-replies')
+    futures = [executor.submit(generate, index, review) for index, review in enumerate(reviews)]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 @app.route('/generate-review-reply', methods=['POST'])
 @login_required
 def generate_review_reply():
@@ -1618,30 +5228,89 @@ def generate_review_reply():
     stars = data.get('stars', '')
     user_prompt = getattr(current_user, 'ai_prompt', None) or DEFAULT_AI_PROMPT
     user_token = getattr(current_user, 'ai_token', None) or DEFAULT_AI_TOKEN
-    prompt = user_prompt
-    model = 'gpt-4o'  # Диагностика: используем gpt-4o
-    # Формируем полный промт
-    full_prompt = f"{prompt}\n\nОтзыв: {review_text}\nТовар: {product_name}\nОценка: {stars}"
     try:
-        # Debug: выводим часть токена, модель, endpoint, тело запроса
+        # Debug: выводим часть токена и модель
         print(f"[AI DEBUG] Using OpenAI token: {user_token[:6]}...{user_token[-4:]}")
-        print(f"[AI DEBUG] Model: {model}")
-        print(f"[AI DEBUG] Endpoint: https://api.openai.com/v1/chat/completions")
-        print(f"[AI DEBUG] Request body: {{'model': '{model}', 'messages': [{{'role': 'user', 'content': full_prompt}}], 'max_tokens': 400, 'temperature': 0.9}}")
-        client = openai.OpenAI(api_key=user_token)
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": full_prompt}],
-            max_tokens=400,
-            temperature=0.9
-        )
-        # Debug: выводим весь ответ OpenAI
-        print(f"[AI DEBUG] OpenAI response: {response}")
-        reply = response.choices[0].message.content.strip()
-        return jsonify({'reply': reply})
+        print(f"[AI DEBUG] Model: {REVIEW_REPLY_MODEL}")
+        reply, usage, cached = reply_for_review(user_token, user_prompt, review_text, product_name, stars)
+        print(f"[AI DEBUG] OpenAI usage: {'ответ из кэша' if cached else usage_dict(usage)}")
+        return jsonify({'reply': reply, 'cached': cached})
     except Exception as e:
         print(f"[AI DEBUG] OpenAI error: {e}")
         return jsonify({'error': f'Ошибка генерации ответа: {e}'})
+
+@app.route('/generate-review-replies', methods=['POST'])
+@login_required
+def generate_review_replies():
+    """Ответы сразу на много отзывов: OpenAI вызывается параллельно (до concurrency запросов)
+
+    Тело запроса: reviews — список {id, review_text, product_name, stars}
+    (подходят и записи /wb-reviews: text, product), concurrency, stream.
+    При stream=true (по умолчанию) ответы отдаются построчно (NDJSON) по
+    мере готовности, последняя строка — итог с суммой токенов.
+    """
+    data = request.json or {}
+    reviews = []
+    for item in data.get('reviews') or []:
+        if not isinstance(item, dict):
+            continue
+        reviews.append({
+            'id': item.get('id'),
+            'review_text': item.get('review_text', item.get('text', '')),
+            'product_name': item.get('product_name', item.get('product', '')),
+            'stars': item.get('stars', '')
+        })
+    if not reviews:
+        return jsonify({'error': 'Не переданы отзывы'}), 400
+    if len(reviews) > REVIEW_REPLY_BULK_MAX:
+        return jsonify({'error': f'Не больше {REVIEW_REPLY_BULK_MAX} отзывов за запрос'}), 400
+    # Проверяем здесь: ошибка внутри потокового ответа пришла бы уже после статуса 200
+    try:
+        concurrency = int(data['concurrency']) if data.get('concurrency') not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency должно быть целым числом'}), 400
+    if concurrency is not None and not 1 <= concurrency <= REVIEW_REPLY_MAX_CONCURRENCY:
+        return jsonify({'error': f'concurrency должно быть от 1 до {REVIEW_REPLY_MAX_CONCURRENCY}'}), 400
+    prompt = getattr(current_user, 'ai_prompt', None) or DEFAULT_AI_PROMPT
+    api_key = getattr(current_user, 'ai_token', None) or DEFAULT_AI_TOKEN
+    if not api_key:
+        return jsonify({'error': 'Не задан ключ OpenAI'}), 400
+    started = time.time()
+    results = iter_generated_replies(api_key, prompt, reviews, concurrency)
+
+    def summary(failed, cached, usage):
+        return {
+            'done': True,
+            'total': len(reviews),
+            'failed': failed,
+            'cached': cached,
+            'usage': usage,
+            'elapsed_sec': round(time.time() - started, 2)
+        }
+
+    if data.get('stream', True):
+        def generate():
+            failed = cached = 0
+            usage = {field: 0 for field in USAGE_FIELDS}
+            try:
+                for result in results:
+                    failed += 'error' in result
+                    cached += bool(result.get('cached'))
+                    for field, value in result.get('usage', {}).items():
+                        usage[field] += value
+                    yield json.dumps(result, ensure_ascii=False) + '\n'
+                yield json.dumps(summary(failed, cached, usage)) + '\n'
+            finally:
+                results.close()
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    ordered = sorted(results, key=lambda result: result['index'])
+    usage = {field: sum(result.get('usage', {}).get(field, 0) for result in ordered) for field in USAGE_FIELDS}
+    response = summary(sum('error' in result for result in ordered),
+                       sum(bool(result.get('cached')) for result in ordered), usage)
+    response['results'] = ordered
+    return jsonify(response)
+
 # Endpoint для сохранения токена, промта и режима
 @app.route('/ai-settings', methods=['POST'])
 @login_required
@@ -1649,7 +5318,11 @@ def save_ai_settings():
     data = request.json or {}
     current_user.ai_token = data.get('ai_token') or None
     current_user.ai_prompt = data.get('ai_prompt') or None
-    current_user.ai_reply_mode = data.get('ai_reply_mode') or 'manual'
+    ai_reply_mode = data.get('ai_reply_mode') or 'manual'
+    if ai_reply_mode == 'auto' and current_user.ai_reply_mode != 'auto':
+        # Автоответ не трогает отзывы, накопившиеся до включения режима
+        current_user.ai_auto_enabled_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    current_user.ai_reply_mode = ai_reply_mode
     db.session.commit()
     login_user(current_user, force=True)
     return jsonify({'success': True})
@@ -1660,16 +5333,285 @@ def get_ai_settings():
     return jsonify({
         'ai_token': current_user.ai_token,
         'ai_prompt': current_user.ai_prompt,
-        'ai_reply_mode': current_user.ai_reply_mode
+        'ai_reply_mode': current_user.ai_reply_mode,
+        'ai_auto_enabled_at': current_user.ai_auto_enabled_at.isoformat() if current_user.ai_auto_enabled_at else None
     })
-# Фоновая задача автоответа (упрощённо)
+# ===== Автоответ на отзывы =====
+# Выключено по умолчанию: автоответ публикует тексты от имени продавца
+AUTO_REPLY_ENABLED = os.getenv('AUTO_REPLY_ENABLED', '0') == '1'
+AUTO_REPLY_INTERVAL_MINUTES = int(os.getenv('AUTO_REPLY_INTERVAL_MINUTES', 10))
+AUTO_REPLY_USER_WORKERS = int(os.getenv('AUTO_REPLY_USER_WORKERS', 4))  # Пользователей обрабатывается одновременно
+AUTO_REPLY_CONCURRENCY = int(os.getenv('AUTO_REPLY_CONCURRENCY', 3))  # Одновременных генераций на пользователя
+AUTO_REPLY_RPS = float(os.getenv('AUTO_REPLY_RPS', 1))  # Ответов в WB в секунду на пользователя
+AUTO_REPLY_MAX_PER_RUN = int(os.getenv('AUTO_REPLY_MAX_PER_RUN', 50))
+AUTO_REPLY_MAX_ATTEMPTS = 3
+AUTO_REPLY_PENDING_TIMEOUT = timedelta(hours=1)  # Зависший pending (процесс упал) можно взять заново
+AUTO_REPLY_POLL_SECONDS = 60
+
+class AutoReply(db.Model):
+    """Автоответ на отзыв: одна запись на отзыв, поэтому на отзыв отвечают не больше одного раза"""
+    feedback_id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    run_id = db.Column(db.Integer)
+    status = db.Column(db.String(16), nullable=False)  # pending, posted, failed
+    attempts = db.Column(db.Integer, nullable=False, default=1)
+    reply = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class AutoReplyRun(db.Model):
+    """Журнал проходов автоответа пользователя"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    status = db.Column(db.String(16), nullable=False, default='running')  # running, done, failed
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime)
+    found = db.Column(db.Integer, default=0)  # неотвеченных отзывов просмотрено
+    posted = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)  # уже отвечены автоответом или исчерпали попытки
+    error = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'found': self.found,
+            'posted': self.posted,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'error': self.error
+        }
+
+class AutoReplier:
+    """Фоновые автоответы для пользователей с ai_reply_mode='auto'
+
+    Раз в AUTO_REPLY_INTERVAL_MINUTES для каждого такого пользователя
+    запускается проход: неотвеченные отзывы из WB, генерация ответов
+    (до AUTO_REPLY_CONCURRENCY одновременно) и отправка через
+    post_review_answer со своим лимитером на пользователя. Проходы разных
+    пользователей идут в общем пуле из AUTO_REPLY_USER_WORKERS потоков,
+    и пользователь, чей проход еще не закончился, пропускается — медленный
+    ключ OpenAI занимает один поток и не задерживает остальных.
+
+    Отвечает только на отзывы, оставленные после включения режима
+    (User.ai_auto_enabled_at), — старые неотвеченные отзывы не трогаются.
+    Перед генерацией отзыв «захватывается» записью AutoReply с id отзыва
+    в качестве ключа, поэтому повторные проходы и другие процессы на тот
+    же отзыв не отвечают. Неудачные попытки повторяются до
+    AUTO_REPLY_MAX_ATTEMPTS раз. Итоги проходов пишутся в AutoReplyRun.
+    """
+    def __init__(self, user_workers=AUTO_REPLY_USER_WORKERS):
+        self.user_workers = max(1, user_workers)
+        self._executor = None
+        self._running = set()
+        self._next_run = {}
+        self._limiters = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.user_workers, thread_name_prefix='auto-reply')
+            return self._executor
+
+    def _limiter(self, user_id):
+        with self._lock:
+            if user_id not in self._limiters:
+                self._limiters[user_id] = AdaptiveRateLimiter(rate=AUTO_REPLY_RPS)
+            return self._limiters[user_id]
+
+    def trigger(self, user_id, force=False):
+        """Ставит проход пользователя в пул; False, если проход уже идет или время еще не подошло"""
+        now = datetime.now()
+        with self._lock:
+            if user_id in self._running or (not force and self._next_run.get(user_id, now) > now):
+                return False
+            self._running.add(user_id)
+            self._next_run[user_id] = now + timedelta(minutes=AUTO_REPLY_INTERVAL_MINUTES)
+        self._get_executor().submit(self._run_user_safe, user_id)
+        return True
+
+    def run_due(self):
+        """Ставит в пул проходы всех auto-пользователей, у которых подошло время; возвращает их число"""
+        user_ids = [user_id for (user_id,) in User.query.filter_by(ai_reply_mode='auto').with_entities(User.id)]
+        return sum(self.trigger(user_id) for user_id in user_ids)
+
+    def _run_user_safe(self, user_id):
+        try:
+            with app.app_context():
+                self.run_user(user_id)
+        except Exception as e:
+            print(f"[AUTO-REPLY] Ошибка прохода пользователя {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+
+    def run_user(self, user_id):
+        """Один проход автоответа пользователя; возвращает запись AutoReplyRun"""
+        user = db.session.get(User, user_id)
+        run = AutoReplyRun(user_id=user_id, status='running', started_at=datetime.now(),
+                           found=0, posted=0, failed=0, skipped=0)
+        db.session.add(run)
+        db.session.commit()
+        try:
+            token = user.wb_token if user else None
+            supplier_id = user.supplier_id if user else None
+            api_key = (user.ai_token if user else None) or DEFAULT_AI_TOKEN
+            prompt = (user.ai_prompt if user else None) or DEFAULT_AI_PROMPT
+            if not token or not supplier_id:
+                raise ValueError('Токен WB или Supplier ID не найден в профиле пользователя')
+            if not api_key:
+                raise ValueError('Не задан ключ OpenAI')
+            if not user.ai_auto_enabled_at:
+                # Режим включен до появления отметки: отсчитываем от первого прохода
+                user.ai_auto_enabled_at = datetime.now(timezone.utc).replace(tzinfo=None)
+                db.session.commit()
+            candidates = self._candidates(user_id, token, run, user.ai_auto_enabled_at)
+            db.session.commit()
+            limiter = self._limiter(user_id)
+            if candidates:
+                with ThreadPoolExecutor(max_workers=max(1, min(AUTO_REPLY_CONCURRENCY, len(candidates))),
+                                        thread_name_prefix=f'auto-reply-{user_id}') as executor:
+                    futures = [executor.submit(self._generate, api_key, prompt, review) for review in candidates]
+                    for future in as_completed(futures):
+                        review, reply, error = future.result()
+                        if error is None:
+                            error = post_review_answer(token, review['id'], reply, limiter)
+                        entry = db.session.get(AutoReply, str(review['id']))
+                        entry.reply = reply or None
+                        entry.updated_at = datetime.now()
+                        if error:
+                            entry.status = 'failed'
+                            entry.error = error
+                            run.failed += 1
+                        else:
+                            entry.status = 'posted'
+                            entry.error = None
+                            run.posted += 1
+                            review_mirror.mark_answered(supplier_id, review['id'], reply)
+                        db.session.commit()
+            run.status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            run.status = 'failed'
+            run.error = str(e)
+        run.finished_at = datetime.now()
+        db.session.commit()
+        print(f"[AUTO-REPLY] Пользователь {user_id}: отвечено {run.posted}, ошибок {run.failed}, "
+              f"пропущено {run.skipped}{', ' + run.error if run.error else ''}")
+        return run
+
+    def _candidates(self, user_id, token, run, created_after):
+        """Неотвеченные отзывы новее created_after (UTC), захваченные этим проходом (не больше AUTO_REPLY_MAX_PER_RUN)"""
+        candidates = []
+        feedbacks = iter_wb_feedbacks(token, answered=False, filters={'date_from': created_after},
+                                      limiter=AdaptiveRateLimiter(rate=WB_FEEDBACKS_RPS))
+        try:
+            for _, f in feedbacks:
+                review = feedback_to_dict(f)
+                if not review.get('id'):
+                    continue
+                run.found += 1
+                if self._claim(user_id, run.id, str(review['id'])):
+                    candidates.append(review)
+                    if len(candidates) >= AUTO_REPLY_MAX_PER_RUN:
+                        break
+                else:
+                    run.skipped += 1
+        finally:
+            feedbacks.close()
+        return candidates
+
+    def _claim(self, user_id, run_id, feedback_id):
+        """Захватывает отзыв для ответа: новый — записью pending, неудачный — условным UPDATE"""
+        now = datetime.now()
+        entry = db.session.get(AutoReply, feedback_id)
+        if entry is None:
+            db.session.add(AutoReply(feedback_id=feedback_id, user_id=user_id, run_id=run_id, status='pending',
+                                     attempts=1, created_at=now, updated_at=now))
+            try:
+                db.session.commit()
+                return True
+            except Exception:
+                # Отзыв одновременно захватил другой процесс
+                db.session.rollback()
+                return False
+        stale = entry.status == 'pending' and entry.updated_at < now - AUTO_REPLY_PENDING_TIMEOUT
+        if not (entry.status == 'failed' or stale) or entry.attempts >= AUTO_REPLY_MAX_ATTEMPTS:
+            return False
+        claimed = (AutoReply.query
+                   .filter_by(feedback_id=feedback_id, status=entry.status, attempts=entry.attempts)
+                   .update({'status': 'pending', 'attempts': entry.attempts + 1, 'run_id': run_id, 'updated_at': now},
+                           synchronize_session=False))
+        db.session.commit()
+        db.session.expire(entry)
+        return claimed == 1
+
+    @staticmethod
+    def _generate(api_key, prompt, review):
+        """(отзыв, ответ, ошибка) — ошибки генерации не прерывают проход"""
+        try:
+            reply, _, _ = reply_for_review(api_key, prompt, review.get('text', ''), review.get('product', ''),
+                                           review.get('stars', ''))
+            if not reply:
+                return review, '', 'Модель вернула пустой ответ'
+            return review, reply, None
+        except Exception as e:
+            return review, '', f'Ошибка генерации ответа: {e}'
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    self.run_due()
+            except Exception as e:
+                print(f"[AUTO-REPLY] Ошибка планировщика автоответов: {e}")
+            self._stop.wait(AUTO_REPLY_POLL_SECONDS)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, name='auto-reply', daemon=True)
+        self._thread.start()
+        print(f"[AUTO-REPLY] Автоответы запущены (раз в {AUTO_REPLY_INTERVAL_MINUTES} мин)")
+
+    def stop(self):
+        self._stop.set()
+
+auto_replier = AutoReplier()
+
 def auto_reply_to_reviews():
+    """Один проход планировщика автоответов (проходы пользователей выполняются в пуле auto_replier)"""
     with app.app_context():
-        users = User.query.filter_by(ai_reply_mode='auto').all()
-        for user in users:
-            # Получить новые отзывы (аналогично /wb-reviews)
-            # Для каждого нового отзыва вызвать generate_review_reply и отправить ответ через WB API
-            pass  # (реализация зависит от вашей логики запуска фоновых задач)
+        return auto_replier.run_due()
+
+@app.route('/auto-reply/runs', methods=['GET'])
+@login_required
+def auto_reply_runs():
+    """Журнал проходов автоответа текущего пользователя"""
+    runs = (AutoReplyRun.query
+            .filter_by(user_id=current_user.id)
+            .order_by(AutoReplyRun.started_at.desc())
+            .limit(request.args.get('limit', 20, type=int))
+            .all())
+    return jsonify({'runs': [run.to_dict() for run in runs]})
+
+@app.route('/auto-reply/run', methods=['POST'])
+@login_required
+def auto_reply_run_now():
+    """Запустить проход автоответа текущего пользователя сейчас"""
+    if current_user.ai_reply_mode != 'auto':
+        return jsonify({'error': 'Автоответ выключен в настройках ИИ'}), 400
+    if not auto_replier.trigger(current_user.id, force=True):
+        return jsonify({'error': 'Проход автоответа уже выполняется'}), 409
+    return jsonify({'success': True, 'runs_url': '/auto-reply/runs'}), 202
 
 with app.app_context():
     db.create_all()
@@ -1682,8 +5624,34 @@ with app.app_context():
     if not hasattr(User, 'ai_reply_mode'):
         with db.engine.connect() as con:
             con.execute("ALTER TABLE user ADD COLUMN ai_reply_mode VARCHAR(16) DEFAULT 'manual'")
+    user_columns = {c['name'] for c in db.inspect(db.engine).get_columns('user')}
+    if 'ai_auto_enabled_at' not in user_columns:
+        with db.engine.begin() as con:
+            con.execute(db.text('ALTER TABLE user ADD COLUMN ai_auto_enabled_at DATETIME'))
+    # Колонки чекпоинтов, добавленные в seller_crawl после создания таблицы
+    crawl_columns = {c['name'] for c in db.inspect(db.engine).get_columns('seller_crawl')}
+    with db.engine.begin() as con:
+        if 'last_page' not in crawl_columns:
+            con.execute(db.text('ALTER TABLE seller_crawl ADD COLUMN last_page INTEGER DEFAULT 0'))
+        if 'stats' not in crawl_columns:
+            con.execute(db.text('ALTER TABLE seller_crawl ADD COLUMN stats TEXT'))
+        if 'checkpoint_at' not in crawl_columns:
+            con.execute(db.text('ALTER TABLE seller_crawl ADD COLUMN checkpoint_at DATETIME'))
+
+def start_background_workers():
+    """Запуск фоновых планировщиков; вызывается точкой входа сервера, а не при импорте
+
+    При запуске через gunicorn — из хука post_worker_init (gunicorn.conf.py).
+    """
+    if RANK_TRACKER_ENABLED:
+        rank_tracker.start()
+    if REVIEW_SYNC_ENABLED:
+        review_mirror.start()
+    if AUTO_REPLY_ENABLED:
+        auto_replier.start()
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8000))
     print(f"Flask is starting on port {port}")
+    start_background_workers()
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Бенчмарк экспорта товаров: скорость записи (строк/сек) и пик памяти
+
+Запуск:
+    python bench_export.py [количество_строк] [форматы через запятую]
+
+Пример:
+    python bench_export.py 100000 csv,xlsx,pdf
+
+База данных и каталог выгрузок приложения на время замера переносятся
+во временный каталог, рабочие файлы не создаются.
+"""
+import argparse
+import os
+import time
+import tempfile
+import tracemalloc
+
+FORMATS = ('csv', 'xlsx', 'pdf')
+
+def make_products(count):
+    """Синтетические записи в формате WildberriesParser.extract_product_info"""
+    description = 'Качественный товар для дома и дачи. ' * 40
+    for i in range(count):
+        product_id = str(100000000 + i)
+        yield {
+            'Наименование': f'Товар {i}',
+            'Ссылка': f'https://www.wildberries.ru/catalog/{product_id}/detail.aspx',
+            'Артикул': product_id,
+            'Бренд': 'Бренд',
+            'Оценка': 4.8,
+            'Количество отзывов': i % 1000,
+            'Цена со скидкой': 990.0,
+            'Цена без скидки': 1990.0,
+            'Цвета': 'черный, белый',
+            'Размеры': '42, 44, 46, 48',
+            'Категория': 'Платья',
+            'Остаток': i % 50,
+            'Статус': 'В продаже',
+            'Описание': description
+        }
+
+def bench(name, writer, rows, directory):
+    filename = os.path.join(directory, f'bench.{name}')
+    # Замер скорости без tracemalloc, он заметно замедляет запись
+    start_time = time.perf_counter()
+    writer(make_products(rows), filename)
+    elapsed = time.perf_counter() - start_time
+    size_mb = os.path.getsize(filename) / (1024 * 1024)
+    # Отдельный прогон для пика памяти
+    tracemalloc.start()
+    writer(make_products(rows), filename)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name}: {rows} строк за {elapsed:.2f} сек — {rows / elapsed:.0f} строк/сек, "
+          f"пик памяти {peak / (1024 * 1024):.1f} МБ, файл {size_mb:.1f} МБ")
+
+def parse_formats(value):
+    formats = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in formats if name not in FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(f"неизвестные форматы: {', '.join(unknown or [value])}; "
+                                         f"доступны {', '.join(FORMATS)}")
+    return formats
+
+def main():
+    parser = argparse.ArgumentParser(description='Скорость записи и пик памяти экспорта товаров')
+    parser.add_argument('rows', nargs='?', type=int, default=20000, help='количество строк (по умолчанию 20000)')
+    parser.add_argument('formats', nargs='?', type=parse_formats, default=list(FORMATS),
+                        help=f"форматы через запятую (по умолчанию {','.join(FORMATS)})")
+    args = parser.parse_args()
+    if args.rows < 1:
+        parser.error('количество строк должно быть больше 0')
+
+    with tempfile.TemporaryDirectory() as directory:
+        # app_simple при импорте создает базу и каталог выгрузок: направляем их во временный каталог
+        os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        os.environ['UPLOAD_FOLDER'] = os.path.join(directory, 'parsed_files')
+        from app_simple import save_to_csv, save_to_xlsx, save_to_pdf
+        writers = {'csv': save_to_csv, 'xlsx': save_to_xlsx, 'pdf': save_to_pdf}
+        for name in args.formats:
+            bench(name, writers[name], args.rows, directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+# Настройки gunicorn (читаются из ./gunicorn.conf.py автоматически)
+# Один файл для Procfile и startCommand в railway.toml: ключи командной
+# строки переопределили бы эти значения
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Один процесс: очередь задач (/jobs/<id>) живет в памяти воркера
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+# Потоки, чтобы опрос /jobs/<id> не ждал долгие запросы (/check-position, /analyze-seo)
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+timeout = 120
+accesslog = '-'
+errorlog = '-'
+
+def post_worker_init(worker):
+    """Фоновые планировщики запускаются в воркере после загрузки приложения"""
+    from app_simple import start_background_workers
+    start_background_workers()
@@ -0,0 +1,70 @@
+# Общие фикстуры тестов: база и файлы выгрузки во временном каталоге,
+# внешние запросы подменяются через http_client.get
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# Настройки читаются при импорте app_simple, поэтому задаем их до него
+_TMP_DIR = tempfile.mkdtemp(prefix='wb-parser-tests-')
+os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(_TMP_DIR, 'test.db')}"
+os.environ['UPLOAD_FOLDER'] = os.path.join(_TMP_DIR, 'parsed_files')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_simple  # noqa: E402
+
+
+class FakeResponse:
+    """Ответ requests для подмены http_client.get"""
+    def __init__(self, status_code=200, data=None, text=None, headers=None):
+        self.status_code = status_code
+        self._data = data
+        self.text = text if text is not None else ('' if data is None else str(data))
+        self.headers = headers or {}
+
+    def json(self):
+        if self._data is None:
+            raise ValueError('No JSON object could be decoded')
+        return self._data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise app_simple.requests.exceptions.HTTPError(f'HTTP {self.status_code}')
+
+
+@pytest.fixture
+def app_module():
+    return app_simple
+
+
+@pytest.fixture
+def client():
+    return app_simple.app.test_client()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Файлы выгрузки пишутся в текущий каталог — переходим во временный"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def app_context():
+    with app_simple.app.app_context():
+        yield
+        app_simple.db.session.remove()
+
+
+def wait_for_job(client, job_id, timeout=30):
+    """Опрашивает /jobs/<id>, пока задача не завершится; возвращает ее статус"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['status'] in ('done', 'failed'):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f'Задача {job_id} не завершилась за {timeout} сек')
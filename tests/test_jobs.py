@@ -0,0 +1,53 @@
+from threading import Event
+
+from conftest import wait_for_job
+
+
+def test_job_lifecycle(app_module, client):
+    started = Event()
+    release = Event()
+
+    def run(job):
+        started.set()
+        job.update_progress({'step': 1})
+        release.wait(5)
+        return {'success': True, 'value': job.params['value']}
+
+    job = app_module.job_queue.submit('parse', run, {'value': 42})
+    assert started.wait(5)
+    response = client.get(f'/jobs/{job.id}/result')
+    assert response.status_code == 202
+    assert response.get_json()['status'] == 'running'
+    assert response.get_json()['progress'] == {'step': 1}
+
+    release.set()
+    status = wait_for_job(client, job.id)
+    assert status['status'] == 'done'
+    assert status['started_at'] and status['finished_at']
+    response = client.get(f'/jobs/{job.id}/result')
+    assert response.status_code == 200
+    assert response.get_json() == {'success': True, 'value': 42}
+
+
+def test_failed_job_error_is_worded_by_kind(app_module, client):
+    def fail(job):
+        raise ValueError('boom')
+
+    parse_job = app_module.job_queue.submit('parse', fail, {})
+    other_job = app_module.job_queue.submit('unknown-kind', fail, {})
+    for job, message in ((parse_job, 'Ошибка парсинга: boom'), (other_job, 'Ошибка задачи: boom')):
+        assert wait_for_job(client, job.id)['status'] == 'failed'
+        response = client.get(f'/jobs/{job.id}/result')
+        assert response.status_code == 500
+        assert response.get_json()['error'] == message
+        assert response.get_json()['job']['error'] == 'boom'
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/missing').status_code == 404
+    assert client.get('/jobs/missing/result').status_code == 404
+
+
+def test_parse_requires_seller_url(client):
+    response = client.post('/parse', json={'format': 'csv'})
+    assert response.status_code == 400
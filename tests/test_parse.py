@@ -0,0 +1,135 @@
+import csv
+import re
+from threading import Lock
+
+import openpyxl
+import pytest
+
+from conftest import FakeResponse, wait_for_job
+
+PAGE_SIZE = 100
+
+
+def make_product(nm_id):
+    return {
+        'id': nm_id,
+        'name': f'Товар {nm_id}',
+        'brand': 'Бренд',
+        'priceU': 150000,
+        'salePriceU': 99000,
+        'rating': 5,
+        'feedbacks': 3,
+        'sizes': [{'available': True, 'stocks': [{'qty': 2}]}]
+    }
+
+
+class FakeCatalog:
+    """catalog.wb.ru продавца: total товаров, страницы из failing отвечают 500"""
+    def __init__(self, total, failing=()):
+        self.total = total
+        self.failing = set(failing)
+        self.pages = []
+        self._lock = Lock()
+
+    def get(self, url, **kwargs):
+        assert 'catalog.wb.ru/sellers/catalog' in url, url
+        page = int(re.search(r'[?&]page=(\d+)', url).group(1))
+        supplier = int(re.search(r'[?&]supplier=(\d+)', url).group(1))
+        with self._lock:
+            self.pages.append(page)
+        if page in self.failing:
+            return FakeResponse(500, text='Internal Server Error')
+        start = (page - 1) * PAGE_SIZE
+        products = [make_product(supplier * 100000 + i) for i in range(start, min(start + PAGE_SIZE, self.total))]
+        return FakeResponse(200, {'data': {'products': products}})
+
+
+def start_parse(client, seller_id, **params):
+    params = dict({'seller_url': f'https://www.wildberries.ru/seller/{seller_id}',
+                   'concurrency': 2, 'rps': 20}, **params)
+    response = client.post('/parse', json=params)
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body['status_url'] == f"/jobs/{body['job_id']}"
+    return body['job_id']
+
+
+@pytest.mark.parametrize('file_format, seller_id', [('csv', 101), ('xlsx', 102), ('pdf', 103)])
+def test_parse_job_exports_each_format(app_module, client, workdir, monkeypatch, file_format, seller_id):
+    catalog = FakeCatalog(total=150)
+    monkeypatch.setattr(app_module.http_client, 'get', catalog.get)
+
+    job_id = start_parse(client, seller_id, format=file_format)
+    status = wait_for_job(client, job_id)
+    assert status['status'] == 'done', status
+    assert status['progress']['pages_done'] == 2
+
+    response = client.get(f'/jobs/{job_id}/result')
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['products_count'] == 150
+    assert result['format'] == file_format
+    assert not result['interrupted']
+    # За короткой второй страницей обход не заходит
+    assert sorted(catalog.pages) == [1, 2]
+
+    path = workdir / result['filename']
+    assert path.suffix == f'.{file_format}'
+    if file_format == 'csv':
+        with open(path, encoding='utf-8-sig') as f:
+            rows = list(csv.reader(f))
+        assert len(rows) == 151
+        assert 'Артикул' in rows[0]
+    elif file_format == 'xlsx':
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        rows = list(workbook.active.iter_rows(values_only=True))
+        workbook.close()
+        assert len(rows) == 151
+        assert 'Артикул' in rows[0]
+    else:
+        assert path.read_bytes().startswith(b'%PDF')
+
+
+def test_parse_job_without_products_fails(app_module, client, workdir, monkeypatch):
+    monkeypatch.setattr(app_module.http_client, 'get', FakeCatalog(total=0).get)
+
+    job_id = start_parse(client, 104)
+    assert wait_for_job(client, job_id)['status'] == 'failed'
+    response = client.get(f'/jobs/{job_id}/result')
+    assert response.status_code == 500
+    assert response.get_json()['error'] == 'Ошибка парсинга: Товары не найдены'
+
+
+def test_parse_rejects_bad_numbers(client):
+    response = client.post('/parse', json={'seller_url': '105', 'concurrency': 'many'})
+    assert response.status_code == 400
+    response = client.post('/parse', json={'seller_url': '105', 'rps': 0})
+    assert response.status_code == 400
+
+
+def test_interrupted_crawl_resumes_from_checkpoint(app_module, client, workdir, monkeypatch):
+    seller_id = 106
+    catalog = FakeCatalog(total=250, failing={2})
+    monkeypatch.setattr(app_module.http_client, 'get', catalog.get)
+
+    job_id = start_parse(client, seller_id)
+    assert wait_for_job(client, job_id)['status'] == 'done'
+    result = client.get(f'/jobs/{job_id}/result').get_json()
+    assert result['interrupted']
+    assert result['products_count'] == 100
+    assert result['snapshot']['last_page'] == 1
+
+    catalog = FakeCatalog(total=250)
+    monkeypatch.setattr(app_module.http_client, 'get', catalog.get)
+    job_id = start_parse(client, seller_id, resume=True)
+    status = wait_for_job(client, job_id)
+    assert status['status'] == 'done'
+    assert status['progress']['resumed_from_page'] == 2
+
+    result = client.get(f'/jobs/{job_id}/result').get_json()
+    assert not result['interrupted']
+    # Первая страница уже сохранена чекпоинтом и повторно не запрашивается
+    assert 1 not in catalog.pages
+    assert result['snapshot']['last_page'] == 3
+    assert result['snapshot']['products_count'] == 250
+    assert result['products_count'] == 250
@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture
+def cache(app_module):
+    return app_module.ReviewReplyCache(variants=2, ttl=60, max_size=100)
+
+
+@pytest.mark.parametrize('text, stars', [('', 5), ('Отлично!', 5), ('Все супер', '5')])
+def test_key_for_trivial_reviews(cache, text, stars):
+    assert cache.key('prompt', text, 'Платье', stars) is not None
+
+
+@pytest.mark.parametrize('text, stars', [
+    ('', 1),
+    ('не тот размер', 2),
+    ('', 4),
+    ('Ткань тонкая, после стирки села на размер', 5),
+    ('', ''),
+    ('', None),
+])
+def test_no_key_for_other_reviews(cache, text, stars):
+    assert cache.key('prompt', text, 'Платье', stars) is None
+
+
+def test_key_normalizes_text(cache):
+    assert cache.key('prompt', 'Отлично!!', 'Платье', 5) == cache.key('prompt', '  отлично ', 'платье', 5)
+    assert cache.key('prompt', 'Отлично', 'Платье', 5) != cache.key('other prompt', 'Отлично', 'Платье', 5)
+    assert cache.key('prompt', 'Отлично', 'Платье', 5) != cache.key('prompt', 'Отлично', 'Юбка', 5)
+
+
+def test_disabled_cache_has_no_keys(app_module):
+    assert app_module.ReviewReplyCache(variants=0, ttl=60, max_size=100).key('prompt', '', 'Платье', 5) is None
+
+
+def test_replies_are_reused_after_variants_collected(cache):
+    key = cache.key('prompt', '', 'Платье', 5)
+    generated = []
+
+    def generate():
+        generated.append(1)
+        return f'Ответ {len(generated)}', {'total_tokens': 10}
+
+    first = [cache.get_or_generate(key, generate) for _ in range(2)]
+    assert [cached for _, _, cached in first] == [False, False]
+    reused = [cache.get_or_generate(key, generate) for _ in range(4)]
+    assert len(generated) == 2
+    assert all(cached for _, _, cached in reused)
+    assert [reply for reply, _, _ in reused] == ['Ответ 1', 'Ответ 2', 'Ответ 1', 'Ответ 2']
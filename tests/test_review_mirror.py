@@ -0,0 +1,140 @@
+import json
+from datetime import datetime, timezone
+from threading import Lock
+
+import pytest
+
+from conftest import FakeResponse
+
+
+def feedback(feedback_id, answer='', created='2026-10-01T10:00:00Z', stars=5):
+    return {
+        'id': feedback_id,
+        'createdDate': created,
+        'productValuation': stars,
+        'text': 'Отзыв',
+        'userName': 'Покупатель',
+        'answer': {'text': answer} if answer else None,
+        'productDetails': {'nmId': 555, 'productName': 'Платье'}
+    }
+
+
+def utc_timestamp(value):
+    return int(value.replace(tzinfo=timezone.utc).timestamp())
+
+
+class FakeFeedbacksApi:
+    """feedbacks-api WB: списки неотвеченных и отвеченных отзывов и отзыв по id"""
+    def __init__(self, app_module, unanswered=(), answered=()):
+        self.app_module = app_module
+        self.unanswered = list(unanswered)
+        self.answered = list(answered)
+        self.by_id = {}
+        self.failing = set()
+        self.list_params = []
+        self.single_ids = []
+        self._lock = Lock()
+
+    def get(self, url, params=None, **kwargs):
+        if url == self.app_module.WB_FEEDBACK_URL:
+            with self._lock:
+                self.single_ids.append(params['id'])
+            found = self.by_id.get(params['id'])
+            return FakeResponse(404, text='Not found') if found is None else FakeResponse(200, {'data': found})
+        assert url == self.app_module.WB_FEEDBACKS_URL, url
+        kind = 'answered' if params['isAnswered'] == 'true' else 'new'
+        with self._lock:
+            self.list_params.append((kind, dict(params)))
+        if kind in self.failing:
+            return FakeResponse(500, text='Internal Server Error')
+        items = self.answered if kind == 'answered' else self.unanswered
+        if params.get('dateFrom'):
+            items = [f for f in items if utc_timestamp(self.app_module.parse_wb_datetime(f['createdDate']))
+                     >= params['dateFrom']]
+        return FakeResponse(200, {'data': {'feedbacks': items[params['skip']:params['skip'] + params['take']]}})
+
+
+@pytest.fixture
+def mirror(app_module, app_context):
+    return app_module.ReviewMirror()
+
+
+def stored(app_module, supplier_id):
+    return {row.id: row.is_answered for row in app_module.Review.query.filter_by(supplier_id=supplier_id)}
+
+
+def test_incremental_sync_requires_full_copy(app_module, mirror):
+    with pytest.raises(ValueError):
+        mirror.sync('mirror-1', 'token', full=False)
+    assert not mirror.is_ready('mirror-1')
+
+
+def test_incremental_sync_picks_up_new_answered_and_deleted(app_module, mirror, monkeypatch):
+    supplier_id = 'mirror-2'
+    api = FakeFeedbacksApi(app_module, unanswered=[feedback('1'), feedback('2'), feedback('3')],
+                           answered=[feedback('4', 'Спасибо')])
+    monkeypatch.setattr(app_module.http_client, 'get', api.get)
+    stats = mirror.sync(supplier_id, 'token')
+    assert stats['full'] and stats['inserted'] == 4
+    assert mirror.is_ready(supplier_id)
+    assert stored(app_module, supplier_id) == {'1': False, '2': False, '3': False, '4': True}
+
+    # Новый отзыв, отзыв 2 ответили в кабинете WB, отзыв 3 удалили
+    api.unanswered = [feedback('5', created='2026-10-02T10:00:00Z'), feedback('1')]
+    api.by_id = {'1': feedback('1'), '2': feedback('2', 'Ответ из кабинета')}
+    api.list_params.clear()
+    stats = mirror.sync(supplier_id, 'token')
+    assert not stats['full']
+    assert stats['inserted'] == 1
+    assert stats['rechecked'] == 2 and stats['deleted'] == 1
+    assert sorted(api.single_ids) == ['2', '3']
+    assert stored(app_module, supplier_id) == {'1': False, '2': True, '4': True, '5': False}
+    answered = json.loads(app_module.db.session.get(app_module.Review, '2').data)
+    assert answered['answer'] == 'Ответ из кабинета'
+
+    # Неотвеченные читаются целиком, отвеченные — от последнего createdDate в копии
+    params = dict(api.list_params)
+    assert 'dateFrom' not in params['new']
+    assert params['answered']['dateFrom'] == utc_timestamp(datetime(2026, 10, 1, 10) - app_module.REVIEW_SYNC_OVERLAP)
+
+    state = mirror.state(supplier_id)
+    assert state.error is None
+    assert state.reviews_count == 4
+    assert state.last_created_at == datetime(2026, 10, 2, 10)
+
+
+def test_full_sync_removes_missing_reviews(app_module, mirror, monkeypatch):
+    supplier_id = 'mirror-3'
+    api = FakeFeedbacksApi(app_module, unanswered=[feedback('31'), feedback('32')], answered=[feedback('33', 'Да')])
+    monkeypatch.setattr(app_module.http_client, 'get', api.get)
+    mirror.sync(supplier_id, 'token', full=True)
+
+    api.unanswered = [feedback('31')]
+    api.failing = {'answered'}
+    stats = mirror.sync(supplier_id, 'token', full=True)
+    # Выгрузка оборвалась — ничего не удаляем
+    assert stats['deleted'] == 0 and 'answered' in stats['errors']
+    assert stored(app_module, supplier_id) == {'31': False, '32': False, '33': True}
+    assert mirror.state(supplier_id).error
+
+    api.failing = set()
+    stats = mirror.sync(supplier_id, 'token', full=True)
+    assert stats['deleted'] == 1
+    assert stored(app_module, supplier_id) == {'31': False, '33': True}
+    assert mirror.state(supplier_id).error is None
+
+
+def test_mark_answered_bumps_synced_at(app_module, mirror, monkeypatch):
+    supplier_id = 'mirror-4'
+    api = FakeFeedbacksApi(app_module, unanswered=[feedback('41')])
+    monkeypatch.setattr(app_module.http_client, 'get', api.get)
+    mirror.sync(supplier_id, 'token', full=True)
+    row = app_module.db.session.get(app_module.Review, '41')
+    synced_at = row.synced_at
+
+    assert mirror.mark_answered(supplier_id, '41', 'Спасибо за отзыв')
+    assert not mirror.mark_answered('other-supplier', '41', 'Чужой отзыв')
+    row = app_module.db.session.get(app_module.Review, '41')
+    assert row.is_answered
+    assert row.synced_at > synced_at
+    assert json.loads(row.data)['answer'] == 'Спасибо за отзыв'
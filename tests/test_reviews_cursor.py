@@ -0,0 +1,35 @@
+import base64
+import json
+
+import pytest
+
+
+def raw_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('positions', [
+    {'new': 0, 'answered': 1000},
+    {'new': None, 'answered': 25},
+    {'new': ['2026-10-01T10:00:00', 'abc'], 'answered': None},
+])
+def test_round_trip(app_module, positions):
+    cursor = app_module.encode_reviews_cursor(positions)
+    assert app_module.decode_reviews_cursor(cursor) == positions
+
+
+@pytest.mark.parametrize('cursor', [
+    raw_cursor({'new': True}),
+    raw_cursor({'new': -1}),
+    raw_cursor({'new': 1.5}),
+    raw_cursor({'new': '10'}),
+    raw_cursor({'archived': 0}),
+    raw_cursor({'new': ['not-a-date', 'abc']}),
+    raw_cursor({'new': ['2026-10-01T10:00:00']}),
+    raw_cursor([0, 0]),
+    'not base64!',
+    '',
+])
+def test_rejects_invalid_cursor(app_module, cursor):
+    with pytest.raises(ValueError):
+        app_module.decode_reviews_cursor(cursor)
@@ -0,0 +1,92 @@
+import time
+from threading import Barrier, Lock, Thread
+
+import pytest
+
+
+def test_get_or_load_coalesces_concurrent_misses(app_module):
+    cache = app_module.TTLCache('test-coalesce', ttl=60, max_size=10)
+    calls = []
+    calls_lock = Lock()
+    threads_count = 8
+    barrier = Barrier(threads_count)
+    results = []
+
+    def loader():
+        with calls_lock:
+            calls.append(1)
+        time.sleep(0.2)
+        return {'page': 1}
+
+    def worker():
+        barrier.wait()
+        results.append(cache.get_or_load('key', loader))
+
+    threads = [Thread(target=worker) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [{'page': 1}] * threads_count
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['coalesced'] + stats['hits'] == threads_count - 1
+
+
+def test_failed_load_is_not_cached(app_module):
+    cache = app_module.TTLCache('test-failed-load', ttl=60, max_size=10)
+
+    def fail():
+        raise ValueError('WB недоступен')
+
+    with pytest.raises(ValueError):
+        cache.get_or_load('key', fail)
+    assert cache.get_or_load('key', lambda: 'ok') == 'ok'
+    assert cache.get('key') == 'ok'
+
+
+def test_ttl_may_depend_on_value(app_module):
+    cache = app_module.TTLCache('test-ttl', ttl=60, max_size=10)
+    cache.get_or_load('empty', lambda: [], ttl=lambda value: 60 if value else 0)
+    cache.get_or_load('full', lambda: [1], ttl=lambda value: 60 if value else 0)
+    assert cache.get('empty', 'missing') == 'missing'
+    assert cache.get('full') == [1]
+    assert cache.stats()['expired'] == 1
+
+
+def test_evicts_least_recently_used(app_module):
+    cache = app_module.TTLCache('test-lru', ttl=60, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicts_by_size(app_module):
+    cache = app_module.TTLCache('test-bytes', ttl=60, max_size=100, max_bytes=250)
+    for key in range(5):
+        cache.set(key, 'x' * 100)
+    stats = cache.stats()
+    assert stats['size'] == 2
+    assert stats['bytes'] <= 250
+    assert stats['evictions'] == 3
+    assert cache.get(4) == 'x' * 100 and cache.get(0) is None
+    # Запись больше лимита все равно хранится, чтобы кэш не был пустым
+    cache.set('big', 'x' * 1000)
+    assert cache.stats()['size'] == 1
+    assert cache.get('big') == 'x' * 1000
+
+
+def test_disk_level_survives_new_instance(app_module, tmp_path):
+    cache = app_module.TTLCache('test-disk', ttl=60, max_size=10, disk_dir=str(tmp_path))
+    cache.set(('query', 1), {'products': [1, 2]})
+    fresh = app_module.TTLCache('test-disk', ttl=60, max_size=10, disk_dir=str(tmp_path))
+    assert fresh.get(('query', 1)) == {'products': [1, 2]}
+    assert fresh.stats()['disk_hits'] == 1
+    fresh.invalidate(('query', 1))
+    assert app_module.TTLCache('test-disk', ttl=60, max_size=10, disk_dir=str(tmp_path)).get(('query', 1)) is None